@@ -0,0 +1,60 @@
+"""
+    Time the agreement analytics on a synthetic flattened export with millions of rows.
+
+    Usage:
+        python -m benchmarks.bench_analytics --rows 2000000
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from prompts import Prompt_3
+from utils.analytics import schema_vocabularies, AgreementAnalysis
+from utils.template_utils import LABEL_SEPARATOR
+from utils.convert_utils import QUESTION_KEYS
+
+
+def synthetic_answers(rng, labels: list, n_rows: int, max_labels: int = 3) -> np.ndarray:
+    """Comma-joined label sets drawn from a small pool of combinations, as in real exports"""
+    pool = []
+    for _ in range(200):
+        size = rng.integers(1, max_labels + 1)
+        pool.append(LABEL_SEPARATOR.join(rng.choice(labels, size=min(size, len(labels)), replace=False)))
+    return np.array(pool, dtype=object)[rng.integers(0, len(pool), n_rows)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the agreement analytics")
+    parser.add_argument("--rows", type=int, default=2000000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vocabularies = schema_vocabularies(Prompt_3().schema)
+    columns = {
+        "prediction_origin": rng.choice(["baseline", "fine-tuned-v1", "fine-tuned-v2"], args.rows),
+        "completed_by": rng.integers(1, 20, args.rows),
+    }
+    for question in QUESTION_KEYS:
+        columns["{}_prediction".format(question)] = synthetic_answers(rng, vocabularies[question], args.rows)
+        annotation = synthetic_answers(rng, vocabularies[question], args.rows)
+        # Annotators keep most of the predictions
+        keep = rng.random(args.rows) < 0.7
+        annotation[keep] = columns["{}_prediction".format(question)][keep]
+        columns["{}_annotation".format(question)] = annotation
+    df = pd.DataFrame(columns)
+
+    start = time.perf_counter()
+    analysis = AgreementAnalysis(df, vocabularies)
+    print("{:<34} {:>8.2f}s for {} rows".format("encoding (8 questions)", time.perf_counter() - start, args.rows))
+    for name, run in (
+        ("overall agreement", lambda: analysis.agreement_by()),
+        ("agreement by origin", lambda: analysis.agreement_by("prediction_origin")),
+        ("agreement by annotator", lambda: analysis.agreement_by("completed_by")),
+        ("label metrics (8 questions)", lambda: [analysis.label_metrics(q) for q in QUESTION_KEYS]),
+        ("confusion matrices (8 questions)", lambda: [analysis.confusion_matrix(q) for q in QUESTION_KEYS]),
+        ("full report", lambda: analysis.report(["prediction_origin", "completed_by"])),
+    ):
+        start = time.perf_counter()
+        run()
+        print("{:<34} {:>8.2f}s for {} rows".format(name, time.perf_counter() - start, args.rows))
+    print(analysis.agreement_by("prediction_origin").round(3).T)
@@ -0,0 +1,125 @@
+"""
+    Compare a single model with the Prompt_Cascade of a cheap and a strong model against a local fake
+    endpoint simulating both models (accuracy, latency, logprobs lower on mistakes). Reports the cost,
+    the latency per image, the share of images escalated to the strong model and the agreement of
+    the predictions with the simulated ground truth, overall and per tier (prediction origin).
+
+    Usage:
+        python -m benchmarks.bench_cascade --images 300 --thresholds 0.9 0.95 0.98
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import pandas as pd
+from PIL import Image
+from openai import AsyncOpenAI
+from prompts import Prompt_3, Prompt_Cascade
+from utils.metrics import RunMetrics
+from utils.pipeline import aquery_with_retries
+from utils.template_utils import load_template, format_value, ATTRIBUTE_MAPPING
+from utils.convert_utils import result_texts
+from utils.analytics import AgreementAnalysis, schema_vocabularies
+from benchmarks.fake_openai import FakeOpenAIServer, fake_truth
+
+
+PRICES = {"models": {"gpt-4o": {"prompt": 2.5, "cached": 1.25, "completion": 10.0},
+                     "gpt-4o-mini": {"prompt": 0.15, "cached": 0.075, "completion": 0.6}}}
+
+
+async def run(prompt, base_url: str, image_paths: list, concurrency: int, template, logger: logging.Logger) -> tuple:
+    """Predictions of every image and the latency of each of them"""
+    client = AsyncOpenAI(api_key="fake", base_url=base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(image_path):
+        async with semaphore:
+            start = time.perf_counter()
+            _, prediction, _ = await aquery_with_retries(prompt, client, image_path, template, 3, logger)
+            return prediction, time.perf_counter() - start
+
+    try:
+        return tuple(zip(*await asyncio.gather(*[one(image_path) for image_path in image_paths])))
+    finally:
+        await client.close()
+
+
+def agreement_frame(prompt, image_paths: list, predictions: list) -> pd.DataFrame:
+    """Flattened predictions next to the simulated ground truth, as in a flattened export"""
+    rows = []
+    for image_path, prediction in zip(image_paths, predictions):
+        truth = fake_truth(prompt.schema, prompt.image_content(image_path)["image_url"]["url"])
+        row = {"prediction_origin": None}
+        if prediction is not None:
+            row["prediction_origin"] = prediction["result"][0].get("origin")
+            for question, text in result_texts(prediction["result"]).items():
+                row["{}_prediction".format(question)] = text
+        for attribute, from_name in ATTRIBUTE_MAPPING.items():
+            row["{}_annotation".format(from_name.replace("answer", "q"))] = format_value(truth[attribute])
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the model cascade against a single model")
+    parser.add_argument("--images", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.9, 0.95, 0.98])
+    parser.add_argument("--cheap_accuracy", type=float, default=0.9, help="Share of right attributes of the cheap model")
+    parser.add_argument("--strong_accuracy", type=float, default=0.95, help="Share of right attributes of the strong model")
+    parser.add_argument("--cheap_latency", type=float, default=0.3)
+    parser.add_argument("--strong_latency", type=float, default=0.8)
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    args = parser.parse_args()
+    template = load_template(args.template)
+
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    directory = tempfile.mkdtemp()
+    image_paths = []
+    for i in range(args.images):
+        image_paths.append(os.path.join(directory, "shoe_{}.png".format(i)))
+        Image.new("RGB", (32, 32), (i % 256, (i // 256) % 256, 77)).save(image_paths[-1])
+
+    server = FakeOpenAIServer(models={
+        "gpt-4o-mini": {"accuracy": args.cheap_accuracy, "latency": lambda: random.lognormvariate(0, 0.3) * args.cheap_latency},
+        "gpt-4o": {"accuracy": args.strong_accuracy, "latency": lambda: random.lognormvariate(0, 0.3) * args.strong_latency},
+    }).start()
+    vocabularies = schema_vocabularies(Prompt_3().schema)
+
+    strategies = [("gpt-4o", Prompt_3(origin="bench/gpt-4o", model="gpt-4o")),
+                  ("gpt-4o-mini", Prompt_3(origin="bench/gpt-4o-mini", model="gpt-4o-mini"))]
+    for threshold in args.thresholds:
+        strategies.append(("cascade@{}".format(threshold), Prompt_Cascade(
+            origin="bench", model="gpt-4o", cheap_models=["gpt-4o-mini"], min_confidence=threshold)))
+
+    print("{:<16} {:>9} {:>10} {:>11} {:>11} {:>10} {:>10}".format(
+        "strategy", "requests", "escalated", "cost $/1k", "latency s", "exact", "jaccard"))
+    breakdowns = []
+    for name, prompt in strategies:
+        prompt.metrics = RunMetrics(PRICES)
+        requests = server.counts["requests"]
+        predictions, latencies = asyncio.run(run(prompt, server.base_url, image_paths, args.concurrency, template, logger))
+        analysis = AgreementAnalysis(agreement_frame(prompt, image_paths, predictions), vocabularies)
+        overall = analysis.agreement_by()
+        exact = overall[[column for column in overall.columns if column.endswith("_exact")]].mean(axis=1).iloc[0]
+        jaccard = overall[[column for column in overall.columns if column.endswith("_jaccard")]].mean(axis=1).iloc[0]
+        escalated = prompt.metrics.counters.get("cascade_escalated_gpt-4o-mini", 0)
+        print("{:<16} {:>9} {:>10} {:>11.3f} {:>11.3f} {:>10.3f} {:>10.3f}".format(
+            name, server.counts["requests"] - requests,
+            "{:.0%}".format(escalated / args.images) if isinstance(prompt, Prompt_Cascade) else "-",
+            prompt.metrics.cost() / args.images * 1000, sum(latencies) / len(latencies), exact, jaccard))
+        if isinstance(prompt, Prompt_Cascade):
+            breakdowns.append((name, analysis.agreement_by("prediction_origin")))
+    server.stop()
+
+    # Agreement of the predictions of each tier of the cascades
+    for name, by_origin in breakdowns:
+        exact = by_origin[[column for column in by_origin.columns if column.endswith("_exact")]].mean(axis=1)
+        print("{}: {}".format(name, ", ".join("{} exact={:.3f} on {} images".format(origin, value, by_origin["rows"][origin])
+                                               for origin, value in exact.items())))
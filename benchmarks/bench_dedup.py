@@ -0,0 +1,103 @@
+"""
+    Benchmark the near-duplicate deduplication on synthetic images: distinct originals and
+    near-duplicates of them (JPEG re-encodes, thumbnails, small crops, brightness changes).
+    Reports the hashing time with an empty and with a filled hash store, the time of the grouping
+    with the BK-tree against all-pairs comparisons, the share of LLM queries saved, and how many
+    duplicates were grouped with their original (recall) and how many images were wrongly grouped.
+
+    Usage:
+        python -m benchmarks.bench_dedup --images 5000 --duplicate_rate 0.3 --threshold 4
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image, ImageEnhance
+from utils.dedup import ImageHasher, Deduplicator, hamming
+
+
+def original(seed: int) -> Image.Image:
+    """Smooth random image, distinct originals have unrelated hashes"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (6, 6, 3), dtype=np.uint8)
+    return Image.fromarray(pixels).resize((256, 256), Image.BICUBIC)
+
+
+def near_duplicate(image: Image.Image, rng: random.Random) -> Image.Image:
+    """Re-upload, thumbnail, crop or exposure change of an image"""
+    kind = rng.choice(["thumbnail", "crop", "brightness", "reencode"])
+    if kind == "thumbnail":
+        return image.resize((rng.randint(64, 160),) * 2, Image.LANCZOS)
+    if kind == "crop":
+        margin = rng.randint(2, 10)
+        return image.crop((margin, margin, image.width - margin, image.height - margin))
+    if kind == "brightness":
+        return ImageEnhance.Brightness(image).enhance(rng.uniform(0.85, 1.15))
+    return image
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the near-duplicate deduplication")
+    parser.add_argument("--images", type=int, default=5000)
+    parser.add_argument("--duplicate_rate", type=float, default=0.3, help="Share of the images that are near-duplicates")
+    parser.add_argument("--algorithm", default="dhash", choices=["dhash", "phash"])
+    parser.add_argument("--threshold", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp()
+    tasks, source = [], {}
+    n_originals = 0
+    for task_id in range(args.images):
+        if n_originals and rng.random() < args.duplicate_rate:
+            origin = rng.randrange(n_originals)
+            image = near_duplicate(original(origin), rng)
+        else:
+            origin = n_originals
+            n_originals += 1
+            image = original(origin)
+        image_path = os.path.join(directory, "image_{}.jpg".format(task_id))
+        image.save(image_path, quality=rng.choice([75, 85, 95]))
+        tasks.append((task_id, image_path))
+        source[task_id] = origin
+
+    hasher = ImageHasher(os.path.join(directory, "hashes.sqlite"), args.algorithm, workers=args.workers)
+    start = time.perf_counter()
+    hashes = hasher.hash_images([image_path for _, image_path in tasks])
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    hasher.hash_images([image_path for _, image_path in tasks])
+    warm = time.perf_counter() - start
+
+    # Grouping of the stream, the hashes are read from the store
+    dedup = Deduplicator(hasher, threshold=args.threshold)
+    start = time.perf_counter()
+    representatives = list(dedup.representatives(tasks))
+    grouping = time.perf_counter() - start
+    representative_of = {task_id: task_id for task_id, _ in representatives}
+    for representative, members in dedup.members.items():
+        for task_id in members:
+            representative_of[task_id] = representative
+
+    # Same grouping by comparing each image with every representative
+    start = time.perf_counter()
+    kept = []
+    for task_id, image_path in tasks:
+        if not any(hamming(hashes[image_path], value) <= args.threshold for value in kept):
+            kept.append(hashes[image_path])
+    all_pairs = time.perf_counter() - start
+    hasher.close()
+
+    duplicates = [task_id for task_id in source if task_id != min(t for t in source if source[t] == source[task_id])]
+    grouped = [task_id for task_id in duplicates if representative_of[task_id] != task_id]
+    wrong = sum(source[representative_of[task_id]] != source[task_id] for task_id in source)
+    print("images: {}, originals: {}, near-duplicates: {}".format(args.images, n_originals, len(duplicates)))
+    print("hashing: {:.2f}s with an empty store, {:.2f}s with the stored hashes".format(cold, warm))
+    print("grouping: {:.3f}s with the BK-tree, {:.3f}s with all pairs".format(grouping, all_pairs))
+    print("queries: {} instead of {} ({:.0%} saved)".format(
+        len(representatives), args.images, 1 - len(representatives) / args.images))
+    print("recall: {:.1%} of the near-duplicates grouped, {} images grouped with another original".format(
+        len(grouped) / max(1, len(duplicates)), wrong))
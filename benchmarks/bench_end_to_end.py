@@ -0,0 +1,185 @@
+"""
+    Offline end-to-end benchmark: runs `main.py` on N synthetic tasks and images against a local
+    fake OpenAI endpoint and a local fake Label Studio server, then reports the throughput, the
+    latency percentiles of each remote endpoint and of each stage timed by the run (from its
+    summary), the peak RSS of the run and the HTTP calls.
+    Nothing is sent to OpenAI or to a real Label Studio.
+
+    Usage:
+        python -m benchmarks.bench_end_to_end --tasks 500 --concurrency 16 --openai_latency 0.8
+        python -m benchmarks.bench_end_to_end --tasks 500 --concurrency 16 --shards 4
+        python -m benchmarks.bench_end_to_end --tasks 100 --projects 5 --concurrency 16
+"""
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import tempfile
+import statistics
+import subprocess
+import yaml
+from PIL import Image
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fake_label_studio import FakeLabelStudioServer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(values: list) -> tuple:
+    """p50, p95 and p99 of a list of durations"""
+    if len(values) < 2:
+        return tuple(values * 3) if values else (0.0, 0.0, 0.0)
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def make_images(data_dir: str, n_tasks: int, size: int, duplicate_rate: float = 0.0):
+    """Write one JPEG per task, named as the fake Label Studio server expects. With `duplicate_rate`,
+    the images are distinct smooth patterns (plain colors all have the same perceptual hash) and
+    that share of them are re-encoded or downscaled copies of earlier ones."""
+    os.makedirs(data_dir, exist_ok=True)
+    originals = []
+    for task_id in range(1, n_tasks + 1):
+        if not duplicate_rate:
+            color = (random.randrange(256), random.randrange(256), random.randrange(256))
+            image = Image.new("RGB", (size, size), color)
+        elif originals and random.random() < duplicate_rate:
+            image = random.choice(originals)
+            image = image.resize((random.randint(size // 2, size),) * 2, Image.LANCZOS)
+        else:
+            pattern = bytes(random.randrange(256) for _ in range(6 * 6 * 3))
+            image = Image.frombytes("RGB", (6, 6), pattern).resize((size, size), Image.BICUBIC)
+            originals.append(image)
+        image.save(os.path.join(data_dir, "shoe_{}.jpg".format(task_id)), quality=random.choice([75, 85, 95]))
+
+
+def make_config(work_dir: str, args, openai_server: FakeOpenAIServer, ls_server: FakeLabelStudioServer) -> str:
+    """Write the configuration of the run pointing at the fake servers"""
+    config = {
+        "openai_api_key": "fake",
+        "openai_base_url": openai_server.base_url,
+        "label_studio_url": ls_server.url,
+        "label_studio_api_key": "fake",
+        "project_id": ls_server.project_id,
+        "data_storage": "local",
+        "data_dir": os.path.join(work_dir, "images"),
+        "template": os.path.abspath(args.template),
+        "page_size": args.page_size,
+        "upload_batch_size": args.upload_batch_size,
+        "prompt": {"class": args.prompt_class, "params": {"model": "fake", "origin": "bench"}},
+        "MAX_RETRIES": args.max_retries,
+        "rate_limit": {"max_backoff": 10},
+        "concurrency": args.concurrency,
+        "journal_path": os.path.join(work_dir, "journal_{project_id}.sqlite"),
+        "cache": "off",
+        "batch_dir": os.path.join(work_dir, "batches_{project_id}"),
+        "metrics": {"summary_path": os.path.join(work_dir, "summary.json")},
+        "logging": "INFO",
+    }
+    if args.projects > 1:
+        # One summary per project, and the combined one in summary.json
+        config["projects"] = [{"project_id": project_id} for project_id in ls_server.project_ids]
+        config["metrics"] = {"summary_path": os.path.join(work_dir, "summary_{project_id}.json"),
+                             "combined_summary_path": os.path.join(work_dir, "summary.json")}
+    if args.pack_size > 1:
+        config["prompt"]["params"]["pack_size"] = args.pack_size
+    if args.duplicate_rate:
+        config["dedup"] = {"hash_path": os.path.join(work_dir, "hashes.sqlite"), "threshold": 4}
+    if args.max_side:
+        config["image_preprocessing"] = {"max_side": args.max_side, "quality": 85, "detail": "auto", "workers": 4}
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of main.py against fake servers")
+    parser.add_argument("--tasks", type=int, default=200, help="Tasks of each project")
+    parser.add_argument("--projects", type=int, default=1, help="Projects annotated by the same run")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--prompt_class", default="prompts.Prompt_3")
+    parser.add_argument("--pack_size", type=int, default=1, help="Images per request with prompts.Prompt_3_Packed")
+    parser.add_argument("--image_size", type=int, default=1024, help="Side of the synthetic images")
+    parser.add_argument("--duplicate_rate", type=float, default=0.0,
+                        help="Share of near-duplicate images, enables the deduplication stage")
+    parser.add_argument("--max_side", type=int, default=None, help="Enable image preprocessing with this max side")
+    parser.add_argument("--openai_latency", type=float, default=0.5, help="Median latency of a completion")
+    parser.add_argument("--openai_latency_sigma", type=float, default=0.3, help="Sigma of the log-normal latency")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute enforced by the fake endpoint")
+    parser.add_argument("--error_429_rate", type=float, default=0.0)
+    parser.add_argument("--error_5xx_rate", type=float, default=0.0)
+    parser.add_argument("--ls_latency", type=float, default=0.02, help="Latency of a Label Studio request")
+    parser.add_argument("--existing_predictions", type=float, default=0.0,
+                        help="Share of the tasks that already have a prediction (updated instead of created)")
+    parser.add_argument("--page_size", type=int, default=100)
+    parser.add_argument("--upload_batch_size", type=int, default=100)
+    parser.add_argument("--max_retries", type=int, default=8)
+    parser.add_argument("--shards", type=int, default=1, help="Run through launch.py with this many processes")
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    parser.add_argument("--work_dir", default=None, help="Keep the images, config and logs of the run here")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_e2e_")
+    make_images(os.path.join(work_dir, "images"), args.tasks * args.projects, args.image_size, args.duplicate_rate)
+
+    openai_server = FakeOpenAIServer(
+        args.rpm, args.error_429_rate, args.error_5xx_rate,
+        latency=lambda: random.lognormvariate(0, args.openai_latency_sigma) * args.openai_latency).start()
+    ls_server = FakeLabelStudioServer(args.tasks, existing_predictions=args.existing_predictions,
+                                      latency=lambda: args.ls_latency, n_projects=args.projects).start()
+    config_path = make_config(work_dir, args, openai_server, ls_server)
+
+    log_path = os.path.join(work_dir, "run.log")
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        command = [sys.executable, "main.py", "--config", config_path]
+        if args.shards > 1:
+            command = [sys.executable, "launch.py", "--config", config_path, "--shards", str(args.shards),
+                       "--log_dir", os.path.join(work_dir, "logs")]
+        returncode = subprocess.call(command, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+    # Kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    openai_server.stop()
+    ls_server.stop()
+
+    predicted = ls_server.predicted_tasks()
+    report = {
+        "tasks": args.tasks * args.projects,
+        "predicted_tasks": predicted,
+        "returncode": returncode,
+        "wall_time_s": round(elapsed, 3),
+        "images_per_s": round(predicted / elapsed, 2),
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "stages": {},
+        "client_stages": {},
+        "http_calls": {"POST /v1/chat/completions": openai_server.counts["requests"]},
+        "openai": dict(openai_server.counts),
+    }
+    stages = {"POST /v1/chat/completions": openai_server.durations}
+    stages.update(ls_server.durations)
+    report["http_calls"].update(ls_server.counts)
+    for stage, durations in stages.items():
+        p50, p95, p99 = percentiles(durations)
+        report["stages"][stage] = {"count": len(durations), "p50_ms": round(p50 * 1000, 1),
+                                   "p95_ms": round(p95 * 1000, 1), "p99_ms": round(p99 * 1000, 1)}
+
+    # Stages timed inside the run (encoding, parsing, rate limiter waits, ...) from its summary
+    summary_path = os.path.join(work_dir, "summary.json")
+    if os.path.exists(summary_path):
+        with open(summary_path) as f:
+            summary = json.load(f)
+        for stage, stats in summary["stages"].items():
+            report["client_stages"][stage] = {"count": stats["count"], "p50_ms": round(stats["p50"] * 1000, 1),
+                                              "p95_ms": round(stats["p95"] * 1000, 1),
+                                              "p99_ms": round(stats["p99"] * 1000, 1)}
+
+    print(json.dumps(report, indent=2))
+    if returncode != 0 or predicted != args.tasks * args.projects:
+        print("The run did not predict every task, see {}".format(log_path), file=sys.stderr)
+        sys.exit(1)
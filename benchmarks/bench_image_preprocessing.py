@@ -0,0 +1,60 @@
+"""
+    Report the bytes sent and the estimated image tokens per image before and after preprocessing.
+
+    Usage:
+        python -m benchmarks.bench_image_preprocessing --data_dir ./dataset/project_4 --max_side 1024 --detail auto
+"""
+import os
+import time
+import argparse
+from PIL import Image
+from utils.image_utils import ImagePreprocessor, estimate_image_tokens, preprocess_image
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def base64_size(n_bytes: int) -> int:
+    return 4 * ((n_bytes + 2) // 3)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image preprocessing stage")
+    parser.add_argument("--data_dir", type=str, required=True, help="Directory with the images")
+    parser.add_argument("--max_side", type=int, default=1024)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--detail", type=str, default="auto", choices=["low", "high", "auto"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=200, help="Number of images to benchmark")
+    args = parser.parse_args()
+
+    image_paths = sorted(
+        os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir) if f.lower().endswith(IMAGE_EXTENSIONS)
+    )[:args.limit]
+    if not image_paths:
+        raise SystemExit("No images found in {}".format(args.data_dir))
+
+    bytes_before, bytes_after, tokens_before, tokens_after = 0, 0, 0, 0
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            width, height = image.size
+        bytes_before += base64_size(os.path.getsize(image_path))
+        tokens_before += estimate_image_tokens(width, height, "high")
+
+        data, _, width, height = preprocess_image(image_path, args.max_side, args.quality)
+        bytes_after += base64_size(len(data))
+        tokens_after += estimate_image_tokens(width, height, args.detail)
+
+    # Throughput of the preprocessing pool
+    preprocessor = ImagePreprocessor(args.max_side, args.quality, args.detail, args.workers, capacity=len(image_paths))
+    start = time.perf_counter()
+    for future in [preprocessor.submit(image_path) for image_path in image_paths]:
+        future.result()
+    elapsed = time.perf_counter() - start
+
+    n = len(image_paths)
+    print("Images:                 {}".format(n))
+    print("Bytes sent per image:   {:.0f} -> {:.0f} ({:.1f}x smaller)".format(
+        bytes_before / n, bytes_after / n, bytes_before / max(bytes_after, 1)))
+    print("Image tokens per image: {:.0f} -> {:.0f}".format(tokens_before / n, tokens_after / n))
+    print("Preprocessing:          {:.1f} images/s with {} workers".format(n / elapsed, args.workers))
@@ -0,0 +1,122 @@
+"""
+    Benchmark the incremental mode against a local fake OpenAI endpoint and a fake Label Studio
+    server. A first incremental run predicts every task, then most tasks are annotated, a few of
+    the others are updated and new tasks are added, as between two runs on a live project. The
+    second run is either a full run or an incremental run, on the same state:
+
+        full:         `annotate`, every task is fetched and queried again
+        incremental:  `annotate --incremental`, only the new and updated tasks without annotation
+
+    Reports for the second run the tasks fetched, the requests to the model, the HTTP calls to
+    Label Studio and the wall time.
+
+    Usage:
+        python -m benchmarks.bench_incremental --tasks 2000 --annotated 0.8 --updated 0.05 --new 0.1
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import yaml
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fake_label_studio import FakeLabelStudioServer
+from benchmarks.bench_end_to_end import ROOT, make_images
+
+
+def write_config(work_dir: str, args, openai_server: FakeOpenAIServer, ls_server: FakeLabelStudioServer) -> str:
+    config = {
+        "openai_api_key": "fake",
+        "openai_base_url": openai_server.base_url,
+        "label_studio_url": ls_server.url,
+        "label_studio_api_key": "fake",
+        "project_id": ls_server.project_id,
+        "data_storage": "local",
+        "data_dir": os.path.join(work_dir, "images"),
+        "template": os.path.abspath(args.template),
+        "prompt": {"class": "prompts.Prompt_3", "params": {"model": "fake", "origin": "bench"}},
+        "MAX_RETRIES": 3,
+        "concurrency": args.concurrency,
+        "page_size": args.page_size,
+        "journal_path": os.path.join(work_dir, "journal.sqlite"),
+        "sync_state_path": os.path.join(work_dir, "sync.json"),
+        "cache": "off",
+        "logging": "INFO",
+    }
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+def run_command(command: list, log_path: str) -> tuple:
+    start = time.perf_counter()
+    with open(log_path, "a") as log:
+        returncode = subprocess.call([sys.executable, "-m", "lsllm"] + command, cwd=ROOT,
+                                     stdout=log, stderr=subprocess.STDOUT)
+    return returncode, time.perf_counter() - start
+
+
+def snapshot(openai_server: FakeOpenAIServer, ls_server: FakeLabelStudioServer) -> dict:
+    return {"fetched": ls_server.served_tasks, "model requests": openai_server.counts["requests"],
+            "ls calls": sum(ls_server.counts.values())}
+
+
+def run_mode(mode: str, args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="bench_incremental_{}_".format(mode))
+    n_new = int(args.tasks * args.new)
+    make_images(os.path.join(work_dir, "images"), args.tasks + n_new, 256)
+    openai_server = FakeOpenAIServer(latency=lambda: random.lognormvariate(0, 0.3) * args.openai_latency).start()
+    ls_server = FakeLabelStudioServer(args.tasks, latency=lambda: 0.005).start()
+    config_path = write_config(work_dir, args, openai_server, ls_server)
+    log_path = os.path.join(work_dir, "run.log")
+    # The high-water mark has the one-second resolution of the Date header, tasks created in the same
+    # second as the start of the first run would count as updated
+    time.sleep(1)
+
+    returncode, _ = run_command(["annotate", "--config", config_path, "--incremental"], log_path)
+    if returncode != 0:
+        raise RuntimeError("The first run failed, see {}".format(log_path))
+
+    # Same changes in both modes
+    rng = random.Random(args.seed)
+    task_ids = list(range(1, args.tasks + 1))
+    annotated = set(rng.sample(task_ids, int(args.tasks * args.annotated)))
+    ls_server.annotate_tasks(annotated)
+    remaining = [task_id for task_id in task_ids if task_id not in annotated]
+    ls_server.touch_tasks(rng.sample(remaining, min(len(remaining), int(args.tasks * args.updated))))
+    ls_server.add_tasks(ls_server.project_id, range(args.tasks + 1, args.tasks + n_new + 1))
+
+    before = snapshot(openai_server, ls_server)
+    command = ["annotate", "--config", config_path] + (["--incremental"] if mode == "incremental" else [])
+    returncode, elapsed = run_command(command, log_path)
+    after = snapshot(openai_server, ls_server)
+    openai_server.stop()
+    ls_server.stop()
+    result = {key: after[key] - before[key] for key in after}
+    result.update(returncode=returncode, time=elapsed, predicted=ls_server.predicted_tasks())
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the incremental mode against a full run")
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--annotated", type=float, default=0.8, help="Share of the tasks annotated after the first run")
+    parser.add_argument("--updated", type=float, default=0.05, help="Share of the tasks updated after the first run")
+    parser.add_argument("--new", type=float, default=0.1, help="Share of new tasks added after the first run")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--openai_latency", type=float, default=0.05)
+    parser.add_argument("--page_size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    args = parser.parse_args()
+
+    print("{:<12} {:>10} {:>9} {:>15} {:>9} {:>8} {:>10}".format(
+        "second run", "exit code", "fetched", "model requests", "ls calls", "time s", "predicted"))
+    for mode in ("full", "incremental"):
+        result = run_mode(mode, args)
+        print("{:<12} {:>10} {:>9} {:>15} {:>9} {:>8.2f} {:>10}".format(
+            mode, result["returncode"], result["fetched"], result["model requests"], result["ls calls"],
+            result["time"], "{}/{}".format(result["predicted"], args.tasks + int(args.tasks * args.new))))
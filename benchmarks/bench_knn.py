@@ -0,0 +1,146 @@
+"""
+    Benchmark the kNN tier on synthetic annotated images: the type, colors and heel of a shoe show in
+    the shape and the colors of its image, the other attributes follow from the type, and a share of
+    the annotations are noisy (attributes that do not show in the image, annotator mistakes).
+    A held-out split is labeled from the index of the others for several agreement thresholds and
+    compared with its annotations, as `lsllm knn evaluate` does on a real export.
+
+    Also compares the inverted-file search of a large index with the exhaustive search (time, recall).
+
+    Usage:
+        python -m benchmarks.bench_knn --images 3000 --label_noise 0.1
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+from utils.knn import HandcraftedEmbedder, VectorIndex, annotated_rows, local_image_paths, evaluate, normalize_rows
+from utils.template_utils import ATTRIBUTE_MAPPING
+
+
+COLORS = {"Black": (20, 20, 20), "White": (235, 235, 235), "Red": (200, 30, 30), "Blue": (30, 60, 200), "Brown": (120, 70, 30)}
+TYPES = ["Sneaker", "Boot", "Sandal", "Pump", "Loafer"]
+# Attributes that do not show in the synthetic images, they follow from the type
+DERIVED = {
+    "Function": ["Sport", "Outdoor", "Beach", "Formal", "Casual"],
+    "Upper Structure": ["Closed", "Closed", "Open", "Closed", "Closed"],
+    "Closure Type": ["Laces", "Zip", "Buckle", "Slip-on", "Slip-on"],
+    "Toe Shape": ["Round", "Round", "Open", "Pointed", "Round"],
+}
+HEELS = ["Flat", "Block", "Stiletto"]
+
+
+def draw_shoe(type_index: int, main: str, sub: str, heel: int, rng: random.Random) -> Image.Image:
+    """Shoe-like drawing: the silhouette depends on the type, the fill on the colors, the heel on its type"""
+    image = Image.new("RGB", (256, 256), (250, 250, 250))
+    draw = ImageDraw.Draw(image)
+    dx, dy = rng.randint(-12, 12), rng.randint(-12, 12)
+    jitter = lambda color: tuple(min(255, max(0, c + rng.randint(-15, 15))) for c in color)
+    outlines = [
+        [(40, 150), (200, 150), (220, 190), (40, 190)],
+        [(60, 40), (130, 40), (130, 150), (220, 160), (220, 200), (60, 200)],
+        [(40, 170), (220, 170), (220, 185), (40, 185)],
+        [(40, 120), (120, 160), (230, 175), (210, 190), (60, 190)],
+        [(40, 140), (190, 140), (225, 175), (225, 195), (40, 195)],
+    ]
+    draw.polygon([(x + dx, y + dy) for x, y in outlines[type_index]], fill=jitter(COLORS[main]), outline=(0, 0, 0))
+    # Sole in the secondary color
+    draw.rectangle([40 + dx, 190 + dy, 225 + dx, 205 + dy], fill=jitter(COLORS[sub]))
+    if heel == 1:
+        draw.rectangle([40 + dx, 205 + dy, 70 + dx, 235 + dy], fill=(60, 60, 60))
+    elif heel == 2:
+        draw.polygon([(45 + dx, 205 + dy), (58 + dx, 205 + dy), (52 + dx, 245 + dy)], fill=(60, 60, 60))
+    return image
+
+
+def make_export(directory: str, n_images: int, label_noise: float, seed: int = 0) -> pd.DataFrame:
+    """Images and flattened export of their annotations"""
+    rng = random.Random(seed)
+    rows = []
+    for task_id in range(1, n_images + 1):
+        type_index = rng.randrange(len(TYPES))
+        main, sub = rng.sample(list(COLORS), 2)
+        heel = rng.randrange(len(HEELS)) if type_index in (1, 3) else 0
+        draw_shoe(type_index, main, sub, heel, rng).save(os.path.join(directory, "shoe_{}.jpg".format(task_id)), quality=85)
+        answers = {"Type": TYPES[type_index], "Main Color": main, "Sub Color": sub, "Heel Type": HEELS[heel]}
+        answers.update({attribute: values[type_index] for attribute, values in DERIVED.items()})
+        for attribute in answers:
+            if rng.random() < label_noise / len(answers):
+                answers[attribute] = "Other"
+        row = {"task_id": task_id, "image_path": "/data/upload/1/{:08x}-shoe_{}.jpg".format(task_id, task_id),
+               "annotation_id": task_id, "annotation_updated_at": None}
+        for attribute, from_name in ATTRIBUTE_MAPPING.items():
+            row["{}_annotation".format(from_name.replace("answer", "q"))] = answers[attribute]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def search_benchmark(n_vectors: int, dimension: int, queries: int, k: int, nprobe: int, directory: str):
+    """Time and recall@k of the inverted-file search against the exhaustive search"""
+    rng = np.random.default_rng(0)
+    centers = normalize_rows(rng.normal(size=(200, dimension)))
+    vectors = normalize_rows(centers[rng.integers(0, 200, n_vectors)] + 0.03 * rng.normal(size=(n_vectors, dimension))).astype(np.float32)
+    codes = np.zeros((n_vectors, 1), dtype=np.int32)
+    embedder = {"embedder": "synthetic"}
+    VectorIndex.write(os.path.join(directory, "ivf"), vectors, codes, list(range(n_vectors)), ["a"], {"a": ["x"]}, embedder)
+    VectorIndex.write(os.path.join(directory, "flat"), vectors, codes, list(range(n_vectors)), ["a"], {"a": ["x"]}, embedder, n_lists=1)
+    ivf, flat = VectorIndex(os.path.join(directory, "ivf")), VectorIndex(os.path.join(directory, "flat"))
+    query_vectors = normalize_rows(vectors[rng.integers(0, n_vectors, queries)] + 0.01 * rng.normal(size=(queries, dimension))).astype(np.float32)
+    results = {}
+    for name, index in (("exhaustive", flat), ("ivf", ivf)):
+        start = time.perf_counter()
+        _, rows = index.search(query_vectors, k, nprobe)
+        results[name] = (time.perf_counter() - start, [set(index.meta["task_ids"][row] for row in found) for found in rows])
+    recall = np.mean([len(a & b) / k for a, b in zip(results["ivf"][1], results["exhaustive"][1])])
+    print("search of {} vectors ({} lists, nprobe {}): exhaustive {:.2f} ms/query, ivf {:.2f} ms/query, recall@{} {:.1%}".format(
+        n_vectors, len(ivf.centroids), nprobe, 1000 * results["exhaustive"][0] / queries,
+        1000 * results["ivf"][0] / queries, k, recall))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the kNN label propagation on synthetic annotated images")
+    parser.add_argument("--images", type=int, default=3000)
+    parser.add_argument("--label_noise", type=float, default=0.1, help="Share of the images with one noisy annotation")
+    parser.add_argument("--holdout", type=float, default=0.2)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.6, 0.7, 0.8, 0.9, 1.0])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--min_similarity", type=float, default=0.8)
+    parser.add_argument("--search_vectors", type=int, default=100000, help="Size of the index of the search benchmark, 0 to skip it")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    directory = tempfile.mkdtemp(prefix="bench_knn_")
+    image_dir = os.path.join(directory, "images")
+    os.makedirs(image_dir)
+    start = time.perf_counter()
+    export = make_export(image_dir, args.images, args.label_noise)
+    rows = annotated_rows(export)
+    image_paths = local_image_paths(rows, {"data_storage": "local", "data_dir": image_dir}, logger)
+    embedder = HandcraftedEmbedder()
+    start = time.perf_counter()
+    reports = evaluate(rows, image_paths, embedder, os.path.join(directory, "index"), logger, args.holdout,
+                       args.thresholds, k=args.k, min_similarity=args.min_similarity)
+    elapsed = time.perf_counter() - start
+    embedder.close()
+
+    print("{} annotated images, {} held out, indexed and evaluated in {:.1f}s".format(
+        args.images, reports[0]["held_out"], elapsed))
+    print("{:>10} {:>9} {:>9} {:>10} {:>8}  {}".format("agreement", "resolved", "share", "accuracy", "exact", "lowest attributes"))
+    for report in reports:
+        worst = sorted((stats["agreement"], attribute) for attribute, stats in report["attributes"].items()
+                       if stats["agreement"] is not None)[:3]
+        print("{:>10.2f} {:>9} {:>9.1%} {:>10} {:>8}  {}".format(
+            report["min_agreement"], report["resolved"], report["resolved_share"],
+            "-" if report["agreement"] is None else "{:.1%}".format(report["agreement"]),
+            "{:.1%}".format(report["exact_images"] / max(1, report["resolved"])),
+            ", ".join("{} {:.1%}".format(attribute, agreement) for agreement, attribute in worst)))
+    if args.search_vectors:
+        search_benchmark(args.search_vectors, 300, 500, args.k, 8, directory)
@@ -0,0 +1,164 @@
+"""
+    Load test of the ML backend (`lsllm serve`) against a local fake OpenAI endpoint. Concurrent
+    annotators open tasks, one /predict call per task as Label Studio sends them, a share of them
+    opening a task that was recently opened (by them or by another annotator). Compares:
+
+        unbatched:     Prompt_3, one request to the model per task (max_batch_size 1)
+        micro-batched: Prompt_3_Packed, the tasks of concurrent calls are packed into one request
+
+    Reports the calls answered with a prediction within the SLO, the latency percentiles of the
+    calls, the requests to the model and the calls answered from the last predictions or joined
+    to a prediction in flight.
+
+    Usage:
+        python -m benchmarks.bench_ml_backend --clients 32 --calls 40 --tasks 2000 --timeout 3
+"""
+import os
+import re
+import sys
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import requests
+import yaml
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.bench_end_to_end import ROOT, make_images, percentiles
+
+
+MODES = {
+    "unbatched": {"class": "prompts.Prompt_3", "max_batch_size": 1},
+    "micro-batched": {"class": "prompts.Prompt_3_Packed", "max_batch_size": 8, "pack_size": 8},
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(work_dir: str, mode: str, args, openai_server: FakeOpenAIServer, port: int) -> str:
+    params = {"model": "fake", "origin": "bench"}
+    if "pack_size" in MODES[mode]:
+        params["pack_size"] = MODES[mode]["pack_size"]
+    config = {
+        "openai_api_key": "fake",
+        "openai_base_url": openai_server.base_url,
+        "label_studio_url": "http://localhost:8080",
+        "label_studio_api_key": "fake",
+        "project_id": 1,
+        "data_storage": "local",
+        "data_dir": os.path.join(work_dir, "images"),
+        "template": os.path.abspath(args.template),
+        "prompt": {"class": MODES[mode]["class"], "params": params},
+        "MAX_RETRIES": 3,
+        "cache": "off",
+        "logging": "WARNING",
+        "ml_backend": {"host": "127.0.0.1", "port": port, "max_batch_size": MODES[mode]["max_batch_size"],
+                       "max_wait_ms": args.max_wait_ms, "concurrency": args.concurrency, "timeout": args.timeout},
+    }
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The ML backend exited with code {}".format(process.returncode))
+        try:
+            if requests.get(url + "/health", timeout=1).json()["status"] == "UP":
+                return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError("The ML backend did not start within {}s".format(timeout))
+
+
+def annotator(url: str, args, seed: int, opened: list, latencies: list, answered: list, lock: threading.Lock):
+    """Open `args.calls` tasks one after the other, like an annotator going through a project"""
+    rng = random.Random(seed)
+    session = requests.Session()
+    for _ in range(args.calls):
+        with lock:
+            if opened and rng.random() < args.repeat:
+                # A task opened recently, e.g. reopened or reviewed by another annotator
+                task_id = rng.choice(opened[-50:])
+            else:
+                task_id = rng.randint(1, args.tasks)
+            opened.append(task_id)
+        task = {"id": task_id, "data": {"image": "/data/upload/1/{:08x}-shoe_{}.jpg".format(task_id, task_id)}}
+        start = time.perf_counter()
+        response = session.post(url + "/predict", json={"project": "1.1700000000", "tasks": [task]}, timeout=60)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            answered.append(response.status_code == 200 and len(response.json()["results"]) == 1)
+        time.sleep(rng.uniform(0, args.think_time))
+
+
+def counters(url: str) -> dict:
+    text = requests.get(url + "/metrics", timeout=5).text
+    return {name: int(value) for name, value in re.findall(r'lsllm_events_total\{event="(\w+)"\} (\d+)', text)}
+
+
+def run_mode(mode: str, args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="bench_ml_backend_")
+    make_images(os.path.join(work_dir, "images"), args.tasks, 256)
+    openai_server = FakeOpenAIServer(latency=lambda: random.lognormvariate(0, 0.3) * args.openai_latency).start()
+    port = free_port()
+    config_path = write_config(work_dir, mode, args, openai_server, port)
+    url = "http://127.0.0.1:{}".format(port)
+    log = open(os.path.join(work_dir, "serve.log"), "w")
+    process = subprocess.Popen([sys.executable, "-m", "lsllm", "serve", "--config", config_path], cwd=ROOT,
+                               stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_until_up(url, process)
+        opened, latencies, answered, lock = [], [], [], threading.Lock()
+        threads = [threading.Thread(target=annotator, args=(url, args, seed, opened, latencies, answered, lock))
+                   for seed in range(args.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        events = counters(url)
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+        openai_server.stop()
+    return {"calls": len(latencies), "answered": sum(answered), "latency": percentiles(latencies),
+            "throughput": len(latencies) / elapsed, "model_requests": openai_server.counts["requests"],
+            "reused": events.get("prediction_cache_hits", 0) + events.get("inflight_joins", 0),
+            "batch_size": events.get("batched_tasks", 0) / max(1, events.get("batches", 0))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the Label Studio ML backend")
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent annotators")
+    parser.add_argument("--calls", type=int, default=40, help="Tasks opened by each annotator")
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--repeat", type=float, default=0.2, help="Share of the calls for a recently opened task")
+    parser.add_argument("--think_time", type=float, default=0.2, help="Maximum seconds between two calls of an annotator")
+    parser.add_argument("--openai_latency", type=float, default=0.8)
+    parser.add_argument("--concurrency", type=int, default=8, help="Batches in flight on the server")
+    parser.add_argument("--max_wait_ms", type=float, default=20)
+    parser.add_argument("--timeout", type=float, default=3.0, help="Latency SLO of a call in seconds")
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    args = parser.parse_args()
+
+    print("{:<14} {:>7} {:>15} {:>8} {:>8} {:>8} {:>9} {:>15} {:>7} {:>11}".format(
+        "mode", "calls", "answered in SLO", "p50 s", "p95 s", "p99 s", "calls/s", "model requests", "reused",
+        "batch size"))
+    for mode in MODES:
+        result = run_mode(mode, args)
+        print("{:<14} {:>7} {:>15} {:>8.3f} {:>8.3f} {:>8.3f} {:>9.1f} {:>15} {:>7} {:>11.1f}".format(
+            mode, result["calls"], "{:.1%}".format(result["answered"] / max(1, result["calls"])), *result["latency"],
+            result["throughput"], result["model_requests"], result["reused"], result["batch_size"]))
@@ -0,0 +1,79 @@
+"""
+    Compare the tokens and the wall time per image of Prompt_3_Packed for several pack sizes,
+    against a local fake endpoint that answers with one annotation per image.
+    A share of the packed outputs can be made invalid to exercise the fallback to single-image queries.
+
+    Usage:
+        python -m benchmarks.bench_packing --images 64 --pack_sizes 1 2 4 8 --invalid_output_rate 0.1
+"""
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from PIL import Image
+from openai import AsyncOpenAI
+from prompts import Prompt_3_Packed
+from utils.template_utils import load_template
+from utils.pipeline import aquery_packed_with_fallback, group_tasks
+from benchmarks.fake_openai import FakeOpenAIServer
+
+
+async def run(prompt, base_url: str, image_paths: list, concurrency: int, template,
+              logger: logging.Logger) -> int:
+    client = AsyncOpenAI(api_key="fake", base_url=base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(group):
+        async with semaphore:
+            results = await aquery_packed_with_fallback(prompt, client, group, template, 3, logger)
+            return sum(prediction is not None for _, prediction, _ in results)
+
+    try:
+        groups = list(group_tasks(prompt, image_paths))
+        return sum(await asyncio.gather(*[one(group) for group in groups]))
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark packing several images per request")
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--pack_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.5, help="Latency of a request with one image")
+    parser.add_argument("--latency_per_image", type=float, default=0.15, help="Extra latency per packed image")
+    parser.add_argument("--invalid_output_rate", type=float, default=0.0)
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    args = parser.parse_args()
+    template = load_template(args.template)
+
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    directory = tempfile.mkdtemp()
+    image_paths = []
+    for i in range(args.images):
+        image_paths.append(os.path.join(directory, "shoe_{}.jpg".format(i)))
+        Image.new("RGB", (64, 64), (200, 30, i % 256)).save(image_paths[-1])
+
+    print("{:>5} {:>9} {:>10} {:>15} {:>19} {:>11}".format(
+        "pack", "succeeded", "requests", "prompt tok/img", "completion tok/img", "wall s/img"))
+    for pack_size in args.pack_sizes:
+        prompt = Prompt_3_Packed(model="fake", origin="bench", pack_size=pack_size)
+        # Larger packs take longer to answer
+        server = FakeOpenAIServer(
+            latency=lambda: args.latency + args.latency_per_image * (pack_size - 1),
+            invalid_output_rate=args.invalid_output_rate).start()
+
+        start = time.perf_counter()
+        succeeded = asyncio.run(run(prompt, server.base_url, image_paths, args.concurrency, template, logger))
+        elapsed = time.perf_counter() - start
+        server.stop()
+
+        print("{:>5} {:>9} {:>10} {:>15.0f} {:>19.0f} {:>11.3f}".format(
+            pack_size, "{}/{}".format(succeeded, args.images), server.counts["requests"],
+            prompt.usage["prompt_tokens"] / args.images, prompt.usage["completion_tokens"] / args.images,
+            elapsed / args.images))
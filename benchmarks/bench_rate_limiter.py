@@ -0,0 +1,90 @@
+"""
+    Drive the concurrent query path against a local fake endpoint that enforces a
+    requests-per-minute limit and injects 429 and 5xx errors, with and without the rate limiter.
+    Exits with an error if, with the rate limiter, an image fails or more than `--max_limited`
+    requests are refused for exceeding the limit of the endpoint, so that it can guard the limiter in CI.
+
+    Usage:
+        python -m benchmarks.bench_rate_limiter --images 300 --concurrency 32 --rpm 1200
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from PIL import Image
+from openai import AsyncOpenAI
+from prompts import Prompt_3
+from utils.template_utils import load_template
+from utils.pipeline import aquery_with_retries
+from utils.rate_limiter import RateLimiter
+from benchmarks.fake_openai import FakeOpenAIServer
+
+
+async def run(prompt, base_url: str, image_path: str, n_images: int, concurrency: int, max_retries: int,
+              template, logger: logging.Logger) -> int:
+    client = AsyncOpenAI(api_key="fake", base_url=base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            _, prediction, _ = await aquery_with_retries(prompt, client, image_path, template, max_retries, logger)
+            return prediction is not None
+
+    try:
+        return sum(await asyncio.gather(*[one() for _ in range(n_images)]))
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the retries and the rate limiter against a fake endpoint")
+    parser.add_argument("--images", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rpm", type=int, default=1200, help="Requests per minute allowed by the fake endpoint")
+    parser.add_argument("--error_429_rate", type=float, default=0.05)
+    parser.add_argument("--error_5xx_rate", type=float, default=0.05)
+    parser.add_argument("--max_retries", type=int, default=8)
+    parser.add_argument("--max_limited", type=int, default=None,
+                        help="Maximum requests over the limit with the rate limiter, the concurrency by default "
+                             "(the first requests are sent before the limits are learned from the headers)")
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    args = parser.parse_args()
+    template = load_template(args.template)
+
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    image_path = os.path.join(tempfile.mkdtemp(), "shoe.jpg")
+    Image.new("RGB", (64, 64), (200, 30, 30)).save(image_path)
+
+    for use_limiter in (False, True):
+        server = FakeOpenAIServer(args.rpm, args.error_429_rate, args.error_5xx_rate,
+                                  latency=lambda: 0.05).start()
+        prompt = Prompt_3(model="fake", origin="bench")
+        prompt.rate_limiter = RateLimiter(max_backoff=10) if use_limiter else None
+
+        start = time.perf_counter()
+        succeeded = asyncio.run(run(prompt, server.base_url, image_path, args.images, args.concurrency, args.max_retries, template, logger))
+        elapsed = time.perf_counter() - start
+        server.stop()
+
+        print("Rate limiter {}".format("on" if use_limiter else "off"))
+        print("  succeeded:      {}/{}".format(succeeded, args.images))
+        print("  HTTP requests:  {} ({} x 429, {} over the limit, {} x 5xx)".format(
+            server.counts["requests"], server.counts["429"], server.counts["limited"], server.counts["5xx"]))
+        print("  throughput:     {:.1f} images/s".format(succeeded / elapsed))
+
+    # Budget of the run with the rate limiter
+    max_limited = args.concurrency if args.max_limited is None else args.max_limited
+    failed = args.images - succeeded
+    if failed:
+        print("{} images failed with the rate limiter".format(failed), file=sys.stderr)
+    if server.counts["limited"] > max_limited:
+        print("{} requests over the limit of {} requests per minute with the rate limiter (budget {})".format(
+            server.counts["limited"], args.rpm, max_limited), file=sys.stderr)
+    if failed or server.counts["limited"] > max_limited:
+        sys.exit(1)
@@ -0,0 +1,110 @@
+"""
+    Benchmark the local spool between the query stage and the upload stage against a local fake
+    OpenAI endpoint and a fake Label Studio server whose prediction writes are unavailable for the
+    first `--outage` seconds of the run:
+
+        direct:    `annotate`, the predictions are uploaded as they are parsed (previous behaviour)
+        together:  `annotate --spool`, the predictions are spooled and pushed by a background consumer
+        split:     `annotate --no-push` during the outage, then `push` once the server is back
+
+    Reports the tasks predicted in Label Studio, the wall time of each command and the spool left.
+
+    Usage:
+        python -m benchmarks.bench_spool --tasks 500 --outage 5
+"""
+import os
+import sys
+import glob
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import yaml
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fake_label_studio import FakeLabelStudioServer
+from benchmarks.bench_end_to_end import ROOT, make_images
+
+
+def write_config(work_dir: str, args, openai_server: FakeOpenAIServer, ls_server: FakeLabelStudioServer) -> str:
+    config = {
+        "openai_api_key": "fake",
+        "openai_base_url": openai_server.base_url,
+        "label_studio_url": ls_server.url,
+        "label_studio_api_key": "fake",
+        "project_id": ls_server.project_id,
+        "data_storage": "local",
+        "data_dir": os.path.join(work_dir, "images"),
+        "template": os.path.abspath(args.template),
+        "prompt": {"class": "prompts.Prompt_3", "params": {"model": "fake", "origin": "bench"}},
+        "MAX_RETRIES": 3,
+        "concurrency": args.concurrency,
+        "journal_path": os.path.join(work_dir, "journal.sqlite"),
+        "spool_dir": os.path.join(work_dir, "spool"),
+        "spool_segment_size": args.segment_size,
+        "spool_segment_seconds": 2,
+        "cache": "off",
+        "metrics": {"summary_path": os.path.join(work_dir, "summary.json")},
+        "logging": "INFO",
+    }
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+def run_command(command: list, log_path: str) -> tuple:
+    start = time.perf_counter()
+    with open(log_path, "a") as log:
+        returncode = subprocess.call([sys.executable, "-m", "lsllm"] + command, cwd=ROOT,
+                                     stdout=log, stderr=subprocess.STDOUT)
+    return returncode, time.perf_counter() - start
+
+
+def run_mode(mode: str, args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="bench_spool_{}_".format(mode))
+    make_images(os.path.join(work_dir, "images"), args.tasks, 256)
+    openai_server = FakeOpenAIServer(latency=lambda: random.lognormvariate(0, 0.3) * args.openai_latency).start()
+    ls_server = FakeLabelStudioServer(args.tasks, latency=lambda: 0.01).start()
+    config_path = write_config(work_dir, args, openai_server, ls_server)
+    log_path = os.path.join(work_dir, "run.log")
+
+    # The prediction writes are down for the first seconds of the query stage
+    ls_server.writes_down = True
+    outage = threading.Timer(args.outage, lambda: setattr(ls_server, "writes_down", False))
+    outage.start()
+    times = {}
+    if mode == "direct":
+        returncode, times["annotate"] = run_command(["annotate", "--config", config_path], log_path)
+    elif mode == "together":
+        returncode, times["annotate"] = run_command(["annotate", "--config", config_path, "--spool"], log_path)
+    else:
+        returncode, times["annotate"] = run_command(["annotate", "--config", config_path, "--no-push"], log_path)
+        outage.join()
+        if returncode == 0:
+            returncode, times["push"] = run_command(["push", "--config", config_path], log_path)
+    outage.cancel()
+    openai_server.stop()
+    ls_server.stop()
+    return {"predicted": ls_server.predicted_tasks(), "returncode": returncode, "times": times,
+            "left": len(glob.glob(os.path.join(work_dir, "spool", "*.jsonl"))), "log": log_path}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the spool between the query and the upload stages")
+    parser.add_argument("--tasks", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--openai_latency", type=float, default=0.2)
+    parser.add_argument("--outage", type=float, default=5.0, help="Seconds the prediction writes are unavailable")
+    parser.add_argument("--segment_size", type=int, default=100)
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    args = parser.parse_args()
+
+    print("{:<10} {:>10} {:>10} {:>11} {:>8} {:>15}".format(
+        "mode", "predicted", "exit code", "annotate s", "push s", "segments left"))
+    for mode in ("direct", "together", "split"):
+        result = run_mode(mode, args)
+        print("{:<10} {:>10} {:>10} {:>11.2f} {:>8} {:>15}".format(
+            mode, "{}/{}".format(result["predicted"], args.tasks), result["returncode"], result["times"]["annotate"],
+            "{:.2f}".format(result["times"]["push"]) if "push" in result["times"] else "-", result["left"]))
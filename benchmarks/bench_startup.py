@@ -0,0 +1,72 @@
+"""
+    Startup time of the command line: the median wall time of `--help` of each subcommand in a
+    fresh interpreter, and the heavy modules imported before a subcommand runs. Exits with an
+    error if a command exceeds the budget or imports a heavy module, so that it can guard
+    against startup regressions in CI.
+
+    Usage:
+        python -m benchmarks.bench_startup --budget 0.5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Must not be imported to parse the command line
+HEAVY_MODULES = ("openai", "label_studio_sdk", "label_studio", "pandas", "numpy", "PIL", "pyarrow", "ijson", "requests")
+# `stats` needs pandas and NumPy for anything it does, so it imports them before parsing and is not timed
+COMMANDS = (["--help"], ["annotate", "--help"], ["push", "--help"], ["serve", "--help"], ["flatten", "--help"], ["bench"])
+IMPORT_CHECK = """
+import sys, json
+from lsllm.cli import build_parser
+from lsllm.annotate import build_parser as build_annotate_parser
+from lsllm.push import build_parser as build_push_parser
+from lsllm.serve import build_parser as build_serve_parser
+build_parser().parse_known_args(["annotate"])
+build_annotate_parser().parse_args(["--config", "config.yaml"])
+build_push_parser().parse_args(["--config", "config.yaml"])
+build_serve_parser().parse_args(["--config", "config.yaml"])
+print(json.dumps(sorted(module for module in {} if module in sys.modules)))
+""".format(HEAVY_MODULES)
+
+
+def time_command(argv: list, repeat: int) -> float:
+    """Median wall time of a command in a fresh interpreter"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time of the lsllm command line")
+    parser.add_argument("--budget", type=float, default=0.5, help="Maximum median seconds of each command")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    report = {"interpreter_s": round(time_command([sys.executable, "-c", "pass"], args.repeat), 3),
+              "heavy_imports_s": round(time_command(
+                  [sys.executable, "-c", "import openai, label_studio_sdk, pandas"], args.repeat), 3),
+              "commands": {}}
+    for command in COMMANDS:
+        report["commands"]["lsllm " + " ".join(command)] = round(
+            time_command([sys.executable, "-m", "lsllm"] + command, args.repeat), 3)
+    output = subprocess.run([sys.executable, "-c", IMPORT_CHECK], cwd=ROOT, capture_output=True, text=True, check=True)
+    report["heavy_modules_imported"] = json.loads(output.stdout)
+    print(json.dumps(report, indent=2))
+
+    slow = [command for command, duration in report["commands"].items() if duration > args.budget]
+    if slow:
+        print("Over the {}s budget: {}".format(args.budget, slow), file=sys.stderr)
+    if report["heavy_modules_imported"]:
+        print("Heavy modules imported to parse the command line: {}".format(report["heavy_modules_imported"]),
+              file=sys.stderr)
+    if slow or report["heavy_modules_imported"]:
+        sys.exit(1)
@@ -0,0 +1,59 @@
+"""
+    Microbenchmark of filling the result template: deepcopy + positional mapping (previous
+    Prompt_3.parse) against the compiled template.
+
+    Usage:
+        python -m benchmarks.bench_template --template ./result_templates/project_4_result_template.json
+"""
+import copy
+import json
+import time
+import argparse
+from prompts import Prompt_3
+from benchmarks.fake_openai import fake_value
+from utils.template_utils import load_template
+
+
+def legacy_parse(output: str, result_template: dict, origin: str) -> dict:
+    json_response = json.loads(output)
+    template = copy.deepcopy(result_template)
+
+    for result in template["result"]:
+        attr = result["from_name"]
+        if attr.startswith("answer") and attr[-1].isdigit():
+            index = int(attr[-1])
+            keys = list(json_response.keys())
+            if index - 1 < len(keys):
+                val = json_response[keys[index - 1]]
+                result["value"]["text"] = [", ".join(val)] if isinstance(val, list) else [val]
+                result["origin"] = origin
+
+    return template
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the result template filling")
+    parser.add_argument("--template", type=str, default="./result_templates/project_4_result_template.json")
+    parser.add_argument("--n", type=int, default=100000)
+    args = parser.parse_args()
+
+    prompt = Prompt_3(model="bench", origin="bench")
+    outputs = [json.dumps(fake_value(prompt.schema)) for _ in range(1000)]
+    with open(args.template) as f:
+        raw_template = json.load(f)
+    compiled = load_template(args.template)
+
+    start = time.perf_counter()
+    for i in range(args.n):
+        legacy_parse(outputs[i % len(outputs)], raw_template, prompt.origin)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(args.n):
+        prompt.parse(outputs[i % len(outputs)], compiled)
+    fast = time.perf_counter() - start
+
+    assert legacy_parse(outputs[0], raw_template, prompt.origin) == prompt.parse(outputs[0], compiled)
+    print("deepcopy + positional mapping: {:.2f}s ({:.1f} us/parse)".format(legacy, 1e6 * legacy / args.n))
+    print("compiled template:             {:.2f}s ({:.1f} us/parse)".format(fast, 1e6 * fast / args.n))
+    print("speed-up:                      {:.1f}x".format(legacy / fast))
@@ -0,0 +1,95 @@
+"""
+    Compare the handling of malformed model outputs against a local fake endpoint that injects
+    code fences, wrong case or spelling of keys and labels, missing attributes and invented labels:
+
+        retry:     no local repair, any invalid output sends the whole image again (previous behaviour)
+        repair:    local repair against the schema, the rest is sent again in full
+        followup:  local repair, then a follow-up request for the attributes that are still invalid
+
+    Reports the requests, the prompt tokens spent on full retries and on follow-ups, the failed
+    images and the wall time.
+
+    Usage:
+        python -m benchmarks.bench_validation --images 300 --malformed_output_rate 0.3
+"""
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from PIL import Image
+from openai import AsyncOpenAI
+from prompts import Prompt_3
+from utils.metrics import RunMetrics
+from utils.pipeline import aquery_with_retries
+from utils.template_utils import load_template
+from benchmarks.fake_openai import FakeOpenAIServer
+
+
+class Prompt_3_NoRepair(Prompt_3):
+    """Prompt_3 without the local validation, as before the repair stage"""
+    def validate(self, output: str) -> tuple:
+        return output, []
+
+
+async def run(prompt, base_url: str, image_paths: list, concurrency: int, template, max_followups: int,
+              logger: logging.Logger) -> list:
+    client = AsyncOpenAI(api_key="fake", base_url=base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(image_path):
+        async with semaphore:
+            return await aquery_with_retries(prompt, client, image_path, template, 5, logger, max_followups)
+
+    try:
+        return await asyncio.gather(*[one(image_path) for image_path in image_paths])
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the local repair and follow-up requests of invalid outputs")
+    parser.add_argument("--images", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--malformed_output_rate", type=float, default=0.3)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--image_size", type=int, default=1024)
+    parser.add_argument("--template", default="./result_templates/project_4_result_template.json")
+    args = parser.parse_args()
+    template = load_template(args.template)
+
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    directory = tempfile.mkdtemp()
+    image_paths = []
+    for i in range(args.images):
+        image_paths.append(os.path.join(directory, "shoe_{}.jpg".format(i)))
+        Image.new("RGB", (args.image_size, args.image_size), (i % 256, (i // 256) % 256, 77)).save(image_paths[-1])
+
+    server = FakeOpenAIServer(latency=lambda: args.latency, malformed_output_rate=args.malformed_output_rate).start()
+    strategies = [("retry", Prompt_3_NoRepair, 0), ("repair", Prompt_3, 0), ("followup", Prompt_3, 1)]
+
+    print("{:<10} {:>9} {:>10} {:>14} {:>10} {:>15} {:>8} {:>8}".format(
+        "strategy", "requests", "retries", "retry tokens", "followups", "followup tokens", "failed", "time s"))
+    for name, prompt_class, max_followups in strategies:
+        prompt = prompt_class(origin="bench", model="fake")
+        prompt.metrics = RunMetrics()
+        requests = server.counts["requests"]
+        start = time.perf_counter()
+        results = asyncio.run(run(prompt, server.base_url, image_paths, args.concurrency, template,
+                                  max_followups, logger))
+        elapsed = time.perf_counter() - start
+        summary = prompt.metrics.summary()
+        by_purpose = summary["tokens_by_purpose"]
+        print("{:<10} {:>9} {:>10} {:>14} {:>10} {:>15} {:>8} {:>8.2f}".format(
+            name, server.counts["requests"] - requests, summary["counters"].get("retries", 0),
+            by_purpose.get("retry", {}).get("prompt", 0), summary["counters"].get("followups", 0),
+            by_purpose.get("followup", {}).get("prompt", 0),
+            sum(prediction is None for _, prediction, _ in results), elapsed))
+        repairs = {key: value for key, value in summary["counters"].items() if key.startswith("repaired_")}
+        if repairs:
+            print("           repairs: {}".format(repairs))
+    server.stop()
@@ -0,0 +1,205 @@
+"""
+    Local stand-in for the parts of the Label Studio API used by the tool: the projects, the
+    paginated task lists (with the Data Manager filters used by the incremental sync), the prediction
+    list, the bulk prediction import and prediction updates.
+    Every request is counted and timed per endpoint. Setting `writes_down` makes the prediction
+    writes fail with 503, as during an outage or a deployment of the server.
+"""
+import re
+import json
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeLabelStudioServer:
+    """
+        Args:
+            n_tasks (int): number of tasks of each project
+            project_id (int): id of the (first) project
+            n_projects (int): number of projects, with consecutive ids and task ids
+            existing_predictions (float): share of the tasks that already have a prediction
+            latency (callable): function returning the latency of a request in seconds
+    """
+    def __init__(self, n_tasks: int, project_id: int = 1, existing_predictions: float = 0.0,
+                 latency=lambda: 0.0, host: str = "127.0.0.1", port: int = 0, n_projects: int = 1):
+        self.project_id = project_id
+        self.project_ids = list(range(project_id, project_id + n_projects))
+        self.latency = latency
+        self.lock = threading.Lock()
+        # Project id -> tasks, task ids are unique over the projects
+        self.tasks = {pid: [] for pid in self.project_ids}
+        self.task_projects = {}
+        for index, pid in enumerate(self.project_ids):
+            self.add_tasks(pid, range(index * n_tasks + 1, (index + 1) * n_tasks + 1))
+        self.predictions = {}
+        self.writes_down = False
+        for task_id in self.task_projects:
+            if random.random() < existing_predictions:
+                self._add_prediction(task_id, [])
+        # "METHOD endpoint" -> number of requests, durations in seconds
+        self.counts = defaultdict(int)
+        self.durations = defaultdict(list)
+        # Number of tasks sent in the task lists
+        self.served_tasks = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                start = time.perf_counter()
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                url = urlparse(self.path)
+                endpoint, status, payload = server.handle(self.command, url.path,
+                                                          {key: values[0] for key, values in parse_qs(url.query).items()},
+                                                          body)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                with server.lock:
+                    server.counts[endpoint] += 1
+                    server.durations[endpoint].append(time.perf_counter() - start)
+
+            do_GET = do_POST = do_PATCH = _handle
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self.httpd.server_address[:2])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def now() -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def add_tasks(self, pid: int, task_ids):
+        """Create tasks in a project, their images are shoe_<task id>.jpg"""
+        with self.lock:
+            for task_id in task_ids:
+                self.tasks[pid].append({"id": task_id, "data": {"image": "/data/upload/{}/{:08x}-shoe_{}.jpg".format(
+                    pid, task_id, task_id)}, "updated_at": self.now(), "total_annotations": 0})
+                self.task_projects[task_id] = pid
+
+    def annotate_tasks(self, task_ids):
+        """Mark tasks as annotated"""
+        self._update_tasks(task_ids, total_annotations=1)
+
+    def touch_tasks(self, task_ids):
+        """Update the data of tasks, e.g. a replaced image"""
+        self._update_tasks(task_ids)
+
+    def _update_tasks(self, task_ids, **fields):
+        task_ids = set(task_ids)
+        with self.lock:
+            for tasks in self.tasks.values():
+                for task in tasks:
+                    if task["id"] in task_ids:
+                        task.update(fields, updated_at=self.now())
+
+    def _add_prediction(self, task_id: int, result: list, model_version: str = None):
+        prediction_id = len(self.predictions) + 1
+        self.predictions[prediction_id] = {"id": prediction_id, "task": task_id, "result": result,
+                                           "model_version": model_version or "", "project": self.task_projects[task_id]}
+
+    def _matches(self, task: dict, item: dict, versions: set) -> bool:
+        """Whether a task matches a Data Manager filter item"""
+        name, operator, value = item["filter"], item["operator"], item["value"]
+        if name == "filter:tasks:id":
+            return task["id"] > value if operator == "greater" else task["id"] == value
+        if name == "filter:tasks:total_annotations":
+            return task["total_annotations"] == value
+        if name == "filter:tasks:predictions_model_versions":
+            return (value in versions) == (operator == "contains")
+        if name == "filter:tasks:updated_at":
+            return task["updated_at"] > value.replace(".000Z", ".000000Z")
+        raise ValueError("Unsupported filter {}".format(name))
+
+    def _task_payload(self, task: dict, include: list, predictions: list) -> dict:
+        payload = {key: value for key, value in task.items() if key in include}
+        if "predictions" in include:
+            payload["predictions"] = [{"id": p["id"], "model_version": p["model_version"], "result": p["result"]}
+                                      for p in predictions]
+        return payload
+
+    def handle(self, method: str, path: str, params: dict, body):
+        """Answer a request
+
+        Returns:
+            tuple: (endpoint name, status code, JSON payload)
+        """
+        time.sleep(self.latency())
+        path = path.rstrip("/")
+        if method == "GET" and path == "/api/version":
+            return "GET /api/version", 200, {"label-studio-os-backend": "fake"}
+        if method == "GET" and re.fullmatch(r"/api/projects/\d+", path):
+            pid = int(path.rsplit("/", 1)[1])
+            if pid not in self.tasks:
+                return "GET /api/projects/<id>", 404, {"detail": "Not found."}
+            return "GET /api/projects/<id>", 200, {"id": pid, "title": "fake"}
+        if method == "GET" and path == "/api/tasks":
+            page, page_size = int(params.get("page", 1)), int(params.get("page_size", 100))
+            include = params.get("include", "id,data").split(",")
+            with self.lock:
+                project_tasks = list(self.tasks.get(int(params.get("project", self.project_id)), []))
+                by_task = defaultdict(list)
+                for prediction in self.predictions.values():
+                    by_task[prediction["task"]].append(prediction)
+            if "query" in params:
+                items = json.loads(params["query"])["filters"]["items"]
+                project_tasks = [task for task in project_tasks if all(
+                    self._matches(task, item, {p["model_version"] for p in by_task[task["id"]]}) for item in items)]
+            tasks = project_tasks[(page - 1) * page_size:page * page_size]
+            if page > 1 and not tasks:
+                return "GET /api/tasks", 404, {"detail": "Invalid page."}
+            with self.lock:
+                self.served_tasks += len(tasks)
+            return "GET /api/tasks", 200, {"tasks": [self._task_payload(task, include, by_task[task["id"]]) for task in tasks],
+                                           "total": len(project_tasks)}
+        if method == "GET" and path == "/api/predictions":
+            pid = int(params.get("project", self.project_id))
+            with self.lock:
+                return "GET /api/predictions", 200, [prediction for prediction in self.predictions.values()
+                                                     if prediction["project"] == pid]
+        if self.writes_down and method in ("POST", "PATCH"):
+            return "{} (unavailable)".format(method), 503, {"detail": "Service unavailable."}
+        if method == "POST" and re.fullmatch(r"/api/projects/\d+/import/predictions", path):
+            with self.lock:
+                for prediction in body:
+                    self._add_prediction(prediction["task"], prediction["result"], prediction.get("model_version"))
+            return "POST /api/projects/<id>/import/predictions", 201, {"created": len(body)}
+        if method == "PATCH" and re.fullmatch(r"/api/predictions/\d+", path):
+            prediction_id = int(path.rsplit("/", 1)[1])
+            with self.lock:
+                if prediction_id not in self.predictions:
+                    return "PATCH /api/predictions/<id>", 404, {"detail": "Not found."}
+                self.predictions[prediction_id].update(body)
+                return "PATCH /api/predictions/<id>", 200, self.predictions[prediction_id]
+        return "{} {}".format(method, path), 404, {"detail": "Not found."}
+
+    def predicted_tasks(self) -> int:
+        """Number of tasks with a non-empty prediction"""
+        with self.lock:
+            return len({prediction["task"] for prediction in self.predictions.values() if prediction["result"]})
@@ -0,0 +1,343 @@
+"""
+    Local stand-in for the OpenAI chat completions endpoint.
+    Answers with canned JSON that is valid for the json_schema of the request, enforces a
+    requests-per-minute limit with x-ratelimit-* headers and injects 400, 429 and 5xx errors, and
+    malformed outputs (code fences, wrong case or spelling, missing or invented labels).
+    Simulated models answer with a given accuracy against a ground truth derived from each
+    image, with token logprobs that are lower for their mistakes.
+    The duration of every request is recorded in `durations`.
+    The files and batches endpoints of the Batch API are served as well: a batch runs its
+    requests through the chat completions endpoint in a background thread.
+"""
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from utils.rate_limiter import estimate_request_tokens, DEFAULT_COMPLETION_TOKENS
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def fake_value(schema: dict):
+    """Build a value that is valid for a (small subset of) JSON schema"""
+    if "enum" in schema:
+        return random.choice(schema["enum"])
+    if schema.get("type") == "object":
+        return {key: fake_value(value) for key, value in schema.get("properties", {}).items()}
+    if schema.get("type") == "array":
+        return [fake_value(schema.get("items", {}))]
+    if schema.get("type") in ("number", "integer"):
+        return 0
+    if schema.get("type") == "boolean":
+        return True
+    return "fake"
+
+
+def fake_output(schema: dict, n_images: int) -> dict:
+    """Build an output for the json_schema of a request, packed schemas get one annotation per image"""
+    output = fake_value(schema)
+    if "images" in schema.get("properties", {}):
+        item_schema = schema["properties"]["images"]["items"]
+        output["images"] = [dict(fake_value(item_schema), index=index) for index in range(1, n_images + 1)]
+    return output
+
+
+# Mistakes injected in outputs with `malformed_output_rate`, all but "missing" and "invented" are repaired locally
+MALFORMATIONS = ("code_fence", "label_case", "near_miss", "key_case", "missing", "invented")
+
+
+def malform(output: dict, schema: dict) -> str:
+    """Serialize an output with one of the mistakes of MALFORMATIONS"""
+    kind = random.choice(MALFORMATIONS)
+    keys = [key for key in output if key in schema.get("properties", {})]
+    if not keys:
+        return json.dumps(output)
+    key = random.choice(keys)
+    value = output[key]
+    label = value[0] if isinstance(value, list) and value else value
+    if kind == "code_fence":
+        return "```json\n{}\n```".format(json.dumps(output, indent=2))
+    if kind == "key_case":
+        output[key.lower().replace(" ", "_")] = output.pop(key)
+    elif kind == "missing":
+        output.pop(key)
+    elif isinstance(label, str):
+        if kind == "label_case":
+            label = label.upper()
+        elif kind == "near_miss":
+            label = label[:-1] if len(label) > 5 else label + "s"
+        else:
+            label = "Unknown"
+        output[key] = [label] if isinstance(value, list) else label
+    return json.dumps(output)
+
+
+def fake_truth(schema: dict, image_url: str) -> dict:
+    """Ground truth of an image for the json_schema of a request: one label per attribute, drawn
+    from a generator seeded with the image URL (its base64 data), so that it is the same for every model"""
+    rng = random.Random(hashlib.sha256(image_url.encode("utf-8")).hexdigest())
+    truth = {}
+    for key, prop in schema.get("properties", {}).items():
+        labels = prop.get("items", prop).get("enum", ["fake"])
+        label = rng.choice(labels)
+        truth[key] = [label] if prop.get("type") == "array" else label
+    return truth
+
+
+def simulated_answer(schema: dict, image_url: str, accuracy: float) -> tuple:
+    """Answer of a simulated model and the logprobs of its tokens. Each attribute is right with
+    probability `accuracy`; right answers are given with a high confidence, mistakes with a lower
+    and more spread one, as calibrated models do.
+
+    Returns:
+        tuple: (output text, list of {"token", "logprob"} whose tokens concatenate into the text)
+    """
+    truth = fake_truth(schema, image_url)
+    tokens = []
+    prefix = "{"
+    for position, (key, value) in enumerate(truth.items()):
+        if random.random() >= accuracy:
+            prop = schema["properties"][key]
+            labels = prop.get("items", prop).get("enum", ["fake"])
+            wrong = random.choice([label for label in labels if [label] != value and label != value] or labels)
+            value = [wrong] if isinstance(value, list) else wrong
+            confidence = random.uniform(0.3, 0.97)
+        else:
+            confidence = random.uniform(0.96, 1.0)
+        prefix += ("," if position else "") + json.dumps(key) + ":"
+        tokens.append({"token": prefix, "logprob": 0.0})
+        tokens.append({"token": json.dumps(value), "logprob": math.log(confidence)})
+        prefix = ""
+    tokens.append({"token": "}", "logprob": 0.0})
+    return "".join(token["token"] for token in tokens), tokens
+
+
+class FakeOpenAIServer:
+    """
+        Args:
+            requests_per_minute (int): limit enforced with 429 responses, None for no limit
+            error_429_rate (float): share of requests answered with an injected 429
+            error_5xx_rate (float): share of requests answered with an injected 500/503
+            error_400_rate (float): share of requests answered with an injected 400, which is not retryable
+            latency (callable): function returning the latency of a request in seconds
+            default_output (str): output used when the request has no json_schema
+            invalid_output_rate (float): share of successful requests answered with an output missing an image
+            models (dict): simulated models, name -> {"accuracy": share of right attributes,
+                "latency": callable returning the latency of a request}, see simulated_answer()
+            malformed_output_rate (float): share of single-image outputs with one of MALFORMATIONS
+    """
+    def __init__(self, requests_per_minute: int = None, error_429_rate: float = 0.0, error_5xx_rate: float = 0.0,
+                 latency=lambda: 0.0, default_output: str = None, invalid_output_rate: float = 0.0, host: str = "127.0.0.1", port: int = 0,
+                 models: dict = None, malformed_output_rate: float = 0.0, error_400_rate: float = 0.0):
+        self.models = models or {}
+        self.malformed_output_rate = malformed_output_rate
+        self.requests_per_minute = requests_per_minute
+        self.error_429_rate = error_429_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.error_400_rate = error_400_rate
+        self.latency = latency
+        self.default_output = default_output
+        self.invalid_output_rate = invalid_output_rate
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "429": 0, "limited": 0, "5xx": 0, "400": 0, "prompt_tokens": 0}
+        self.window = []
+        self.durations = []
+        # File id -> content, batch id -> batch object
+        self.files = {}
+        self.batches = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, headers: dict, payload):
+                # Contents of the files are sent as they are
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Type", "application/octet-stream" if isinstance(payload, bytes) else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._send(*server.handle_get(self.path.split("?")[0]))
+
+            def do_POST(self):
+                start = time.perf_counter()
+                data = self.rfile.read(int(self.headers["Content-Length"]))
+                path = self.path.split("?")[0]
+                if path.endswith("/files"):
+                    self._send(*server.create_file(self.headers["Content-Type"], data))
+                    return
+                if path.endswith("/batches"):
+                    self._send(*server.create_batch(json.loads(data)))
+                    return
+                status, headers, payload = server.handle(self.path, json.loads(data))
+                self._send(status, headers, payload)
+                with server.lock:
+                    server.durations.append(time.perf_counter() - start)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return "http://{}:{}/v1".format(*self.httpd.server_address[:2])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _store_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        with self.lock:
+            file_id = "file-{}".format(len(self.files) + 1)
+            self.files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def create_file(self, content_type: str, data: bytes) -> tuple:
+        """POST /files, multipart form with the `file` and its `purpose`"""
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + data)
+        fields, filename = {}, "upload"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = part.get_payload(decode=True)
+            if name == "file":
+                filename = part.get_filename() or filename
+        if "file" not in fields:
+            return 400, {}, {"error": {"message": "Missing file", "type": "invalid_request_error"}}
+        return 200, {}, self._store_file(fields["file"], filename, fields.get("purpose", b"batch").decode("utf-8"))
+
+    def create_batch(self, body: dict) -> tuple:
+        """POST /batches, the batch is run in a background thread"""
+        if body.get("input_file_id") not in self.files:
+            return 404, {}, {"error": {"message": "No such file", "type": "invalid_request_error"}}
+        with self.lock:
+            batch = {"id": "batch_{}".format(len(self.batches) + 1), "object": "batch", "endpoint": body["endpoint"],
+                     "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+                     "status": "in_progress", "created_at": int(time.time()), "output_file_id": None,
+                     "error_file_id": None, "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self._run_batch, args=(batch,), daemon=True).start()
+        return 200, {}, dict(batch)
+
+    def _run_batch(self, batch: dict):
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]].decode("utf-8").splitlines():
+            request = json.loads(line)
+            if request.get("url") != batch["endpoint"]:
+                errors.append({"id": "batch_req_{}".format(len(outputs) + len(errors)), "custom_id": request["custom_id"],
+                               "response": None, "error": {"code": "invalid_url", "message": "Unsupported url"}})
+                continue
+            status, _, payload = self.handle(request["url"], request["body"])
+            outputs.append({"id": "batch_req_{}".format(len(outputs) + len(errors)), "custom_id": request["custom_id"],
+                            "response": {"status_code": status, "request_id": "req", "body": payload}, "error": None})
+        failed = len(errors) + sum(output["response"]["status_code"] != 200 for output in outputs)
+        output_file = self._store_file("".join(json.dumps(output) + "\n" for output in outputs).encode("utf-8"),
+                                       "output.jsonl", "batch_output") if outputs else None
+        error_file = self._store_file("".join(json.dumps(error) + "\n" for error in errors).encode("utf-8"),
+                                      "errors.jsonl", "batch_output") if errors else None
+        with self.lock:
+            batch.update(status="completed", output_file_id=output_file and output_file["id"],
+                         error_file_id=error_file and error_file["id"],
+                         request_counts={"total": len(outputs) + len(errors), "completed": len(outputs) + len(errors) - failed,
+                                         "failed": failed})
+
+    def handle_get(self, path: str) -> tuple:
+        """GET /files/{id}/content and /batches/{id}"""
+        parts = path.strip("/").split("/")
+        with self.lock:
+            if len(parts) == 4 and parts[1] == "files" and parts[3] == "content" and parts[2] in self.files:
+                return 200, {}, self.files[parts[2]]
+            if len(parts) == 3 and parts[1] == "batches" and parts[2] in self.batches:
+                return 200, {}, dict(self.batches[parts[2]])
+        return 404, {}, {"error": {"message": "Not found", "type": "invalid_request_error"}}
+
+    def _rate_limit_headers(self, now: float) -> dict:
+        if self.requests_per_minute is None:
+            return {}
+        self.window = [t for t in self.window if now - t < 60]
+        remaining = max(0, self.requests_per_minute - len(self.window))
+        reset = 60 - (now - self.window[0]) if self.window else 0
+        return {
+            "x-ratelimit-limit-requests": str(self.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": "{:.3f}s".format(reset),
+        }
+
+    def handle(self, path: str, body: dict):
+        model = self.models.get(body.get("model"))
+        time.sleep(model["latency"]() if model is not None else self.latency())
+        with self.lock:
+            self.counts["requests"] += 1
+            now = time.monotonic()
+            headers = self._rate_limit_headers(now)
+            if self.requests_per_minute is not None and headers["x-ratelimit-remaining-requests"] == "0":
+                self.counts["429"] += 1
+                # Over the enforced limit, unlike the injected 429s
+                self.counts["limited"] += 1
+                headers["retry-after"] = headers["x-ratelimit-reset-requests"][:-1]
+                return 429, headers, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            draw = random.random()
+            if draw < self.error_429_rate:
+                self.counts["429"] += 1
+                return 429, dict(headers, **{"retry-after-ms": "200"}), {"error": {"message": "Injected rate limit", "type": "requests", "code": "rate_limit_exceeded"}}
+            if draw < self.error_429_rate + self.error_5xx_rate:
+                self.counts["5xx"] += 1
+                return random.choice((500, 503)), headers, {"error": {"message": "Injected server error", "type": "server_error"}}
+            if draw < self.error_429_rate + self.error_5xx_rate + self.error_400_rate:
+                self.counts["400"] += 1
+                return 400, headers, {"error": {"message": "Injected invalid request", "type": "invalid_request_error"}}
+            self.window.append(now)
+            headers = self._rate_limit_headers(now)
+            self.counts["ok"] += 1
+
+        schema = body.get("response_format", {}).get("json_schema", {}).get("schema")
+        n_images = sum(part.get("type") == "image_url" for message in body.get("messages", [])
+                       if isinstance(message["content"], list) for part in message["content"])
+        logprobs = None
+        if schema and model is not None and n_images == 1:
+            image_url = next(part["image_url"]["url"] for message in body["messages"] if isinstance(message["content"], list)
+                             for part in message["content"] if part.get("type") == "image_url")
+            output, tokens = simulated_answer(schema, image_url, model["accuracy"])
+            if body.get("logprobs"):
+                logprobs = {"content": [dict(token, bytes=None, top_logprobs=[]) for token in tokens]}
+        elif schema:
+            output = fake_output(schema, n_images)
+            if "images" in output and random.random() < self.invalid_output_rate:
+                output["images"] = output["images"][:-1]
+            if "images" not in output and random.random() < self.malformed_output_rate:
+                output = malform(output, schema)
+            else:
+                output = json.dumps(output)
+        else:
+            output = self.default_output or ""
+        # Images are counted as image tokens, not as the length of their base64 data
+        prompt_tokens = estimate_request_tokens(body) - DEFAULT_COMPLETION_TOKENS
+        with self.lock:
+            self.counts["prompt_tokens"] += prompt_tokens
+        return 200, headers, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "finish_reason": "stop", "logprobs": logprobs,
+                         "message": {"role": "assistant", "content": output}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(output) // 4,
+                      "total_tokens": prompt_tokens + len(output) // 4}
+        }
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import yaml
+import signal
+import argparse
+import subprocess
+from tqdm import tqdm
+from utils.journal import journal_state_counts
+from utils.sharding import check_shard, shard_path, merge_summaries
+from utils.projects import expand_project_configs
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def shard_command(args, shard_index: int, extra_args: list) -> list:
+    """Command line of main.py for one shard"""
+    command = [sys.executable, os.path.join(ROOT, "main.py"), "--config"] + args.config
+    if args.project_ids:
+        command += ["--project_ids"] + [str(project_id) for project_id in args.project_ids]
+    return command + ["--shard-index", str(shard_index), "--shard-count", str(args.shards)] + extra_args
+
+
+def progress_counts(journal_paths: list) -> dict:
+    """Number of tasks in each state, summed over the journals of the shards"""
+    counts = {}
+    for path in journal_paths:
+        for state, count in journal_state_counts(path).items():
+            counts[state] = counts.get(state, 0) + count
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run main.py as N local processes, each on its own shard of the tasks. "
+                                                 "Other arguments (--mode, --resume, --limit, ...) are passed to every shard.")
+    parser.add_argument("--config", type=str, nargs="+", help="System config(s), see main.py", default=["./configs/chat_gpt_40.yaml"])
+    parser.add_argument("--project_ids", type=int, nargs="+", help="Annotate these projects, see main.py", default=None)
+    parser.add_argument("--shards", type=int, help="Number of processes", default=os.cpu_count())
+    parser.add_argument("--log_dir", type=str, help="Output of each shard", default="./runs/logs")
+    parser.add_argument("--poll_interval", type=float, help="Seconds between two progress updates", default=2.0)
+    args, extra_args = parser.parse_known_args()
+    check_shard(0, args.shards)
+
+    configs = []
+    for config_path in args.config:
+        with open(config_path, "r") as stream:
+            configs.append(yaml.safe_load(stream))
+    # Journal and summary of each project, every shard of a project writes its own
+    journal_paths, summary_paths = [], {}
+    for config in expand_project_configs(configs, args.project_ids):
+        project_id = config["project_id"]
+        journal_path = config.get("journal_path", "./journals/project_{}.sqlite".format(project_id))
+        metrics_config = config.get("metrics") or {}
+        summary_path = metrics_config.get("summary_path", "./runs/project_{}_summary.json".format(project_id))
+        journal_paths += [shard_path(journal_path, i, args.shards) for i in range(args.shards)]
+        summary_paths[summary_path] = [shard_path(summary_path, i, args.shards) for i in range(args.shards)]
+
+    # Start the shards, a previous summary must not be mistaken for the one of this run
+    os.makedirs(args.log_dir, exist_ok=True)
+    for paths in summary_paths.values():
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    processes, logs = [], []
+    for i in range(args.shards):
+        log = open(os.path.join(args.log_dir, "shard-{}-of-{}.log".format(i, args.shards)), "w")
+        logs.append(log)
+        # In their own session, the shards do not get the Ctrl-C of the terminal, the launcher forwards it once
+        processes.append(subprocess.Popen(shard_command(args, i, extra_args), cwd=os.getcwd(),
+                                          stdout=log, stderr=subprocess.STDOUT, start_new_session=True))
+    print("Started {} shards, logs in {}".format(args.shards, args.log_dir))
+
+    # Aggregated progress from the journals of the shards
+    progress = tqdm(unit="task", desc="Tasks")
+    try:
+        while any(process.poll() is None for process in processes):
+            counts = progress_counts(journal_paths)
+            progress.n = counts.get("uploaded", 0) + counts.get("spooled", 0) + counts.get("failed", 0)
+            progress.set_postfix(counts, refresh=False)
+            progress.set_description("Tasks ({}/{} shards running)".format(
+                sum(process.poll() is None for process in processes), args.shards))
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        # The shards flush their journal and pending uploads on interruption, a second signal would cut it short
+        print("Interrupted, waiting for the shards to flush their uploads and journals ...")
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+    finally:
+        counts = progress_counts(journal_paths)
+        progress.n = counts.get("uploaded", 0) + counts.get("spooled", 0) + counts.get("failed", 0)
+        progress.set_postfix(counts, refresh=False)
+        progress.close()
+        for log in logs:
+            log.close()
+
+    # Merge the summaries of the shards of each project
+    for summary_path, paths in summary_paths.items():
+        summaries = []
+        for i, path in enumerate(paths):
+            if os.path.exists(path):
+                with open(path) as f:
+                    summaries.append(json.load(f))
+            else:
+                print("Shard {} did not write its summary ({})".format(i, path))
+        if not summaries:
+            continue
+        summary = merge_summaries(summaries)
+        if os.path.dirname(summary_path):
+            os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        print("Merged summary of {} shards written to {}".format(len(summaries), summary_path))
+        print("Tokens: {} prompt ({} cached), {} completion, estimated cost ${:.4f}".format(
+            summary["tokens"]["prompt"], summary["tokens"]["cached"], summary["tokens"]["completion"], summary["cost_usd"]))
+
+    failed = [i for i, process in enumerate(processes) if process.returncode != 0]
+    if failed:
+        print("Shards {} failed, see their logs in {}. Rerun with --resume to finish them.".format(failed, args.log_dir))
+        sys.exit(1)
@@ -0,0 +1,2 @@
+"""LabelStudio-LLMs query tool: pre-annotate Label Studio projects with LLMs"""
+__version__ = "0.1.0"
@@ -0,0 +1,285 @@
+"""
+    The annotate command: query the LLM for the tasks of one or more Label Studio projects
+    and push the predictions back. The heavy dependencies (OpenAI, Label Studio SDK, Pillow)
+    are only imported once the arguments are parsed, so that --help stays fast.
+"""
+import os
+import json
+import itertools
+import argparse
+import logging
+
+
+def start_profiler(kind: str):
+    """Start profiling the run with cProfile or pyinstrument"""
+    if kind == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler, kind: str, path: str):
+    """Stop the profiler and write its output, a .prof file for cProfile or an HTML report for pyinstrument"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if kind == "pyinstrument":
+        profiler.stop()
+        with open(path, "w") as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def write_project_summary(run, logger: logging.Logger) -> dict:
+    """Write and log the summary of the run of a project (ProjectRun)"""
+    from utils.sharding import config_shard_path
+    metrics = run.prompt.metrics
+    config = run.config
+    for name, value in run.uploader.stats.items():
+        metrics.count("predictions_{}".format(name), value)
+    summary_path = config_shard_path(config, (config.get("metrics") or {}).get(
+        "summary_path", "./runs/project_{}_summary.json".format(config["project_id"])))
+    summary = metrics.write_summary(summary_path)
+    logger.info("Run summary of project {} written to {}".format(config["project_id"], summary_path))
+    for stage, stats in summary["stages"].items():
+        logger.info("{:<16} n={:<7} total={:.1f}s p50={:.3f}s p95={:.3f}s p99={:.3f}s".format(
+            stage, stats["count"], stats["total"], stats["p50"], stats["p95"], stats["p99"]))
+    logger.info("Tokens: {} prompt ({} cached), {} completion, estimated cost ${:.4f}".format(
+        summary["tokens"]["prompt"], summary["tokens"]["cached"], summary["tokens"]["completion"], summary["cost_usd"]))
+    counters, by_purpose = summary["counters"], summary["tokens_by_purpose"]
+    if counters.get("retries") or counters.get("followups"):
+        logger.info("Retries: {} full ({} prompt tokens), {} follow-ups for {} attributes ({} prompt tokens)".format(
+            counters.get("retries", 0), by_purpose.get("retry", {}).get("prompt", 0), counters.get("followups", 0),
+            counters.get("followup_attributes", 0), by_purpose.get("followup", {}).get("prompt", 0)))
+    if summary["errors"]:
+        logger.info("Errors: {}".format(summary["errors"]))
+    return summary
+
+
+def build_parser(prog: str = "Label Studio LLM pre-annotation tool") -> argparse.ArgumentParser:
+    """Arguments of the annotate command"""
+    parser = argparse.ArgumentParser(prog=prog, description="Get prediction from LLM and push it to Label Studio server")
+    
+    parser.add_argument("--config", type=str, nargs="+", help="System config(s), one or more projects each", default=["./configs/chat_gpt_40.yaml"])
+    parser.add_argument("--project_ids", type=int, nargs="+", help="Annotate these projects with the configuration(s)", default=None)
+    parser.add_argument("--mode", type=str, choices=["online", "batch"], help="Query OpenAI online or through the Batch API", default="online")
+    parser.add_argument("--resume", action="store_true", help="Resume the previous run from its journal")
+    parser.add_argument("--incremental", action="store_true", help="Only fetch the tasks without annotation that lack a current prediction")
+    parser.add_argument("--no-push", action="store_true", help="Write the predictions to the local spool only, `lsllm push` uploads them")
+    parser.add_argument("--spool", action="store_true", help="Write the predictions to the local spool and push it to Label Studio at the same time")
+    parser.add_argument("--limit", type=int, help="Only process the first N tasks of each project", default=None)
+    parser.add_argument("--shard-index", type=int, help="Only process the tasks of this shard (0-based)", default=None)
+    parser.add_argument("--shard-count", type=int, help="Number of shards the tasks are split into", default=None)
+    parser.add_argument("--profile", nargs="?", const="cprofile", choices=["cprofile", "pyinstrument"], help="Profile the run", default=None)
+    parser.add_argument("--profile_output", type=str, help="Output of the profiler", default=None)
+    return parser
+
+
+def main(argv: list = None, prog: str = "Label Studio LLM pre-annotation tool"):
+    """Entry point of the annotate command
+
+    Args:
+        argv (list): arguments, sys.argv[1:] by default
+        prog (str): name of the program shown in the help
+    """
+    args = build_parser(prog).parse_args(argv)
+    run(args)
+
+
+def run(args: argparse.Namespace):
+    """Annotate the projects of the configuration(s) with the parsed arguments"""
+    import yaml
+    from openai import OpenAI, AsyncOpenAI
+    from utils.utils import create_prompt_from_config
+    from utils.label_studio_server import setup
+    from utils.pipeline import ProjectRun, run_projects_serial, run_projects_concurrent
+    from utils.uploader import PredictionUploader
+    from utils.spool import SpoolConsumer, spool_directory, create_spool_writer_from_config
+    from utils.journal import create_journal_from_config, resume_tasks
+    from utils.sync import create_sync_from_config
+    from utils.batch import run_batch
+    from utils.cache import create_cache_from_config
+    from utils.image_utils import create_preprocessor_from_config
+    from utils.dedup import create_hasher_from_config, create_deduplicator_from_config
+    from utils.knn import create_embedder_from_config, create_knn_labeler_from_config
+    from utils.rate_limiter import create_rate_limiter_from_config
+    from utils.metrics import create_metrics_from_config, start_prometheus_writer
+    from utils.sharding import check_shard, config_shard_path, merge_summaries
+    from utils.projects import expand_project_configs, SharedLabelStudioClients
+    
+    # Read the configurations, one per project
+    configs = []
+    for config_path in args.config:
+        with open(config_path, "r") as stream:
+            configs.append(yaml.safe_load(stream))
+    projects = expand_project_configs(configs, args.project_ids)
+    
+    # Shard of the tasks processed by this process, the command line overrides the configuration
+    for project_config in projects:
+        if args.shard_count is not None:
+            project_config["shard_index"] = args.shard_index or 0
+            project_config["shard_count"] = args.shard_count
+        check_shard(project_config.get("shard_index", 0), project_config.get("shard_count", 1))
+    
+    # The clients, rate limits, cache, image preprocessing and concurrency are
+    # shared by all the projects and come from the first configuration
+    config = projects[0]
+    
+    
+    # Logging to terrminal
+    logger = logging.getLogger("Label Studio LLM tool")
+    
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(getattr(logging, config["logging"]))
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+    logger.propagate = False
+    logger.setLevel(getattr(logging, config["logging"]))
+    
+
+    # Config OpenAI Client
+    # Retries are handled by the tool with the shared rate limiter
+    openai_client = OpenAI(api_key=config["openai_api_key"], base_url=config.get("openai_base_url"), max_retries=0)
+    
+    cache = create_cache_from_config(config)
+    image_preprocessor = create_preprocessor_from_config(config)
+    # The Batch API jobs are resumed from their files, without the groups of near-duplicates
+    hasher = create_hasher_from_config(config) if args.mode == "online" else None
+    # Only the online runs label images locally, the Batch API jobs are resumed from their files
+    embedder = create_embedder_from_config(config) if args.mode == "online" else None
+    rate_limiter = create_rate_limiter_from_config(config)
+    ls_clients = SharedLabelStudioClients(config.get("label_studio_pool_size", 32))
+    # With several projects the preprocessing pool is timed separately and merged into the combined summary
+    shared_metrics = create_metrics_from_config(config) if len(projects) > 1 else None
+    
+    if args.no_push and args.spool:
+        raise ValueError("--no-push and --spool cannot be used together!")
+    spooled = args.no_push or args.spool
+    
+    runs, prometheus_writers, consumers, syncs = [], [], [], []
+    for project_config in projects:
+        prompt = create_prompt_from_config(project_config["prompt"])
+        prompt.cache = cache
+        prompt.image_preprocessor = image_preprocessor
+        prompt.rate_limiter = rate_limiter
+        prompt.followup_detail = project_config.get("followup_detail", "low")
+        metrics = create_metrics_from_config(project_config)
+        prompt.metrics = metrics
+        if image_preprocessor is not None:
+            image_preprocessor.metrics = shared_metrics or metrics
+        metrics_config = project_config.get("metrics") or {}
+        if metrics_config.get("prometheus_path"):
+            prometheus_path = config_shard_path(project_config, metrics_config["prometheus_path"])
+            prometheus_writers.append((metrics, prometheus_path, start_prometheus_writer(
+                metrics, prometheus_path, metrics_config.get("prometheus_interval", 15))))
+        
+        # Setup Label studio Client
+        # In incremental mode, only the tasks that need a prediction are fetched, with their current predictions
+        sync = create_sync_from_config(project_config, prompt, args.incremental)
+        model_version = sync.model_version if sync is not None else project_config.get("model_version")
+        ls_project, tasks, template = setup(project_config, logger, metrics, ls_clients.get(project_config), sync)
+        tasks = itertools.islice(tasks, args.limit)
+        journal = create_journal_from_config(project_config, args.resume)
+        if not spooled or args.spool:
+            uploader = PredictionUploader(ls_project, logger,
+                                          batch_size=project_config.get("upload_batch_size", 100),
+                                          workers=project_config.get("upload_workers", 4),
+                                          journal=journal,
+                                          metrics=metrics,
+                                          model_version=model_version,
+                                          index=sync.predictions if sync is not None else None)
+        if args.spool:
+            # The predictions are pushed from the spool in the background, a slow or unavailable
+            # Label Studio server only delays them
+            consumers.append(SpoolConsumer(spool_directory(project_config), uploader, logger).start())
+        if spooled:
+            uploader = create_spool_writer_from_config(project_config, logger, journal, metrics, model_version,
+                                                       consumer=args.spool)
+        if args.resume:
+            tasks = resume_tasks(tasks, journal, prompt, template, uploader, logger)
+        # The images whose annotated neighbours agree are labeled without the model
+        knn = create_knn_labeler_from_config(project_config, embedder, template, prompt.origin, metrics)
+        if knn is not None:
+            tasks = knn.unresolved(tasks)
+        # Only one image of each group of near-duplicates is queried
+        dedup = create_deduplicator_from_config(project_config, hasher, metrics)
+        if dedup is not None:
+            tasks = dedup.representatives(tasks)
+        runs.append(ProjectRun(prompt, uploader, tasks, template, project_config, journal,
+                               name="Project {}".format(project_config["project_id"]) if len(projects) > 1 else None,
+                               dedup=dedup, knn=knn))
+        if sync is not None:
+            syncs.append((sync, journal))
+    
+    logger.info("Getting the results from OpenAI ...")
+    
+    profiler = start_profiler(args.profile) if args.profile else None
+    
+    # Process the tasks through the Batch API, or concurrently if requested
+    completed = False
+    try:
+        if args.mode == "batch":
+            completed = True
+            # The Batch API jobs of the projects are submitted one project after the other
+            for run in runs:
+                run_batch(run.prompt, openai_client, run.uploader, run.tasks, run.template, run.config, logger, run.journal)
+        elif config.get("concurrency", 1) > 1:
+            async_openai_client = AsyncOpenAI(api_key=config["openai_api_key"], base_url=config.get("openai_base_url"), max_retries=0)
+            completed = not run_projects_concurrent(runs, async_openai_client, config["concurrency"], logger)
+        else:
+            run_projects_serial(runs, openai_client, logger)
+            completed = True
+    finally:
+        for consumer in consumers:
+            logger.info("Pushing the rest of the spool {} ...".format(consumer.directory))
+            consumer.stop()
+            for name, value in consumer.uploader.stats.items():
+                consumer.uploader.metrics.count("predictions_{}".format(name), value)
+        # The next incremental run starts from this one if every selected task was processed,
+        # or from the oldest update of the tasks that were not predicted
+        if completed and args.limit is None:
+            for sync, journal in syncs:
+                states = journal.load_states()
+                sync.commit(logger, {task_id for task_id, state in states.items() if state in ("uploaded", "spooled")})
+        for run in runs:
+            run.journal.close()
+        if hasher is not None:
+            hasher.close()
+        if embedder is not None:
+            embedder.close()
+        if profiler is not None:
+            profile_output = config_shard_path(config, args.profile_output or "./profiles/run.{}".format(
+                "html" if args.profile == "pyinstrument" else "prof"))
+            stop_profiler(profiler, args.profile, profile_output)
+            logger.info("Profile written to {}".format(profile_output))
+        
+        # Summary of the run of each project, and of all of them
+        summaries = [write_project_summary(run, logger) for run in runs]
+        if shared_metrics is not None:
+            summary = merge_summaries(summaries + [shared_metrics.summary()])
+            summary.pop("shards")
+            summary_path = config_shard_path(config, (config.get("metrics") or {}).get(
+                "combined_summary_path", "./runs/projects_summary.json"))
+            if os.path.dirname(summary_path):
+                os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+            with open(summary_path, "w") as f:
+                json.dump(dict(summary, projects=[run.config["project_id"] for run in runs]), f, indent=2)
+            logger.info("Combined summary of {} projects written to {}, estimated cost ${:.4f}".format(
+                len(runs), summary_path, summary["cost_usd"]))
+        for metrics, prometheus_path, prometheus_stop in prometheus_writers:
+            prometheus_stop.set()
+            metrics.write_prometheus(prometheus_path)
+    
+    # The predictions that could not be stored stay parsed in the journals, `--resume` uploads them
+    if not spooled:
+        failed_uploads = sum(run.uploader.stats["failed"] for run in runs)
+        if failed_uploads:
+            raise SystemExit("{} predictions could not be stored in Label Studio, run again with --resume "
+                             "to upload them".format(failed_uploads))
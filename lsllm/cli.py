@@ -0,0 +1,76 @@
+"""
+    Command line of the tool:
+
+        lsllm annotate --config ./configs/chat_gpt_sample.yaml
+        lsllm push --config ./configs/chat_gpt_sample.yaml
+        lsllm serve --config ./configs/chat_gpt_sample.yaml --port 9090
+        lsllm flatten export.json export.parquet
+        lsllm stats export.parquet --by prediction_origin
+        lsllm knn evaluate export.parquet --config ./configs/chat_gpt_sample.yaml
+        lsllm bench end_to_end --tasks 500
+
+    Only the standard library is imported here, each subcommand imports the dependencies it
+    needs once it is selected, so that `lsllm --help` and short commands start quickly.
+"""
+import sys
+import runpy
+import pkgutil
+import argparse
+
+
+# Subcommand -> (module run as __main__, help)
+COMMANDS = {
+    "annotate": ("lsllm.annotate", "Query the LLM for the tasks of Label Studio projects and upload the predictions"),
+    "push": ("lsllm.push", "Push the predictions spooled by `annotate --no-push` to Label Studio"),
+    "serve": ("lsllm.serve", "Serve the predictions as a Label Studio ML backend, when a task is opened"),
+    "flatten": ("utils.convert_utils", "Flatten a Label Studio JSON export into CSV, JSONL or Parquet"),
+    "knn": ("utils.knn", "Build or evaluate the kNN index of the annotated images of a project"),
+    "stats": ("utils.analytics", "Agreement between the predictions and the annotations of a flattened export"),
+    "bench": (None, "Run a benchmark of the benchmarks package, e.g. `lsllm bench end_to_end --help`"),
+}
+
+
+def benchmark_names() -> list:
+    """Names of the benchmarks (benchmarks/bench_<name>.py)"""
+    import benchmarks
+    return sorted(module.name[len("bench_"):] for module in pkgutil.iter_modules(benchmarks.__path__)
+                  if module.name.startswith("bench_"))
+
+
+def run_module(module: str, prog: str, argv: list):
+    """Run a module as a script with its own arguments"""
+    sys.argv = [prog] + argv
+    runpy.run_module(module, run_name="__main__")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="lsllm", description="Pre-annotate Label Studio projects with LLMs")
+    subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+    for command, (_, help) in COMMANDS.items():
+        # The arguments are parsed by the subcommand itself
+        subparsers.add_parser(command, help=help, add_help=False)
+    return parser
+
+
+def main(argv: list = None):
+    """Entry point of the `lsllm` console script"""
+    args, rest = build_parser().parse_known_args(argv)
+    prog = "lsllm {}".format(args.command)
+
+    if args.command == "annotate":
+        from .annotate import main as annotate
+        annotate(rest, prog=prog)
+    elif args.command == "push":
+        from .push import main as push
+        push(rest, prog=prog)
+    elif args.command == "serve":
+        from .serve import main as serve
+        serve(rest, prog=prog)
+    elif args.command == "bench":
+        names = benchmark_names()
+        if not rest or rest[0] not in names:
+            print("usage: {} {{{}}} [args ...]".format(prog, ",".join(names)), file=sys.stderr)
+            sys.exit(2)
+        run_module("benchmarks.bench_{}".format(rest[0]), "{} {}".format(prog, rest[0]), rest[1:])
+    else:
+        run_module(COMMANDS[args.command][0], prog, rest)
@@ -0,0 +1,119 @@
+"""
+    The push command: upload the predictions written to the local spool by `lsllm annotate --no-push`
+    to Label Studio. The query stage and the upload stage can run on different machines or at
+    different times, the journal of the project is updated as the predictions are stored.
+"""
+import argparse
+import logging
+
+
+def build_parser(prog: str = "Label Studio LLM spool push") -> argparse.ArgumentParser:
+    """Arguments of the push command"""
+    parser = argparse.ArgumentParser(prog=prog, description="Push the spooled predictions to the Label Studio server")
+
+    parser.add_argument("--config", type=str, nargs="+", help="System config(s), one or more projects each", default=["./configs/chat_gpt_40.yaml"])
+    parser.add_argument("--project_ids", type=int, nargs="+", help="Push the spools of these projects with the configuration(s)", default=None)
+    parser.add_argument("--from", dest="from_dirs", type=str, nargs="+", help="Spool directories, the `spool_dir` of each project by default", default=None)
+    parser.add_argument("--follow", action="store_true", help="Keep pushing new segments until interrupted")
+    parser.add_argument("--delete", action="store_true", help="Delete the pushed segments instead of renaming them to *.jsonl.done")
+    parser.add_argument("--shard-index", type=int, help="Push the spool of this shard (0-based)", default=None)
+    parser.add_argument("--shard-count", type=int, help="Number of shards of the annotate run", default=None)
+    return parser
+
+
+def main(argv: list = None, prog: str = "Label Studio LLM spool push"):
+    """Entry point of the push command
+
+    Args:
+        argv (list): arguments, sys.argv[1:] by default
+        prog (str): name of the program shown in the help
+    """
+    args = build_parser(prog).parse_args(argv)
+    run(args)
+
+
+def run(args: argparse.Namespace):
+    """Push the spools of the projects of the configuration(s) with the parsed arguments"""
+    import yaml
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.uploader import PredictionUploader
+    from utils.journal import create_journal_from_config
+    from utils.spool import SpoolConsumer, spool_directory, spool_project
+    from utils.sharding import check_shard
+    from utils.projects import expand_project_configs, SharedLabelStudioClients
+
+    configs = []
+    for config_path in args.config:
+        with open(config_path, "r") as stream:
+            configs.append(yaml.safe_load(stream))
+    projects = expand_project_configs(configs, args.project_ids)
+    for project_config in projects:
+        if args.shard_count is not None:
+            project_config["shard_index"] = args.shard_index or 0
+            project_config["shard_count"] = args.shard_count
+        check_shard(project_config.get("shard_index", 0), project_config.get("shard_count", 1))
+    config = projects[0]
+
+    logger = logging.getLogger("Label Studio LLM tool")
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(getattr(logging, config["logging"]))
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(console_handler)
+    logger.propagate = False
+    logger.setLevel(getattr(logging, config["logging"]))
+
+    # Spool directory of each project, the segments record the project of their predictions
+    if args.from_dirs:
+        by_id = {project_config["project_id"]: project_config for project_config in projects}
+        spools = []
+        for directory in args.from_dirs:
+            project_id = spool_project(directory)
+            if project_id is None:
+                logger.info("Nothing to push in {}".format(directory))
+                continue
+            if project_id not in by_id:
+                raise ValueError("Spool {} holds predictions of project {}, which is not in the configuration(s), "
+                                 "use --project_ids!".format(directory, project_id))
+            spools.append((by_id[project_id], directory))
+    else:
+        spools = [(project_config, spool_directory(project_config)) for project_config in projects]
+
+    ls_clients = SharedLabelStudioClients(config.get("label_studio_pool_size", 32))
+
+    def push(project_config: dict, directory: str, consumer: SpoolConsumer) -> dict:
+        try:
+            logger.info("Pushing the spool {} to project {}".format(directory, project_config["project_id"]))
+            consumer.drain(follow=args.follow)
+            return consumer.stats
+        finally:
+            consumer.uploader.journal.close()
+
+    consumers = []
+    for project_config, directory in spools:
+        ls_project = ls_clients.get(project_config).get_project(id=project_config["project_id"])
+        # The tasks of the journal are marked as uploaded, the annotate run is not resumed here
+        journal = create_journal_from_config(project_config, resume=True)
+        uploader = PredictionUploader(ls_project, logger,
+                                      batch_size=project_config.get("upload_batch_size", 100),
+                                      workers=project_config.get("upload_workers", 4),
+                                      journal=journal)
+        consumers.append(SpoolConsumer(directory, uploader, logger, delete=args.delete))
+
+    # The projects are pushed in parallel, the segments of a project in order
+    with ThreadPoolExecutor(max_workers=max(1, len(spools))) as executor:
+        futures = [executor.submit(push, project_config, directory, consumer)
+                   for (project_config, directory), consumer in zip(spools, consumers)]
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, pushing the complete segments left ...")
+        finally:
+            # The consumers following their spool push the complete segments and return,
+            # also when another consumer failed, so that the executor can shut down
+            for consumer in consumers:
+                consumer.stop()
+        for (project_config, directory), future in zip(spools, futures):
+            stats = future.result()
+            logger.info("Project {}: {} predictions of {} segments pushed from {}".format(
+                project_config["project_id"], stats["predictions"], stats["segments"], directory))
@@ -0,0 +1,94 @@
+"""
+    The serve command: run the tool as a Label Studio ML backend, the predictions of a task are
+    computed when an annotator opens it. Connect it in the project settings of Label Studio
+    (Model > Connect model) with the URL of the server.
+"""
+import argparse
+import logging
+
+
+def build_parser(prog: str = "Label Studio LLM ML backend") -> argparse.ArgumentParser:
+    """Arguments of the serve command"""
+    parser = argparse.ArgumentParser(prog=prog, description="Serve the predictions of the LLM as a Label Studio ML backend")
+
+    parser.add_argument("--config", type=str, nargs="+", help="System config(s), one or more projects each", default=["./configs/chat_gpt_40.yaml"])
+    parser.add_argument("--project_ids", type=int, nargs="+", help="Serve these projects with the configuration(s)", default=None)
+    parser.add_argument("--host", type=str, help="Address to listen on, `ml_backend.host` by default", default=None)
+    parser.add_argument("--port", type=int, help="Port to listen on, `ml_backend.port` by default", default=None)
+    return parser
+
+
+def main(argv: list = None, prog: str = "Label Studio LLM ML backend"):
+    """Entry point of the serve command
+
+    Args:
+        argv (list): arguments, sys.argv[1:] by default
+        prog (str): name of the program shown in the help
+    """
+    args = build_parser(prog).parse_args(argv)
+    run(args)
+
+
+def run(args: argparse.Namespace):
+    """Serve the projects of the configuration(s) with the parsed arguments"""
+    import yaml
+    from openai import AsyncOpenAI
+    from utils.utils import create_prompt_from_config
+    from utils.ml_backend import MLBackendServer, create_served_project, create_service_from_config
+    from utils.cache import create_cache_from_config
+    from utils.image_utils import create_preprocessor_from_config
+    from utils.rate_limiter import create_rate_limiter_from_config
+    from utils.metrics import create_metrics_from_config
+    from utils.projects import expand_project_configs
+
+    configs = []
+    for config_path in args.config:
+        with open(config_path, "r") as stream:
+            configs.append(yaml.safe_load(stream))
+    projects = expand_project_configs(configs, args.project_ids)
+    # The client, rate limits, cache, image preprocessing and the server settings come from the first configuration
+    config = projects[0]
+
+    logger = logging.getLogger("Label Studio LLM tool")
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(getattr(logging, config["logging"]))
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(console_handler)
+    logger.propagate = False
+    logger.setLevel(getattr(logging, config["logging"]))
+
+    # Retries are handled by the tool with the shared rate limiter
+    client = AsyncOpenAI(api_key=config["openai_api_key"], base_url=config.get("openai_base_url"), max_retries=0)
+    cache = create_cache_from_config(config)
+    image_preprocessor = create_preprocessor_from_config(config)
+    rate_limiter = create_rate_limiter_from_config(config)
+    # One set of metrics for the whole server, exposed on /metrics, with the percentiles of the last calls
+    metrics = create_metrics_from_config(config, window=4096)
+    if image_preprocessor is not None:
+        image_preprocessor.metrics = metrics
+
+    served = {}
+    for project_config in projects:
+        prompt = create_prompt_from_config(project_config["prompt"])
+        prompt.cache = cache
+        prompt.image_preprocessor = image_preprocessor
+        prompt.rate_limiter = rate_limiter
+        prompt.followup_detail = project_config.get("followup_detail", "low")
+        prompt.metrics = metrics
+        served[project_config["project_id"]] = create_served_project(project_config, prompt)
+        logger.info("Serving project {} with {} (model version {})".format(
+            project_config["project_id"], type(prompt).__name__, served[project_config["project_id"]].model_version))
+
+    backend_config = config.get("ml_backend") or {}
+    service = create_service_from_config(config, served, client, logger, metrics).start()
+    server = MLBackendServer(service, logger, host=args.host or backend_config.get("host", "0.0.0.0"),
+                             port=args.port if args.port is not None else backend_config.get("port", 9090))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping the ML backend")
+    finally:
+        server.shutdown()
+        service.stop()
+        if cache is not None:
+            cache.close()
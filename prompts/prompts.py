@@ -1,10 +1,17 @@
 import abc
 from abc import ABC #Abstract Base Class
 import json
+import asyncio
+import hashlib
+import importlib
 import openai
-import copy
-from utils.image_utils import encode_image
-from utils.convert_utils import remove_first_and_last_line, check_json_valid
+from utils.image_utils import encode_image, image_mime_type
+from utils.cache import hash_file
+from utils.rate_limiter import estimate_request_tokens
+from utils.template_utils import compile_template
+from utils.metrics import stage_timer
+from utils.schema import SchemaValidator, extract_json
+from utils.confidence import attribute_confidences
 
 class Prompt(ABC):
     """
@@ -14,17 +21,284 @@ class Prompt(ABC):
     def __init__(self, origin=None, model=None):
         self.origin = origin
         self.model = model
+        # Optional ResponseCache, ImagePreprocessor, RateLimiter and RunMetrics, attached by the caller
+        self.cache = None
+        self.image_preprocessor = None
+        self.rate_limiter = None
+        self.metrics = None
+        # Token usage of the queries sent by this prompt
+        self.usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        # Image detail of the follow-up requests for missing attributes, None to keep the detail of the first request
+        self.followup_detail = "low"
+        self._validator = None
         pass
     
     
     @abc.abstractmethod
-    def query(self, *args, **kwargs):
+    def build_request(self, image_path: str) -> dict:
         """
-            Specific type of query method for each prompt
+            Build the body of the chat completion request for a single image
         """
         return NotImplemented
     
     
+    def image_content(self, image_path: str) -> dict:
+        """
+            Image part of the user message, preprocessed if an ImagePreprocessor is attached
+        """
+        if self.image_preprocessor is not None:
+            return self.image_preprocessor.image_content(image_path)
+        with stage_timer(self.metrics, "encode"):
+            url = f"data:{image_mime_type(image_path)};base64,{encode_image(image_path)}"
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": url,
+            },
+        }
+    
+    
+    def cache_key(self, image_path: str) -> str:
+        """
+            Key of the response in the cache: hash of the image bytes, the prompt, the schema and the model
+        """
+        digest = hash_file(image_path)
+        digest.update(json.dumps([
+            getattr(self, "prompt", None),
+            getattr(self, "system_msg", None),
+            getattr(self, "schema", None),
+            self.model,
+            getattr(self.image_preprocessor, "settings", None)
+        ], sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+    
+    
+    def _cached(self, image_path: str) -> tuple:
+        """
+            Cache key of an image and its cached output, None on a miss
+        """
+        key = self.cache_key(image_path)
+        return key, self.cache.get(key)
+    
+    
+    async def _acached(self, image_path: str) -> tuple:
+        """
+            Asynchronous counterpart of _cached(), the image is hashed and the cache read outside the event loop
+        """
+        if self.cache is None:
+            return None, None
+        return await asyncio.to_thread(self._cached, image_path)
+    
+    
+    def uncache(self, image_path: str):
+        """
+            Drop the cached response of an image, e.g. when it could not be parsed
+        """
+        if self.cache is not None:
+            self.cache.delete(self.cache_key(image_path))
+    
+    
+    def recache(self, image_path: str, output: str):
+        """
+            Replace the cached response of an image, e.g. by its repaired output
+        """
+        if self.cache is not None:
+            self.cache.put(self.cache_key(image_path), output)
+    
+    
+    @property
+    def validator(self):
+        """
+            SchemaValidator compiled from `self.schema`, None if the prompt has no schema
+        """
+        schema = getattr(self, "schema", None)
+        if schema is None:
+            return None
+        if self._validator is None or self._validator.schema is not schema:
+            self._validator = SchemaValidator(schema)
+        return self._validator
+    
+    
+    def validate(self, output: str) -> tuple:
+        """
+            Repair the output locally against the schema (code fences, case and spelling of the keys
+            and labels, ...) and list the attributes that are still missing or invalid.
+            Outputs that are not a JSON object are returned as they are, to be queried again.
+            
+            Returns:
+                tuple: (output, list of the missing or invalid attributes)
+        """
+        validator = self.validator
+        if validator is None:
+            return output, []
+        try:
+            values, repairs = extract_json(output)
+        except ValueError:
+            return output, []
+        values, value_repairs = validator.repair(values)
+        if not isinstance(values, dict):
+            return output, []
+        if self.metrics is not None:
+            for repair in repairs + value_repairs:
+                self.metrics.count("repaired_{}".format(repair))
+        return json.dumps(values), validator.invalid_properties(values)
+    
+    
+    def build_followup_request(self, image_path: str, output: str, attributes: list) -> dict:
+        """
+            Request for only the attributes of the output that are missing or invalid: the first
+            request, the output as the answer of the assistant and a message naming the attributes.
+            The structured output schema is narrowed to these attributes.
+        """
+        request = self.build_request(image_path)
+        messages = [dict(message) for message in request["messages"]]
+        for message in messages:
+            if self.followup_detail is not None and isinstance(message["content"], list):
+                message["content"] = [
+                    dict(part, image_url=dict(part["image_url"], detail=self.followup_detail))
+                    if part.get("type") == "image_url" else part
+                    for part in message["content"]
+                ]
+        messages.append({"role": "assistant", "content": output})
+        messages.append({"role": "user", "content": (
+            "The values of {} are missing or not allowed. Answer again for these attributes only, "
+            "using only the allowed values.").format(", ".join(attributes))})
+        request["messages"] = messages
+        if "response_format" in request and self.validator is not None:
+            request["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "shoe_annotation_followup",
+                    "schema": self.validator.subschema(attributes),
+                    "strict": True
+                }
+            }
+        return request
+    
+    
+    def merge_followup(self, output: str, followup_output: str) -> str:
+        """
+            Output updated with the attributes of the answer to a follow-up request
+        """
+        values = json.loads(output)
+        try:
+            answer, _ = extract_json(followup_output)
+        except ValueError:
+            return output
+        if isinstance(answer, dict):
+            values.update(answer)
+        return json.dumps(values)
+    
+    
+    def followup(self, client: openai.Client, image_path: str, output: str, attributes: list) -> str:
+        """
+            Query the model again for the missing or invalid attributes and merge its answer into the output
+        """
+        return self.merge_followup(output, self._create(client, self.build_followup_request(image_path, output, attributes)))
+    
+    
+    async def afollowup(self, client: openai.AsyncClient, image_path: str, output: str, attributes: list) -> str:
+        """
+            Asynchronous counterpart of followup()
+        """
+        # The image is encoded outside the event loop
+        request = await asyncio.to_thread(self.build_followup_request, image_path, output, attributes)
+        return self.merge_followup(output, await self._acreate(client, request))
+    
+    
+    def _record_usage(self, response, model: str = None):
+        self.usage["requests"] += 1
+        if response.usage is not None:
+            self.usage["prompt_tokens"] += response.usage.prompt_tokens
+            self.usage["completion_tokens"] += response.usage.completion_tokens
+        if self.metrics is not None:
+            self.metrics.record_usage(response.usage, model)
+    
+    
+    def _create(self, client: openai.Client, request: dict) -> str:
+        """
+            Send a chat completion request through the rate limiter and return the text output
+        """
+        return self._create_response(client, request).choices[0].message.content
+    
+    
+    def _create_response(self, client: openai.Client, request: dict):
+        """
+            Send a chat completion request through the rate limiter and return the whole response
+        """
+        if self.rate_limiter is not None:
+            with stage_timer(self.metrics, "rate_limit_wait"):
+                self.rate_limiter.acquire(estimate_request_tokens(request))
+            with stage_timer(self.metrics, "query"):
+                raw_response = client.chat.completions.with_raw_response.create(**request)
+            self.rate_limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
+        else:
+            with stage_timer(self.metrics, "query"):
+                response = client.chat.completions.create(**request)
+        self._record_usage(response, request.get("model"))
+        return response
+    
+    
+    async def _acreate(self, client: openai.AsyncClient, request: dict) -> str:
+        """
+            Asynchronous counterpart of _create()
+        """
+        return (await self._acreate_response(client, request)).choices[0].message.content
+    
+    
+    async def _acreate_response(self, client: openai.AsyncClient, request: dict):
+        """
+            Asynchronous counterpart of _create_response()
+        """
+        if self.rate_limiter is not None:
+            with stage_timer(self.metrics, "rate_limit_wait"):
+                await self.rate_limiter.aacquire(estimate_request_tokens(request))
+            with stage_timer(self.metrics, "query"):
+                raw_response = await client.chat.completions.with_raw_response.create(**request)
+            self.rate_limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
+        else:
+            with stage_timer(self.metrics, "query"):
+                response = await client.chat.completions.create(**request)
+        self._record_usage(response, request.get("model"))
+        return response
+    
+    
+    def query(self, client: openai.Client, image_path: str) -> str:
+        """
+            Query the model synchronously and return the raw text output
+        """
+        key = self.cache_key(image_path) if self.cache is not None else None
+        if key is not None:
+            output = self.cache.get(key)
+            if output is not None:
+                return output
+        
+        output = self._create(client, self.build_request(image_path))
+        
+        if key is not None:
+            self.cache.put(key, output)
+        return output
+    
+    
+    async def aquery(self, client: openai.AsyncClient, image_path: str) -> str:
+        """
+            Asynchronous counterpart of query(), used by the concurrent pipeline. Hashing and
+            encoding the image run in a worker thread, so that they do not block the event loop
+        """
+        key, output = await self._acached(image_path)
+        if output is not None:
+            return output
+        
+        request = await asyncio.to_thread(self.build_request, image_path)
+        output = await self._acreate(client, request)
+        
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, output)
+        return output
+    
+    
     @abc.abstractmethod
     def parse(self, *args, **kwargs):
         """
@@ -54,60 +328,47 @@ class Prompt_1(Prompt):
     The value should be a list containing the corresponding labels from the provided categories
     Return only 1 JSON dictionary, which can be parsed using Python. Follow the possible values for each attribute and do not generate your own attributes.
     """
+        
+        categories = {
+            "Function": ["Daily", "Fashion", "Running", "Hiking", "Walking", "Soccer", "Basketball",
+                         "Training", "Gym", "Golf", "Tennis", "Skateboard", "Snow", "Surfing", "Swimming", "Aqua", "Combat"],
+            "Type": ["Sneakers", "Sports", "Trainers", "Dress Shoes", "Sandals", "Heels", "Pumps", "Boots", "Traditional", "Slipper"],
+            "Main Color": ["Neutral tones", "Pastels", "Bright/Variant", "Dark/Moody", "Monochrome"],
+            "Sub Color": ["Neutral tones", "Pastels", "Bright/Variant", "Dark/Moody", "Monochrome"],
+            "Upper Structure": ["No Upper", "One-Piece Upper", "Multi-Piece Upper"],
+            "Closure Type": ["Shoelace", "Slip-on", "Velcro", "Straps", "Buckle", "Zipper", "Hook and Loop", "Dial"],
+            "Toe Shape": ["Round", "Pointed", "Square", "Almond"],
+            "Heel Type": ["Flat", "Block", "Stiletto", "Wedge"]
+        }
+        
+        # Not sent with the request, only used to validate and repair the free-form output locally
+        self.schema = {
+            "type": "object",
+            "properties": {k: {"type": "array", "items": {"type": "string", "enum": v}} for k, v in categories.items()},
+            "required": list(categories.keys()),
+            "additionalProperties": False
+        }
     
-    def query(self, client: openai.Client, image_path: str) -> str:
-        response = client.chat.completions.create(
-        model=self.model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    { "type": "text", "text": self.prompt },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{encode_image(image_path)}",
-                        },
-                    },
-                ],
-            }
-        ],
-    )
-    
-        #Print the response as a JSON string
-        return response.choices[0].message.content
+    def build_request(self, image_path: str) -> dict:
+        return dict(
+            model=self.model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        { "type": "text", "text": self.prompt },
+                        self.image_content(image_path),
+                    ],
+                }
+            ],
+        )
     
     def parse(self, output: str, result_template: dict):
-        pruned_response = remove_first_and_last_line(output)
-        json_response = json.loads(pruned_response)
-        json_response = json_response[0]
-        if not check_json_valid:
-            return TypeError("The JSON format is incorrect!")
-    
-        template = copy.deepcopy(result_template)
-    
-        for result in template["result"]:
-            if result["from_name"] == "answer1":
-                result["value"]["text"] = [", ".join(json_response["Function"])]
-            elif result["from_name"] == "answer2":
-                result["value"]["text"] = [", ".join(json_response["Type"])]
-            elif result["from_name"] == "answer3":
-                result["value"]["text"] = [", ".join(json_response["Main Color"])]
-            elif result["from_name"] == "answer4":
-                result["value"]["text"] = [", ".join(json_response["Sub Color"])]
-            elif result["from_name"] == "answer5":
-                result["value"]["text"] = [", ".join(json_response["Upper Structure"])]
-            elif result["from_name"] == "answer6":
-                result["value"]["text"] = [", ".join(json_response["Closure Type"])]
-            elif result["from_name"] == "answer7":
-                result["value"]["text"] = [", ".join(json_response["Toe Shape"])]
-            elif result["from_name"] == "answer8":
-                result["value"]["text"] = [", ".join(json_response["Heel Type"])]
-            else:
-                continue
-            result["origin"] = self.origin
-    
-        return template
+        # The output may be wrapped in a code fence
+        json_response, _ = extract_json(output)
+        if isinstance(json_response, list):
+            json_response = json_response[0]
+        return compile_template(result_template).fill(json_response, self.origin)
 
 class Prompt_2(Prompt):
     def __init__(self, origin=None, model=None):
@@ -144,8 +405,8 @@ class Prompt_2(Prompt):
             "additionalProperties": False
 }
 
-    def query(self, client: openai.Client, image_path: str) -> str:
-        response = client.chat.completions.create(
+    def build_request(self, image_path: str) -> dict:
+        return dict(
             model=self.model,
             messages=[
                 {"role": "system", "content": self.system_msg},
@@ -153,12 +414,7 @@ class Prompt_2(Prompt):
                     "role": "user",
                     "content": [
                         {"type": "text", "text": self.prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encode_image(image_path)}",
-                            },
-                        },
+                        self.image_content(image_path),
                     ],
                 },
             ],
@@ -172,22 +428,9 @@ class Prompt_2(Prompt):
             }
         )
 
-        return response.choices[0].message.content
-
     def parse(self, output: str, result_template: dict):
         json_response = json.loads(output)
-        template = copy.deepcopy(result_template)
-
-        for result in template["result"]:
-            attr = result["from_name"]
-            if attr.startswith("answer") and attr[-1].isdigit():
-                index = int(attr[-1])
-                keys = list(json_response.keys())
-                if index - 1 < len(keys):
-                    result["value"]["text"] = [json_response[keys[index - 1]]]
-                    result["origin"] = self.origin
-
-        return template
+        return compile_template(result_template).fill(json_response, self.origin)
     
 class Prompt_3(Prompt):
     def __init__(self, origin=None, model=None):
@@ -225,8 +468,8 @@ class Prompt_3(Prompt):
             "additionalProperties": False
         }
 
-    def query(self, client: openai.Client, image_path: str) -> str:
-        response = client.chat.completions.create(
+    def build_request(self, image_path: str) -> dict:
+        return dict(
             model=self.model,
             messages=[
                 {"role": "system", "content": self.system_msg},
@@ -234,12 +477,7 @@ class Prompt_3(Prompt):
                     "role": "user",
                     "content": [
                         {"type": "text", "text": self.prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encode_image(image_path)}",
-                            },
-                        },
+                        self.image_content(image_path),
                     ],
                 },
             ],
@@ -253,27 +491,238 @@ class Prompt_3(Prompt):
             }
         )
 
-        return response.choices[0].message.content
-
     def parse(self, output: str, result_template: dict):
         json_response = json.loads(output)
-        template = copy.deepcopy(result_template)
-
-        for result in template["result"]:
-            attr = result["from_name"]
-            if attr.startswith("answer") and attr[-1].isdigit():
-                index = int(attr[-1])
-                keys = list(json_response.keys())
-                if index - 1 < len(keys):
-                    key = keys[index - 1]
-                    val = json_response[key]
-                    if isinstance(val, list):
-                        result["value"]["text"] = [", ".join(val)]
-                    else:
-                        result["value"]["text"] = [val]
-                    result["origin"] = self.origin
-
-        return template
+        return compile_template(result_template).fill(json_response, self.origin)
+    
+class Prompt_3_Packed(Prompt_3):
+    """
+        Prompt_3 classifying `pack_size` images per request, so that the system message and the
+        schema are sent once for the whole pack. The response holds one annotation per image,
+        keyed by the image index, and is split back into Prompt_3 outputs with split().
+    """
+    def __init__(self, origin=None, model=None, pack_size=4):
+        super().__init__(origin, model)
+        self.pack_size = pack_size
+
+        self.packed_prompt = (
+            "Analyze each of the {} shoe images below and return one annotation per image as per JSON schema. "
+            "Set `index` to the number of the image the annotation belongs to."
+        )
+
+        image_annotation = {
+            "type": "object",
+            "properties": dict({"index": {"type": "integer"}}, **self.schema["properties"]),
+            "required": ["index"] + self.schema["required"],
+            "additionalProperties": False
+        }
+        self.packed_schema = {
+            "type": "object",
+            "properties": {"images": {"type": "array", "items": image_annotation}},
+            "required": ["images"],
+            "additionalProperties": False
+        }
+
+    def build_packed_request(self, image_paths: list) -> dict:
+        content = [{"type": "text", "text": self.packed_prompt.format(len(image_paths))}]
+        for index, image_path in enumerate(image_paths, start=1):
+            content.append({"type": "text", "text": "Image {}:".format(index)})
+            content.append(self.image_content(image_path))
+        return dict(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": self.system_msg},
+                {"role": "user", "content": content},
+            ],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "shoe_annotations",
+                    "schema": self.packed_schema,
+                    "strict": True
+                }
+            }
+        )
+
+    def query_packed(self, client: openai.Client, image_paths: list) -> str:
+        return self._create(client, self.build_packed_request(image_paths))
+
+    async def aquery_packed(self, client: openai.AsyncClient, image_paths: list) -> str:
+        request = await asyncio.to_thread(self.build_packed_request, image_paths)
+        return await self._acreate(client, request)
+
+    def split(self, output: str, n_images: int) -> list:
+        """
+            Split a packed output into one Prompt_3 output per image, in the order of the images.
+            Raises a ValueError if the output does not hold exactly one annotation per image.
+        """
+        annotations = json.loads(output)["images"]
+        by_index = {annotation.get("index"): annotation for annotation in annotations}
+        if len(annotations) != n_images or set(by_index) != set(range(1, n_images + 1)):
+            raise ValueError("Expected annotations for images 1 to {}, got {}".format(
+                n_images, [annotation.get("index") for annotation in annotations]))
+        return [
+            json.dumps({key: value for key, value in by_index[index].items() if key != "index"})
+            for index in range(1, n_images + 1)
+        ]
+    
+class Prompt_Cascade(Prompt):
+    """
+        Cascade of models sharing the prompt of a `base` prompt class. Each image is first queried with
+        the cheapest model of `cheap_models`, with logprobs. Its output is accepted if it is valid for
+        the schema and the confidence of every attribute (probability of the tokens of its value)
+        reaches `min_confidence`, otherwise the image is escalated to the next model, up to `model`,
+        whose valid outputs are always accepted. The model that produced an output is stored in it
+        under TIER_KEY, and the origin of the prediction is "{origin}/{model}".
+        The Batch API mode only uses `model`.
+    """
+    TIER_KEY = "_model"
+
+    def __init__(self, origin=None, model=None, base="prompts.Prompt_3", cheap_models=None, min_confidence=0.9):
+        super().__init__(origin, model)
+        module_name, class_name = base.rsplit(".", 1)
+        base_class = getattr(importlib.import_module(module_name), class_name)
+        self.models = list(cheap_models or []) + [model]
+        self.tiers = [base_class(origin="{}/{}".format(origin, tier_model), model=tier_model) for tier_model in self.models]
+        # Attribute -> threshold, or one threshold for every attribute
+        self.min_confidence = min_confidence
+        self.prompt = getattr(self.tiers[-1], "prompt", None)
+        self.system_msg = getattr(self.tiers[-1], "system_msg", None)
+        self.schema = getattr(self.tiers[-1], "schema", None)
+
+    def _sync_tiers(self):
+        # The preprocessor and the metrics are attached to the cascade after it is created
+        for tier in self.tiers:
+            tier.image_preprocessor = self.image_preprocessor
+            tier.metrics = self.metrics
+            tier.followup_detail = self.followup_detail
+
+    def threshold(self, attribute: str) -> float:
+        if isinstance(self.min_confidence, dict):
+            return self.min_confidence.get(attribute, self.min_confidence.get("default", 0.0))
+        return self.min_confidence
+
+    def cache_key(self, image_path: str) -> str:
+        key = super().cache_key(image_path) + json.dumps([self.models, self.min_confidence], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def build_request(self, image_path: str) -> dict:
+        return self.tiers[-1].build_request(image_path)
+
+    def _tier_request(self, index: int, image_path: str) -> dict:
+        request = self.tiers[index].build_request(image_path)
+        if index < len(self.tiers) - 1:
+            request["logprobs"] = True
+        return request
+
+    def _accept(self, index: int, response):
+        """
+            Output of a tier tagged with its model, or None if the image should be escalated
+        """
+        model = self.models[index]
+        choice = response.choices[0]
+        output = choice.message.content
+        last = index == len(self.tiers) - 1
+        try:
+            values = json.loads(output)
+        except (TypeError, ValueError):
+            values = None
+        if not isinstance(values, dict):
+            if last:
+                # Left to the parser, so that the query is retried
+                return output
+            reason = "invalid"
+        elif last:
+            reason = None
+        elif self.validator is not None and self.validator.errors(values):
+            reason = "invalid"
+        elif choice.logprobs is None or not choice.logprobs.content:
+            reason = "no_logprobs"
+        else:
+            confidences = attribute_confidences(output, choice.logprobs.content)
+            low = [attribute for attribute in values if confidences.get(attribute, 0.0) < self.threshold(attribute)]
+            reason = "low_confidence" if low else None
+
+        if self.metrics is not None:
+            self.metrics.count("cascade_{}_{}".format("escalated" if reason else "accepted", model))
+            if reason:
+                self.metrics.count("cascade_{}".format(reason))
+        if reason:
+            return None
+        values[self.TIER_KEY] = model
+        return json.dumps(values)
+
+    def query(self, client: openai.Client, image_path: str) -> str:
+        key = self.cache_key(image_path) if self.cache is not None else None
+        if key is not None:
+            output = self.cache.get(key)
+            if output is not None:
+                return output
+
+        self._sync_tiers()
+        for index in range(len(self.tiers)):
+            output = self._accept(index, self._create_response(client, self._tier_request(index, image_path)))
+            if output is not None:
+                break
+
+        if key is not None:
+            self.cache.put(key, output)
+        return output
+
+    async def aquery(self, client: openai.AsyncClient, image_path: str) -> str:
+        key, output = await self._acached(image_path)
+        if output is not None:
+            return output
+
+        self._sync_tiers()
+        for index in range(len(self.tiers)):
+            request = await asyncio.to_thread(self._tier_request, index, image_path)
+            output = self._accept(index, await self._acreate_response(client, request))
+            if output is not None:
+                break
+
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, output)
+        return output
+
+    def _split_tier(self, output: str) -> tuple:
+        """
+            Tier that produced an output and the output without its tag
+        """
+        try:
+            values = json.loads(output)
+        except (TypeError, ValueError):
+            return self.tiers[-1], output
+        if not isinstance(values, dict) or values.get(self.TIER_KEY) not in self.models:
+            return self.tiers[-1], output
+        tier = self.tiers[self.models.index(values.pop(self.TIER_KEY))]
+        return tier, json.dumps(values)
+
+    def _tag(self, tier, output: str) -> str:
+        try:
+            values = json.loads(output)
+        except (TypeError, ValueError):
+            return output
+        if isinstance(values, dict):
+            values[self.TIER_KEY] = tier.model
+            return json.dumps(values)
+        return output
+
+    def validate(self, output: str) -> tuple:
+        self._sync_tiers()
+        tier, output = self._split_tier(output)
+        output, invalid = tier.validate(output)
+        return self._tag(tier, output), invalid
+
+    def build_followup_request(self, image_path: str, output: str, attributes: list) -> dict:
+        # The follow-up goes to the model that produced the output
+        self._sync_tiers()
+        tier, output = self._split_tier(output)
+        return tier.build_followup_request(image_path, output, attributes)
+
+    def parse(self, output: str, result_template: dict):
+        tier, output = self._split_tier(output)
+        return tier.parse(output, result_template)
     
 class Prompt_Test(Prompt):
     """
@@ -282,8 +731,14 @@ class Prompt_Test(Prompt):
     def __init__(self, origin=None, model=None):
         super().__init__(origin, model)
     
+    def build_request(self, image_path: str) -> dict:
+        return dict(model=self.model, messages=[])
+    
     def query(self, client: openai.Client, image_path: str) -> str:
         return "This is for testing purposes only."
     
+    async def aquery(self, client: openai.AsyncClient, image_path: str) -> str:
+        return "This is for testing purposes only."
+    
     def parse(self, output: str, result_template: dict):
-        return result_template
\ No newline at end of file
+        return compile_template(result_template).template
\ No newline at end of file
@@ -0,0 +1,25 @@
+import logging
+import pytest
+from benchmarks.fake_label_studio import FakeLabelStudioServer
+from benchmarks.fake_openai import FakeOpenAIServer
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger("tests")
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+@pytest.fixture
+def ls_server():
+    server = FakeLabelStudioServer(20).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def openai_server():
+    server = FakeOpenAIServer().start()
+    yield server
+    server.stop()
@@ -0,0 +1,97 @@
+import os
+import json
+from types import SimpleNamespace
+import pytest
+from openai import OpenAI
+from label_studio_sdk import Client
+from benchmarks.bench_end_to_end import ROOT, make_images
+from prompts import Prompt_3
+from utils.batch import iter_batch_outputs, write_batch_shards, run_batch
+from utils.journal import RunJournal
+from utils.template_utils import load_template
+from utils.uploader import PredictionUploader
+
+
+class FakeFiles:
+    def __init__(self, files: dict):
+        self.files = files
+
+    def content(self, file_id: str):
+        return SimpleNamespace(text="\n".join(self.files[file_id]))
+
+
+def response(task_id: int, status_code: int, body: dict) -> str:
+    return json.dumps({"custom_id": str(task_id), "response": {"status_code": status_code, "body": body}})
+
+
+def test_failed_batch_requests_are_journaled(tmp_path, logger):
+    journal = RunJournal(str(tmp_path / "journal.sqlite"))
+    client = SimpleNamespace(files=FakeFiles({
+        "errors": [json.dumps({"custom_id": "1", "error": {"code": "invalid_request"}})],
+        "outputs": [
+            response(2, 200, {"choices": [{"message": {"content": "{}"}}]}),
+            response(3, 500, {"error": "server error"}),
+            response(4, 200, {"choices": []}),
+            '{"custom_id": "5", "resp',
+        ],
+    }))
+    batch = SimpleNamespace(error_file_id="errors", output_file_id="outputs")
+    assert list(iter_batch_outputs(client, batch, logger, journal)) == [(2, "{}")]
+    assert journal.load_states() == {1: "failed", 3: "failed", 4: "failed"}
+
+
+@pytest.fixture
+def images(tmp_path) -> list:
+    make_images(str(tmp_path / "images"), 20, 64)
+    return [(task_id, str(tmp_path / "images" / "shoe_{}.jpg".format(task_id))) for task_id in range(1, 21)]
+
+
+def shard_lines(paths: list) -> list:
+    lines = []
+    for path in paths:
+        with open(path, "rb") as f:
+            lines.append(f.read().splitlines())
+    return lines
+
+
+def test_shards_are_split_by_request_count(tmp_path, images):
+    paths = write_batch_shards(Prompt_3(model="fake"), images[:10], str(tmp_path / "batches"), max_requests=4)
+    assert [len(lines) for lines in shard_lines(paths)] == [4, 4, 2]
+    assert [json.loads(line)["custom_id"] for lines in shard_lines(paths) for line in lines] == \
+        [str(task_id) for task_id in range(1, 11)]
+
+
+def test_shards_are_split_by_size(tmp_path, images):
+    prompt = Prompt_3(model="fake")
+    line_size = max(len(line) + 1 for lines in shard_lines(
+        write_batch_shards(prompt, images[:10], str(tmp_path / "single"))) for line in lines)
+    paths = write_batch_shards(prompt, images[:10], str(tmp_path / "batches"), max_bytes=int(line_size * 3.5))
+    assert sum(len(lines) for lines in shard_lines(paths)) == 10
+    assert len(paths) > 1
+    assert all(os.path.getsize(path) <= line_size * 3.5 for path in paths)
+    with pytest.raises(ValueError):
+        write_batch_shards(prompt, images[:1], str(tmp_path / "small"), max_bytes=100)
+
+
+def test_run_batch_against_the_fake_endpoints(tmp_path, images, ls_server, openai_server, logger):
+    client = OpenAI(api_key="fake", base_url=openai_server.base_url, max_retries=0)
+    project = Client(url=ls_server.url, api_key="fake").get_project(id=ls_server.project_id)
+    template = load_template(os.path.join(ROOT, "result_templates", "project_4_result_template.json"))
+    config = {"project_id": ls_server.project_id, "batch_dir": str(tmp_path / "batches"), "batch_poll_interval": 0.1,
+              "batch_max_requests": 4}
+    journal = RunJournal(str(tmp_path / "journal.sqlite"))
+
+    run_batch(Prompt_3(model="fake"), client, PredictionUploader(project, logger, journal=journal), images[:10],
+              template, config, logger, journal)
+    # One batch per shard of 4 requests, every task predicted
+    assert len(openai_server.batches) == 3
+    assert all(batch["status"] == "completed" for batch in openai_server.batches.values())
+    assert ls_server.predicted_tasks() == 10
+    assert set(journal.load_states().values()) == {"uploaded"}
+    assert not os.path.exists(os.path.join(config["batch_dir"], "batches.json"))
+
+    # The next run submits its own tasks instead of resuming the finished batches
+    run_batch(Prompt_3(model="fake"), client, PredictionUploader(project, logger, journal=journal), images[10:],
+              template, config, logger, journal)
+    assert len(openai_server.batches) == 6
+    assert ls_server.predicted_tasks() == 20
@@ -0,0 +1,22 @@
+import sys
+import time
+import subprocess
+import pytest
+from benchmarks.bench_end_to_end import ROOT
+
+HEAVY_MODULES = {"openai", "pandas", "PIL", "numpy"}
+
+
+@pytest.mark.parametrize("argv", [["--help"], ["annotate", "--help"]])
+def test_help_starts_quickly_without_the_heavy_dependencies(argv):
+    start = time.monotonic()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-m", "lsllm"] + argv, cwd=ROOT,
+                            capture_output=True, text=True, timeout=30)
+    elapsed = time.monotonic() - start
+    assert result.returncode == 0
+    assert "usage: lsllm" in result.stdout
+    # -X importtime writes "import time: self | cumulative | package" for every imported module
+    imported = {line.rsplit("|", 1)[1].strip().split(".")[0] for line in result.stderr.splitlines()
+                if line.startswith("import time:") and "|" in line}
+    assert imported and not imported & HEAVY_MODULES
+    assert elapsed < 2.0
@@ -0,0 +1,52 @@
+import csv
+import json
+import pytest
+from utils.convert_utils import stream_flatten_export
+
+
+def result(text: str) -> list:
+    return [{"from_name": "answer1", "to_name": "q1", "type": "textarea", "value": {"text": [text]}}]
+
+
+EXPORT = [
+    # Not annotated, predictions of the task as a list
+    {"id": 1, "data": {"image": "/data/upload/1/shoe_1.jpg"}, "annotations": [],
+     "predictions": [{"id": 10, "model_version": "v1", "result": result("red")}]},
+    # Annotated twice: from the prediction embedded as a dict, and from the second prediction of the task
+    {"id": 2, "data": {"image": "/data/upload/1/shoe_2.jpg"},
+     "annotations": [
+         {"id": 100, "result": result("blue"), "prediction": {"id": 20, "model_version": "v1", "result": result("red")}},
+         {"id": 101, "result": result("black"), "parent_prediction": 21},
+     ],
+     "predictions": [{"id": 20, "model_version": "v1", "result": result("red")},
+                     {"id": 21, "model_version": "v2", "result": result("black")}]},
+    # Neither annotated nor predicted
+    {"id": 3, "data": {"image": "/data/upload/1/shoe_3.jpg"}},
+]
+
+# (task_id, annotation_id, q1_prediction, q1_annotation, q1_changed, prediction_origin)
+EXPECTED = [
+    ("1", "", "red", "", "", "v1"),
+    ("2", "100", "red", "blue", "True", "v1"),
+    ("2", "101", "black", "black", "False", "v2"),
+    ("3", "", "", "", "", ""),
+]
+COLUMNS = ("task_id", "annotation_id", "q1_prediction", "q1_annotation", "q1_changed", "prediction_origin")
+
+
+def read_rows(path: str, output_format: str) -> list:
+    with open(path, encoding="utf-8", newline="") as f:
+        if output_format == "csv":
+            return [tuple(row[column] for column in COLUMNS) for row in csv.DictReader(f)]
+        rows = [json.loads(line) for line in f]
+    return [tuple("" if row[column] is None else str(row[column]) for column in COLUMNS) for row in rows]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+@pytest.mark.parametrize("chunk_size", [1, 10000])
+def test_stream_flatten_export(tmp_path, output_format, chunk_size):
+    input_path = tmp_path / "export.json"
+    input_path.write_text(json.dumps(EXPORT), encoding="utf-8")
+    output_path = str(tmp_path / "flat.{}".format(output_format))
+    assert stream_flatten_export(str(input_path), output_path, chunk_size=chunk_size) == 4
+    assert read_rows(output_path, output_format) == EXPECTED
@@ -0,0 +1,38 @@
+from utils.dedup import Deduplicator
+
+
+class FixedHasher:
+    """Hashes given by the image paths: "hash-<value>" """
+    def hash_images(self, image_paths, metrics=None):
+        return {image_path: int(image_path.split("-")[1]) for image_path in image_paths}
+
+
+def test_results_are_bounded_and_reloaded():
+    dedup = Deduplicator(FixedHasher(), threshold=0, chunk_size=1, max_results=2)
+    reloaded = []
+
+    def reload(task_id):
+        reloaded.append(task_id)
+        return "output {}".format(task_id), {"task": task_id}, None
+
+    dedup.reload = reload
+    tasks = [(1, "hash-1"), (2, "hash-2"), (3, "hash-4"), (4, "hash-1"), (5, "hash-4")]
+    queried = []
+    for task_id, _ in dedup.representatives(tasks):
+        queried.append(task_id)
+        dedup.resolve(task_id, "output {}".format(task_id), {"task": task_id}, None)
+    assert queried == [1, 2, 3]
+    assert len(dedup.results) == 2
+    # Task 4 duplicates task 1, evicted by task 3: its result is read again
+    assert reloaded == [1]
+    assert dedup.drain() == [(4, "output 1", {"task": 1}, None), (5, "output 3", {"task": 3}, None)]
+
+
+def test_evicted_result_without_reload_is_queried():
+    dedup = Deduplicator(FixedHasher(), threshold=0, chunk_size=1, max_results=1)
+    queried = []
+    for task_id, _ in dedup.representatives([(1, "hash-1"), (2, "hash-2"), (3, "hash-1")]):
+        queried.append(task_id)
+        dedup.resolve(task_id, "output", {"task": task_id}, None)
+    assert queried == [1, 2, 3]
+    assert dedup.stats == {"representatives": 3, "duplicates": 0}
@@ -0,0 +1,10 @@
+import sys
+import subprocess
+from benchmarks.bench_end_to_end import ROOT
+
+
+def test_knn_does_not_import_pandas():
+    # The kNN tier runs in the annotate command, pandas is only needed by the analytics
+    output = subprocess.run([sys.executable, "-c", "import sys, utils.knn; print('pandas' in sys.modules)"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "False"
@@ -0,0 +1,24 @@
+from utils.metrics import RunMetrics
+
+
+def test_window_bounds_the_durations_kept():
+    metrics = RunMetrics(window=100)
+    for i in range(1000):
+        metrics.observe("query", i / 1000)
+    assert len(metrics.durations["query"]) == 100
+    stats = metrics.summary()["stages"]["query"]
+    # Count, total and max cover every duration, the percentiles the last 100
+    assert stats["count"] == 1000
+    assert stats["total"] == round(sum(i / 1000 for i in range(1000)), 6)
+    assert stats["max"] == 0.999
+    assert 0.9 <= stats["p50"] <= 0.999
+    assert 'lsllm_stage_seconds_count{stage="query"} 1000' in metrics.prometheus()
+
+
+def test_without_window_every_duration_is_kept():
+    metrics = RunMetrics()
+    for i in range(1000):
+        metrics.observe("query", i / 1000)
+    stats = metrics.summary()["stages"]["query"]
+    assert stats["count"] == 1000
+    assert abs(stats["p50"] - 0.4995) < 1e-6
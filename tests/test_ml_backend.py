@@ -0,0 +1,93 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from openai import AsyncOpenAI
+from benchmarks.bench_end_to_end import ROOT, make_images
+from benchmarks.fake_openai import FakeOpenAIServer
+from utils.ml_backend import MLBackendServer, create_served_project, create_service_from_config
+from utils.metrics import RunMetrics
+from utils.utils import create_prompt_from_config
+
+
+def task(task_id: int) -> dict:
+    return {"id": task_id, "data": {"image": "/data/upload/1/{:08x}-shoe_{}.jpg".format(task_id, task_id)}}
+
+
+@pytest.fixture
+def backend(tmp_path, logger):
+    """Start an ML backend serving project 1 with a packed prompt against a fake OpenAI server"""
+    make_images(str(tmp_path / "images"), 20, 64)
+    servers = []
+
+    def start(openai_server: FakeOpenAIServer, **ml_backend):
+        config = {
+            "project_id": 1,
+            "data_storage": "local",
+            "data_dir": str(tmp_path / "images"),
+            "template": os.path.join(ROOT, "result_templates", "project_4_result_template.json"),
+            "prompt": {"class": "prompts.Prompt_3_Packed", "params": {"model": "fake", "origin": "test", "pack_size": 8}},
+            "MAX_RETRIES": 1,
+            "ml_backend": dict({"max_batch_size": 8, "max_wait_ms": 200, "timeout": 10}, **ml_backend),
+        }
+        prompt = create_prompt_from_config(config["prompt"])
+        client = AsyncOpenAI(api_key="fake", base_url=openai_server.base_url, max_retries=0)
+        service = create_service_from_config(config, {1: create_served_project(config, prompt)}, client, logger,
+                                             RunMetrics()).start()
+        server = MLBackendServer(service, logger, host="127.0.0.1", port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append((server, service))
+        return server
+
+    yield start
+    for server, service in servers:
+        server.shutdown()
+        service.stop()
+
+
+def predict(url: str, tasks: list) -> requests.Response:
+    return requests.post(url + "/predict", json={"project": "1.1700000000", "tasks": tasks}, timeout=30)
+
+
+def test_health_and_setup(backend, openai_server):
+    server = backend(openai_server)
+    assert requests.get(server.url + "/health", timeout=5).json() == {"status": "UP", "model_class": ["Prompt_3_Packed"]}
+    response = requests.post(server.url + "/setup", json={"project": "1.1700000000", "schema": "<View/>"}, timeout=5)
+    assert response.status_code == 200
+    assert response.json() == {"model_version": "test"}
+
+
+def test_concurrent_calls_are_micro_batched(backend, openai_server):
+    server = backend(openai_server)
+    with ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(lambda task_id: predict(server.url, [task(task_id)]), range(1, 9)))
+    assert all(len(response.json()["results"]) == 1 for response in responses)
+    counters = server.service.metrics.counters
+    assert counters["batched_tasks"] == 8
+    assert counters["batches"] < 8
+    assert openai_server.counts["requests"] < 8
+
+
+def test_concurrent_identical_tasks_are_queried_once(backend, openai_server):
+    server = backend(openai_server)
+    with ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(lambda _: predict(server.url, [task(5)]), range(8)))
+    results = [response.json()["results"] for response in responses]
+    assert all(len(result) == 1 and result[0] == results[0][0] for result in results)
+    counters = server.service.metrics.counters
+    assert counters["batched_tasks"] == 1
+    assert counters["inflight_joins"] + counters["prediction_cache_hits"] == 7
+    assert openai_server.counts["requests"] == 1
+
+
+def test_timeout_returns_an_empty_result(backend):
+    openai_server = FakeOpenAIServer(latency=lambda: 1.0).start()
+    try:
+        server = backend(openai_server, timeout=0.2)
+        response = predict(server.url, [task(1)])
+        assert response.status_code == 200
+        assert response.json() == {"results": [], "model_version": "test"}
+        assert server.service.metrics.counters["tasks_timed_out"] == 1
+    finally:
+        openai_server.stop()
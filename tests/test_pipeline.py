@@ -0,0 +1,47 @@
+import os
+import asyncio
+import pytest
+from openai import OpenAI, AsyncOpenAI
+from benchmarks.bench_end_to_end import ROOT, make_images
+from prompts import Prompt_3_Packed
+from utils.cache import ResponseCache
+from utils.pipeline import query_packed_with_fallback, aquery_packed_with_fallback
+from utils.template_utils import load_template
+
+
+@pytest.fixture
+def packed(tmp_path, openai_server, logger):
+    """Run the packed queries of a cached Prompt_3_Packed against the fake server"""
+    make_images(str(tmp_path / "images"), 8, 64)
+    prompt = Prompt_3_Packed(origin="test", model="fake", pack_size=8)
+    prompt.cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    template = load_template(os.path.join(ROOT, "result_templates", "project_4_result_template.json"))
+
+    def run(task_ids: list, concurrent: bool) -> list:
+        image_paths = [str(tmp_path / "images" / "shoe_{}.jpg".format(task_id)) for task_id in task_ids]
+        if not concurrent:
+            client = OpenAI(api_key="fake", base_url=openai_server.base_url, max_retries=0)
+            return query_packed_with_fallback(prompt, client, image_paths, template, 3, logger)
+
+        async def query() -> list:
+            client = AsyncOpenAI(api_key="fake", base_url=openai_server.base_url, max_retries=0)
+            try:
+                return await aquery_packed_with_fallback(prompt, client, image_paths, template, 3, logger)
+            finally:
+                await client.close()
+        return asyncio.run(query())
+    return run
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_packed_queries_use_the_response_cache(packed, openai_server, concurrent):
+    first = packed([1, 2, 3, 4], concurrent)
+    assert all(prediction is not None for _, prediction, _ in first)
+    assert openai_server.counts["requests"] == 1
+
+    # The cached images are not packed again, the misses are packed together
+    second = packed([1, 5, 2, 6, 3, 4], concurrent)
+    assert all(prediction is not None for _, prediction, _ in second)
+    assert [output for output, _, _ in second[:1] + second[2:3] + second[4:]] == [output for output, _, _ in first]
+    assert openai_server.counts["requests"] == 2
+    assert packed([5, 6, 1], concurrent) and openai_server.counts["requests"] == 2
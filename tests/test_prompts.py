@@ -0,0 +1,44 @@
+import asyncio
+import threading
+from PIL import Image
+from openai import AsyncOpenAI
+from prompts import Prompt_3
+from utils.cache import ResponseCache
+
+
+class RecordingPrompt(Prompt_3):
+    """Prompt_3 recording the threads hashing and encoding the images"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = []
+
+    def cache_key(self, image_path: str) -> str:
+        self.threads.append(threading.get_ident())
+        return super().cache_key(image_path)
+
+    def image_content(self, image_path: str) -> dict:
+        self.threads.append(threading.get_ident())
+        return super().image_content(image_path)
+
+
+def test_aquery_hashes_and_encodes_off_the_event_loop(tmp_path, openai_server):
+    image_path = str(tmp_path / "shoe.jpg")
+    Image.new("RGB", (64, 64), (200, 30, 30)).save(image_path)
+    prompt = RecordingPrompt(model="fake", origin="test")
+    prompt.cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+
+    async def query() -> tuple:
+        client = AsyncOpenAI(api_key="fake", base_url=openai_server.base_url, max_retries=0)
+        try:
+            first = await prompt.aquery(client, image_path)
+            # The second query is answered from the cache
+            return first, await prompt.aquery(client, image_path), threading.get_ident()
+        finally:
+            await client.close()
+
+    first, second, loop_thread = asyncio.run(query())
+    assert first == second
+    assert openai_server.counts["requests"] == 1
+    assert len(prompt.threads) == 3
+    assert loop_thread not in prompt.threads
+    prompt.cache.close()
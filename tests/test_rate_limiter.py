@@ -0,0 +1,115 @@
+import os
+import time
+import random
+import httpx
+import openai
+import pytest
+from PIL import Image
+from prompts import Prompt_3
+from benchmarks.bench_end_to_end import ROOT
+from utils.pipeline import query_with_retries
+from utils.rate_limiter import RateLimiter, create_rate_limiter_from_config
+from utils.template_utils import load_template
+
+
+def rate_limit_error(headers: dict) -> openai.RateLimitError:
+    request = httpx.Request("POST", "http://127.0.0.1/v1/chat/completions")
+    return openai.RateLimitError("Rate limit reached", response=httpx.Response(429, headers=headers, request=request),
+                                 body=None)
+
+
+def test_requests_per_minute_bounds_throughput():
+    limiter = RateLimiter(requests_per_minute=600)
+    start = time.monotonic()
+    for _ in range(610):
+        limiter.acquire(1)
+    elapsed = time.monotonic() - start
+    # A full bucket of 600 requests, then 10 requests per second
+    assert elapsed >= 10 / 10 * 0.9
+
+
+def test_tokens_per_minute_bounds_throughput():
+    limiter = RateLimiter(tokens_per_minute=6000)
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < 1.0:
+        limiter.acquire(100)
+        sent += 100
+    elapsed = time.monotonic() - start
+    # Never more than the full bucket and the tokens refilled since the start
+    assert sent <= 6000 + 100 * elapsed + 100
+
+
+@pytest.mark.parametrize("headers, delay", [({"retry-after": "0.5"}, 0.5), ({"retry-after-ms": "300"}, 0.3)])
+def test_retry_after_blocks_every_query(headers, delay):
+    limiter = RateLimiter(base_backoff=0.1)
+    assert limiter.on_error(rate_limit_error(headers), attempt=1) >= delay
+    # The other queries wait as well
+    assert limiter.reserve(100) >= delay * 0.9
+    time.sleep(delay + 0.1)
+    assert limiter.reserve(100) == 0.0
+
+
+def test_header_limits_are_shared_by_the_shards():
+    limiter = create_rate_limiter_from_config({"rate_limit": {"requests_per_minute": 600}, "shard_count": 4})
+    assert limiter.requests.capacity == 150
+    limiter.update_from_headers({"x-ratelimit-limit-requests": "600", "x-ratelimit-remaining-requests": "400",
+                                 "x-ratelimit-limit-tokens": "80000", "x-ratelimit-remaining-tokens": "80000"})
+    # The bucket of the shard is kept, not replaced by the limit of the whole account
+    assert limiter.requests.capacity == 150
+    assert limiter.requests.level <= 100
+    assert limiter.tokens.capacity == 20000
+
+
+@pytest.fixture
+def query(tmp_path, openai_server, logger):
+    """Query one image through the retries of the pipeline, with a rate limiter, against the fake server"""
+    image_path = str(tmp_path / "shoe.jpg")
+    Image.new("RGB", (64, 64), (200, 30, 30)).save(image_path)
+    prompt = Prompt_3(model="fake", origin="test")
+    prompt.rate_limiter = RateLimiter(base_backoff=0.05, max_backoff=5)
+    client = openai.OpenAI(api_key="fake", base_url=openai_server.base_url, max_retries=0)
+    template = load_template(os.path.join(ROOT, "result_templates", "project_4_result_template.json"))
+
+    def run(max_retries: int = 10) -> tuple:
+        return query_with_retries(prompt, client, image_path, template, max_retries, logger)
+    return run
+
+
+def test_injected_errors_are_retried(openai_server, query):
+    random.seed(1)
+    openai_server.error_429_rate = 0.3
+    openai_server.error_5xx_rate = 0.3
+    results = [query() for _ in range(10)]
+    assert all(error is None and output is not None for output, _, error in results)
+    assert openai_server.counts["ok"] == 10
+    assert openai_server.counts["429"] > 0 and openai_server.counts["5xx"] > 0
+    assert openai_server.counts["requests"] == 10 + openai_server.counts["429"] + openai_server.counts["5xx"]
+
+
+def test_retry_after_ms_is_honoured(openai_server, query):
+    # The injected 429s ask for 200 ms
+    openai_server.error_429_rate = 1.0
+    start = time.monotonic()
+    output, _, error = query(max_retries=3)
+    assert output is None and error.startswith("RateLimitError")
+    assert openai_server.counts["requests"] == 3
+    assert time.monotonic() - start >= 2 * 0.2
+
+
+def test_retry_after_is_honoured(openai_server, query):
+    # The second request is over the limit, with a retry-after of the remaining second of the window
+    openai_server.requests_per_minute = 1
+    openai_server.window = [time.monotonic() - 59]
+    start = time.monotonic()
+    output, _, error = query()
+    assert error is None and output is not None
+    assert openai_server.counts["limited"] == 1
+    assert time.monotonic() - start >= 0.9
+
+
+def test_invalid_requests_are_not_retried(openai_server, query):
+    openai_server.error_400_rate = 1.0
+    output, _, error = query()
+    assert output is None and error.startswith("BadRequestError")
+    assert openai_server.counts["requests"] == 1
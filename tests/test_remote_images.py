@@ -0,0 +1,93 @@
+import os
+import hashlib
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import pytest
+from utils.metrics import RunMetrics
+from utils.remote_images import RemoteImageSource
+
+
+class ETagHandler(SimpleHTTPRequestHandler):
+    """Static files with an ETag, answering 304 when it matches If-None-Match"""
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                etag = '"{}"'.format(hashlib.md5(f.read()).hexdigest())
+            self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return None
+            self.etag = etag
+        return super().send_head()
+
+    def end_headers(self):
+        if getattr(self, "etag", None):
+            self.send_header("ETag", self.etag)
+            self.etag = None
+        super().end_headers()
+
+
+@pytest.fixture
+def static_server(tmp_path):
+    (tmp_path / "static").mkdir()
+    for index in range(5):
+        (tmp_path / "static" / "shoe_{}.jpg".format(index)).write_bytes(bytes([index]) * 1000)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(ETagHandler, directory=str(tmp_path / "static")))
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = RemoteImageSource("http://label-studio.invalid", "fake", cache_dir=str(tmp_path / "cache"))
+    source.metrics = RunMetrics()
+    yield source
+    source.close()
+
+
+def url(server, name: str, query: str = "") -> str:
+    return "http://{}:{}/{}{}".format(*server.server_address[:2], name, query)
+
+
+def test_etag_revalidation_is_a_cache_hit(static_server, source):
+    path = source.fetch(url(static_server, "shoe_1.jpg"))
+    assert source.fetch(url(static_server, "shoe_1.jpg")) == path
+    with open(path, "rb") as f:
+        assert f.read() == bytes([1]) * 1000
+    assert static_server.requests[1][1] is not None
+    assert source.metrics.counters["image_downloads"] == 1
+    assert source.metrics.counters["image_cache_hits"] == 1
+
+
+def test_presigned_urls_share_their_cache_entry(static_server, source):
+    first = source.fetch(url(static_server, "shoe_2.jpg", "?X-Amz-Signature=aaa&X-Amz-Expires=60&version=3"))
+    second = source.fetch(url(static_server, "shoe_2.jpg", "?X-Amz-Signature=bbb&X-Amz-Expires=60&version=3"))
+    assert first == second
+    assert source.metrics.counters["image_downloads"] == 1
+    assert source.metrics.counters["image_cache_hits"] == 1
+    # Another value of a parameter that is not a signature is another image
+    source.fetch(url(static_server, "shoe_2.jpg", "?X-Amz-Signature=ccc&version=4"))
+    assert source.metrics.counters["image_downloads"] == 2
+
+
+def test_eviction_keeps_the_cache_under_its_size(static_server, tmp_path):
+    source = RemoteImageSource("http://label-studio.invalid", "fake", cache_dir=str(tmp_path / "cache"),
+                               cache_max_mb=2500 / (1024 * 1024))
+    try:
+        paths = [source.fetch(url(static_server, "shoe_{}.jpg".format(index))) for index in range(5)]
+        assert source.cache.total_bytes <= source.cache.max_bytes
+        # The two most recently used images are kept
+        assert [os.path.exists(path) for path in paths] == [False, False, False, True, True]
+        assert source.cache.get(url(static_server, "shoe_0.jpg")) is None
+    finally:
+        source.close()
@@ -0,0 +1,66 @@
+import threading
+from label_studio_sdk import Client
+from utils.journal import RunJournal
+from utils.spool import OPEN_SUFFIX, SpoolWriter, SpoolConsumer, ready_segments, create_spool_writer_from_config
+from utils.uploader import PredictionUploader
+
+
+def make_consumer(ls_server, directory, logger):
+    project = Client(url=ls_server.url, api_key="fake").get_project(id=ls_server.project_id)
+    return SpoolConsumer(directory, PredictionUploader(project, logger), logger, poll_interval=0.1)
+
+
+def test_follow_consumer_stops(tmp_path, ls_server, logger):
+    consumer = make_consumer(ls_server, str(tmp_path), logger).start()
+    consumer.stop(timeout=5)
+    assert not consumer.thread.is_alive()
+
+
+def test_follow_drain_returns_once_stopped(tmp_path, ls_server, logger):
+    writer = SpoolWriter(str(tmp_path), ls_server.project_id, logger, segment_size=5)
+    for task_id in range(1, 11):
+        writer.add(task_id, {"result": [{"value": {"text": ["x"]}}]})
+    consumer = make_consumer(ls_server, str(tmp_path), logger)
+    # As `lsllm push --follow` does, in another thread stopped on Ctrl-C
+    thread = threading.Thread(target=consumer.drain, kwargs={"follow": True})
+    thread.start()
+    consumer.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert ready_segments(str(tmp_path)) == []
+    assert ls_server.predicted_tasks() == 10
+
+
+def test_open_segment_is_recovered(tmp_path, logger):
+    journal = RunJournal(str(tmp_path / "journal.sqlite"))
+    path = tmp_path / ("{:020d}-1{}".format(1, OPEN_SUFFIX))
+    lines = ['{{"project": 1, "task": {}, "result": []}}\n'.format(task_id) for task_id in (1, 2)]
+    # The last line was cut by the interruption
+    path.write_text("".join(lines) + '{"project": 1, "task": 3, "res')
+    SpoolWriter(str(tmp_path), 1, logger, journal=journal)
+    assert not path.exists()
+    segments = ready_segments(str(tmp_path))
+    assert len(segments) == 1
+    with open(segments[0], encoding="utf-8") as f:
+        assert f.readlines() == lines
+    assert journal.load_states() == {1: "spooled", 2: "spooled"}
+
+
+def test_spooled_does_not_override_uploaded(tmp_path):
+    journal = RunJournal(str(tmp_path / "journal.sqlite"))
+    journal.record(1, "parsed")
+    journal.record(1, "uploaded")
+    journal.record(1, "spooled")
+    journal.record(2, "spooled")
+    assert journal.load_states() == {1: "uploaded", 2: "spooled"}
+
+
+def test_no_backpressure_without_consumer(tmp_path, logger):
+    config = {"project_id": 1, "spool_dir": str(tmp_path), "spool_segment_size": 1, "spool_max_pending_mb": 0.0001}
+    writer = create_spool_writer_from_config(config, logger, consumer=False)
+    # As with `annotate --no-push`, the spool exceeds the limit and nothing pushes it
+    thread = threading.Thread(target=lambda: [writer.add(task_id, {"result": []}) for task_id in range(1, 11)])
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert len(ready_segments(str(tmp_path))) == 10
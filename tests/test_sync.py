@@ -0,0 +1,37 @@
+import json
+from utils.sync import IncrementalSync
+
+
+def committed_mark(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["high_water_mark"]
+
+
+def make_sync(tmp_path) -> IncrementalSync:
+    sync = IncrementalSync(str(tmp_path / "sync.json"), "v1")
+    sync.started = "2026-01-02T10:00:00.000Z"
+    sync.select({"id": 1, "updated_at": "2026-01-02T09:30:12.345678Z"})
+    sync.select({"id": 2, "updated_at": "2026-01-02T09:10:05.000000Z"})
+    sync.select({"id": 3, "updated_at": "2026-01-02T09:50:00.000000Z"})
+    return sync
+
+
+def test_commit_moves_the_mark_once_every_task_is_finished(tmp_path, logger):
+    sync = make_sync(tmp_path)
+    sync.commit(logger, {1, 2, 3})
+    assert committed_mark(sync.path) == "2026-01-02T10:00:00.000Z"
+    assert IncrementalSync(sync.path, "v1").mark == "2026-01-02T10:00:00.000Z"
+
+
+def test_commit_holds_the_mark_before_the_oldest_unfinished_task(tmp_path, logger):
+    sync = make_sync(tmp_path)
+    sync.commit(logger, {1})
+    # The changed-task filter is strictly after the mark, task 2 is selected again
+    assert committed_mark(sync.path) == "2026-01-02T09:10:04.000Z"
+
+
+def test_commit_keeps_the_mark_without_update_time(tmp_path, logger):
+    sync = make_sync(tmp_path)
+    sync.select({"id": 4})
+    sync.commit(logger, {1, 2, 3})
+    assert not (tmp_path / "sync.json").exists()
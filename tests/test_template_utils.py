@@ -0,0 +1,47 @@
+import os
+import json
+import pytest
+from benchmarks.bench_end_to_end import ROOT
+from benchmarks.bench_template import legacy_parse
+from prompts import Prompt_3
+from utils.template_utils import ATTRIBUTE_MAPPING, CompiledTemplate, load_template
+
+TEMPLATE_PATH = os.path.join(ROOT, "result_templates", "project_4_result_template.json")
+
+OUTPUT = {"Function": "boots", "Type": "ankle boots", "Main Color": "black", "Sub Color": ["brown", "white"],
+          "Upper Structure": "leather", "Closure Type": "laces", "Toe Shape": "round", "Heel Type": "block"}
+
+
+def test_compiled_template_matches_the_previous_builder():
+    with open(TEMPLATE_PATH) as f:
+        raw_template = json.load(f)
+    prompt = Prompt_3(model="fake", origin="test")
+    output = json.dumps(OUTPUT)
+    assert prompt.parse(output, load_template(TEMPLATE_PATH)) == legacy_parse(output, raw_template, "test")
+    # The template is not modified by filling it
+    with open(TEMPLATE_PATH) as f:
+        assert json.load(f) == raw_template
+
+
+def test_missing_attribute_raises():
+    template = load_template(TEMPLATE_PATH)
+    with pytest.raises(ValueError, match="Heel Type"):
+        template.fill({key: value for key, value in OUTPUT.items() if key != "Heel Type"}, "test")
+    with pytest.raises(ValueError):
+        template.fill([OUTPUT], "test")
+
+
+def test_multi_digit_answers():
+    mapping = dict(ATTRIBUTE_MAPPING, Material="answer9", Season="answer10")
+    template = {"result": [{"id": str(index), "from_name": "answer{}".format(index), "to_name": "q{}".format(index),
+                            "type": "textarea", "value": {"text": [""]}} for index in range(1, 11)]}
+    values = dict(OUTPUT, Material="suede", Season="winter")
+    # Keys in another order than the results, the positional mapping depended on it
+    filled = CompiledTemplate(template, mapping).fill(dict(reversed(list(values.items()))), "test")
+    texts = {result["from_name"]: result["value"]["text"][0] for result in filled["result"]}
+    assert texts["answer1"] == "boots"
+    assert texts["answer4"] == "brown, white"
+    assert texts["answer9"] == "suede"
+    assert texts["answer10"] == "winter"
+    with pytest.raises(ValueError, match="answer10"):
+        CompiledTemplate({"result": template["result"][:9]}, mapping)
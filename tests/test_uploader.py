@@ -0,0 +1,40 @@
+import pytest
+from label_studio_sdk import Client
+from utils.uploader import PredictionUploader
+
+
+def prediction(text: str) -> dict:
+    return {"result": [{"from_name": "color", "to_name": "image", "type": "textarea", "value": {"text": [text]}}]}
+
+
+@pytest.fixture
+def uploader(ls_server, logger):
+    project = Client(url=ls_server.url, api_key="fake").get_project(id=ls_server.project_id)
+    return PredictionUploader(project, logger, batch_size=4)
+
+
+def test_task_added_twice_before_the_flush_gets_one_prediction(uploader, ls_server):
+    uploader.add(1, prediction("red"))
+    uploader.add(2, prediction("red"))
+    uploader.add(1, prediction("blue"))
+    uploader.flush()
+    stored = sorted((p["task"], p["result"][0]["value"]["text"][0]) for p in ls_server.predictions.values())
+    assert stored == [(1, "blue"), (2, "red")]
+    assert uploader.stats["created"] == 2
+
+
+def test_failed_creates_are_counted(uploader, ls_server):
+    ls_server.writes_down = True
+    for task_id in range(1, 6):
+        uploader.add(task_id, prediction("red"))
+    uploader.flush()
+    assert uploader.stats["failed"] == 5 and uploader.stats["created"] == 0
+    assert ls_server.predictions == {}
+
+    # The predictions that were not stored are sent again
+    ls_server.writes_down = False
+    for task_id in range(1, 6):
+        uploader.add(task_id, prediction("red"))
+    uploader.flush()
+    assert uploader.stats["created"] == 5
+    assert ls_server.predicted_tasks() == 5
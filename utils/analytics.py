@@ -0,0 +1,201 @@
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from .template_utils import ATTRIBUTE_MAPPING, LABEL_SEPARATOR
+from .convert_utils import QUESTION_KEYS
+
+
+OTHER_LABEL = "<other>"
+
+
+def schema_vocabularies(schema: dict, mapping: dict = None) -> dict:
+    """Label vocabulary of each question from the JSON schema of a prompt (e.g. Prompt_3().schema)
+
+    Args:
+        schema (dict): JSON schema of the model output
+        mapping (dict): attribute -> from_name ("answerN"), defaults to ATTRIBUTE_MAPPING
+
+    Returns:
+        dict: question ("qN") -> list of labels
+    """
+    vocabularies = {}
+    for attribute, from_name in (mapping or ATTRIBUTE_MAPPING).items():
+        prop = schema["properties"][attribute]
+        labels = prop.get("items", prop).get("enum", [])
+        vocabularies[from_name.replace("answer", "q")] = list(labels)
+    return vocabularies
+
+
+def encode_answers(values: pd.Series, labels: list):
+    """Encode comma-joined label sets as codes into a boolean matrix of the distinct answers.
+    Only the distinct strings are split, so the cost depends on the number of distinct answers
+    rather than on the number of rows.
+
+    Args:
+        values (pd.Series): comma-joined labels, NaN/None for missing answers
+        labels (list): vocabulary, labels outside of it are counted as OTHER_LABEL
+
+    Returns:
+        tuple: (code of each row, -1 for missing answers; n_distinct x (len(labels) + 1) boolean matrix)
+    """
+    codes, uniques = pd.factorize(values)
+    index = {label: i for i, label in enumerate(labels)}
+    unique_hot = np.zeros((len(uniques), len(labels) + 1), dtype=bool)
+    for row, value in enumerate(uniques):
+        for label in str(value).split(LABEL_SEPARATOR):
+            label = label.strip()
+            if label:
+                unique_hot[row, index.get(label, len(labels))] = True
+    return codes, unique_hot
+
+
+def answer_pairs(df: pd.DataFrame, question: str, labels: list):
+    """Distinct (prediction, annotation) pairs of a question, over the rows where both are present.
+    Every metric is computed once per distinct pair and weighted by its number of rows.
+
+    Returns:
+        tuple: (mask of the compared rows, pair index of each compared row, row count of each pair,
+                prediction matrix of the pairs, annotation matrix of the pairs)
+    """
+    predicted_codes, predicted_hot = encode_answers(df["{}_prediction".format(question)], labels)
+    annotated_codes, annotated_hot = encode_answers(df["{}_annotation".format(question)], labels)
+    mask = (predicted_codes >= 0) & (annotated_codes >= 0)
+    n_annotated = max(len(annotated_hot), 1)
+    pair_ids = predicted_codes[mask].astype(np.int64) * n_annotated + annotated_codes[mask]
+    inverse, pairs = pd.factorize(pair_ids)
+    counts = np.bincount(inverse, minlength=len(pairs))
+    return mask, inverse, counts, predicted_hot[pairs // n_annotated], annotated_hot[pairs % n_annotated]
+
+
+class AgreementAnalysis:
+    """
+        Agreement between the predictions and the annotations of a flattened export.
+        The answers of each question are encoded once, as distinct (prediction, annotation) pairs,
+        every metric is then computed on the pairs and weighted or gathered back to the rows with NumPy.
+
+        Args:
+            df (pd.DataFrame): flattened annotations (see flatten_task())
+            vocabularies (dict): question -> labels, see schema_vocabularies()
+    """
+    def __init__(self, df: pd.DataFrame, vocabularies: dict):
+        self.df = df
+        self.vocabularies = vocabularies
+        self.questions = [question for question in QUESTION_KEYS if question in vocabularies]
+        self.pairs = {question: answer_pairs(df, question, vocabularies[question]) for question in self.questions}
+        self._rows = None
+
+    def row_agreement(self) -> pd.DataFrame:
+        """Exact match and Jaccard index of the label sets of each row and question
+
+        Returns:
+            pd.DataFrame: qN_exact and qN_jaccard columns, NaN where the prediction or the annotation is missing
+        """
+        if self._rows is not None:
+            return self._rows
+        columns = {}
+        for question in self.questions:
+            mask, inverse, _, predicted, annotated = self.pairs[question]
+            intersection = (predicted & annotated).sum(axis=1)
+            union = (predicted | annotated).sum(axis=1)
+            jaccard = np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+            exact = (predicted == annotated).all(axis=1).astype(float)
+            for name, values in (("exact", exact), ("jaccard", jaccard)):
+                column = np.full(len(self.df), np.nan)
+                column[mask] = values[inverse]
+                columns["{}_{}".format(question, name)] = column
+        self._rows = pd.DataFrame(columns, index=self.df.index)
+        return self._rows
+
+    def agreement_by(self, by=None) -> pd.DataFrame:
+        """Mean exact match and Jaccard index of each question, overall or per group
+
+        Args:
+            by (str | list): column(s) to group by, e.g. "prediction_origin" or "completed_by"
+
+        Returns:
+            pd.DataFrame: one row per group, with its number of rows
+        """
+        agreement = self.row_agreement()
+        if by is None:
+            summary = agreement.mean().to_frame("all").T
+            summary["rows"] = len(self.df)
+            return summary
+        keys = [self.df[column] for column in ([by] if isinstance(by, str) else by)]
+        grouped = agreement.groupby(keys, dropna=False)
+        summary = grouped.mean()
+        summary["rows"] = grouped.size()
+        return summary
+
+    def label_metrics(self, question: str) -> pd.DataFrame:
+        """Precision, recall, F1 and support of each label of a question
+
+        Returns:
+            pd.DataFrame: one row per label (and OTHER_LABEL)
+        """
+        _, _, counts, predicted, annotated = self.pairs[question]
+        tp = counts @ (predicted & annotated)
+        fp = counts @ (predicted & ~annotated)
+        fn = counts @ (~predicted & annotated)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = tp / (tp + fp)
+            recall = tp / (tp + fn)
+            f1 = 2 * precision * recall / (precision + recall)
+        return pd.DataFrame({"precision": precision, "recall": recall, "f1": f1, "support": tp + fn,
+                             "predicted": tp + fp}, index=self.vocabularies[question] + [OTHER_LABEL])
+
+    def confusion_matrix(self, question: str) -> pd.DataFrame:
+        """Label co-occurrence matrix of a question: cell (i, j) counts the rows where label i was predicted
+        and label j was annotated. For single-label answers this is the usual confusion matrix.
+
+        Returns:
+            pd.DataFrame: predicted labels as rows, annotated labels as columns
+        """
+        _, _, counts, predicted, annotated = self.pairs[question]
+        matrix = predicted.T.astype(np.int64) @ (annotated * counts[:, None])
+        names = self.vocabularies[question] + [OTHER_LABEL]
+        return pd.DataFrame(matrix, index=pd.Index(names, name="predicted"), columns=pd.Index(names, name="annotated"))
+
+    def report(self, by: list = ()) -> dict:
+        """Full report: overall and per-group agreement, per-label metrics and confusion matrices
+
+        Returns:
+            dict: JSON-serializable report
+        """
+        to_records = lambda frame: json.loads(frame.reset_index().to_json(orient="records"))
+        return {
+            "overall": to_records(self.agreement_by()),
+            "by": {column: to_records(self.agreement_by(column)) for column in by},
+            "labels": {question: to_records(self.label_metrics(question)) for question in self.questions},
+            "confusion": {question: json.loads(self.confusion_matrix(question).to_json()) for question in self.questions},
+        }
+
+
+def read_flattened(path: str) -> pd.DataFrame:
+    """Read a flattened export written as CSV, JSONL or Parquet"""
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    if path.endswith(".jsonl"):
+        return pd.read_json(path, lines=True)
+    return pd.read_csv(path, low_memory=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Agreement between the predictions and the annotations of a flattened export")
+    parser.add_argument("input", type=str, help="Flattened export (.csv, .jsonl or .parquet), see utils/convert_utils.py")
+    parser.add_argument("--by", type=str, action="append", help="Break the agreement down by this column (e.g. prediction_origin, completed_by)", default=[])
+    parser.add_argument("--output", type=str, help="Write the full report as JSON", default=None)
+    args = parser.parse_args()
+
+    from prompts import Prompt_3
+    vocabularies = schema_vocabularies(Prompt_3().schema)
+    analysis = AgreementAnalysis(read_flattened(args.input), vocabularies)
+
+    pd.set_option("display.width", 200)
+    print(analysis.agreement_by().T)
+    for column in args.by:
+        print(analysis.agreement_by(column))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(analysis.report(args.by), f, indent=2)
+        print("Saved the report to: {}".format(args.output))
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import logging
+import openai
+from tqdm import tqdm
+from .pipeline import log_first_prediction, prefetch_images
+from .uploader import PredictionUploader
+from .journal import RunJournal
+from .metrics import stage_timer
+from .sharding import config_shard_path
+
+
+# Limits of a single Batch API input file
+MAX_REQUESTS_PER_SHARD = 50000
+MAX_BYTES_PER_SHARD = 200 * 1024 * 1024
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def write_batch_shards(prompt, tasks, batch_dir: str,
+                       max_requests: int = MAX_REQUESTS_PER_SHARD, max_bytes: int = MAX_BYTES_PER_SHARD) -> list:
+    """Render the request of every task into JSONL shards for the Batch API
+
+    Args:
+        prompt: Prompt object
+        tasks: iterable of (task_id, image_path) pairs
+        batch_dir (str): directory to write the shards to
+        max_requests (int): maximum number of requests per shard
+        max_bytes (int): maximum size of a shard in bytes
+
+    Returns:
+        list: paths to the shards
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    shard_paths = []
+    shard = None
+    n_requests, n_bytes = 0, 0
+
+    for task_id, image_path in tqdm(prefetch_images(prompt, tasks)):
+        line = json.dumps({
+            "custom_id": str(task_id),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": prompt.build_request(image_path)
+        }) + "\n"
+        line = line.encode("utf-8")
+        if len(line) > max_bytes:
+            raise ValueError("The request of task {} does not fit in a batch shard".format(task_id))
+
+        # Start a new shard when the current one is full
+        if shard is None or n_requests >= max_requests or n_bytes + len(line) > max_bytes:
+            if shard is not None:
+                shard.close()
+            shard_paths.append(os.path.join(batch_dir, "shard_{:04d}.jsonl".format(len(shard_paths))))
+            shard = open(shard_paths[-1], "wb")
+            n_requests, n_bytes = 0, 0
+
+        shard.write(line)
+        n_requests += 1
+        n_bytes += len(line)
+
+    if shard is not None:
+        shard.close()
+    return shard_paths
+
+
+def submit_batches(client: openai.Client, shard_paths: list, logger: logging.Logger) -> list:
+    """Upload the shards and create one batch per shard
+
+    Returns:
+        list: batch ids
+    """
+    batch_ids = []
+    for shard_path in shard_paths:
+        with open(shard_path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h"
+        )
+        logger.info("Submitted {} as batch {}".format(shard_path, batch.id))
+        batch_ids.append(batch.id)
+    return batch_ids
+
+
+def wait_for_batches(client: openai.Client, batch_ids: list, poll_interval: float, logger: logging.Logger) -> list:
+    """Poll the batches until all of them reach a final status
+
+    Returns:
+        list: batch objects in their final status
+    """
+    pending = list(batch_ids)
+    finished = {}
+    while pending:
+        for batch_id in list(pending):
+            batch = client.batches.retrieve(batch_id)
+            if batch.status in FINAL_STATUSES:
+                logger.info("Batch {} {} ({} requests, {} failed)".format(
+                    batch_id, batch.status, batch.request_counts.total, batch.request_counts.failed))
+                finished[batch_id] = batch
+                pending.remove(batch_id)
+        if pending:
+            time.sleep(poll_interval)
+    return [finished[batch_id] for batch_id in batch_ids]
+
+
+def iter_batch_outputs(client: openai.Client, batch, logger: logging.Logger, journal: RunJournal = None):
+    """Download the output file of a batch and yield the model output of each task.
+    The failed requests are logged and journaled as failed.
+
+    Yields:
+        tuple: (task_id, output)
+    """
+    def failed(record: dict, error):
+        logger.error("Batch request for task {} failed: {}".format(record.get("custom_id"), error))
+        if journal is not None and record.get("custom_id") is not None:
+            journal.record(int(record["custom_id"]), "failed", error=str(error))
+
+    def records(file_id: str):
+        for line in client.files.content(file_id).text.splitlines():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                logger.error("Invalid line in the batch file {}: {}".format(file_id, e))
+
+    if batch.error_file_id:
+        for record in records(batch.error_file_id):
+            failed(record, record.get("error"))
+
+    if not batch.output_file_id:
+        return
+
+    for record in records(batch.output_file_id):
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            failed(record, record.get("error") or response.get("body"))
+            continue
+        try:
+            output = response["body"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            failed(record, "No output in the response: {}: {}".format(type(e).__name__, e))
+            continue
+        yield int(record["custom_id"]), output
+
+
+def run_batch(prompt, client: openai.Client, uploader: PredictionUploader, tasks,
+              template: dict, config: dict, logger: logging.Logger, journal: RunJournal = None):
+    """Pre-annotate the tasks through the OpenAI Batch API
+
+    The ids of the submitted batches are stored in `batch_dir`, running again with
+    the same directory resumes polling instead of submitting the requests again.
+    Once their results are uploaded, the ids are archived and the next run submits
+    the current tasks.
+
+    Args:
+        prompt: Prompt object
+        client (openai.Client): OpenAI client
+        uploader (PredictionUploader): uploader of the predictions to Label Studio
+        tasks: iterable of (task_id, image_path) pairs
+        template (dict): result template
+        config (dict): configuration dictionary
+        logger (logging.Logger): logger
+        journal (RunJournal): journal recording the state of each task
+    """
+    batch_dir = config_shard_path(config, config.get("batch_dir", "./batches/project_{}".format(config["project_id"])))
+    state_file = os.path.join(batch_dir, "batches.json")
+
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            batch_ids = json.load(f)
+        logger.info("Resuming {} submitted batches from {}".format(len(batch_ids), state_file))
+    else:
+        logger.info("Writing the batch requests to {} ...".format(batch_dir))
+        shard_paths = write_batch_shards(prompt, tasks, batch_dir,
+                                         config.get("batch_max_requests", MAX_REQUESTS_PER_SHARD),
+                                         config.get("batch_max_bytes", MAX_BYTES_PER_SHARD))
+        batch_ids = submit_batches(client, shard_paths, logger)
+        with open(state_file, "w") as f:
+            json.dump(batch_ids, f)
+
+    batches = wait_for_batches(client, batch_ids, config.get("batch_poll_interval", 60), logger)
+
+    logger.info("Uploading the batch results to Label Studio ...")
+    index = 0
+    for batch in batches:
+        for task_id, output in tqdm(iter_batch_outputs(client, batch, logger, journal)):
+            try:
+                with stage_timer(prompt.metrics, "parse"):
+                    # Repaired locally, the attributes that are still missing are not queried again
+                    output, _ = prompt.validate(output)
+                    prediction = prompt.parse(output, template)
+            except Exception as e:
+                if prompt.metrics is not None:
+                    prompt.metrics.record_error(e)
+                    prompt.metrics.count("tasks_failed")
+                logger.error("Error in parsing the output of task {}!".format(task_id))
+                logger.error(type(e))
+                if journal is not None:
+                    journal.record(task_id, "failed", output=output, error="{}: {}".format(type(e).__name__, e))
+                continue
+            if prompt.metrics is not None:
+                prompt.metrics.count("tasks_parsed")
+            if journal is not None:
+                journal.record(task_id, "parsed", output=output)
+            if index == 0:
+                log_first_prediction(logger, prompt, output, prediction)
+            uploader.add(task_id, prediction)
+            index += 1
+    uploader.flush()
+    # The batches are finished, they must not be resumed by the next run
+    archive = os.path.join(batch_dir, "batches.{}.done.json".format(time.strftime("%Y%m%d-%H%M%S")))
+    os.replace(state_file, archive)
+    logger.info("Batch results uploaded, batch ids archived to {}".format(archive))
@@ -0,0 +1,127 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+CACHE_MODES = ("read", "write", "off")
+
+
+def hash_file(path: str) -> hashlib.sha256:
+    """Hash the content of a file
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        hashlib.sha256: hash object, can be updated with more data
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest
+
+
+class ResponseCache:
+    """
+        Persistent cache of LLM responses stored in SQLite.
+        When the total size of the stored responses exceeds `max_bytes`, the least
+        recently used entries are evicted.
+
+        Modes:
+            read:  serve responses from the cache, store the new ones
+            write: always query the model, refresh the stored responses
+            off:   do not use the cache
+    """
+    def __init__(self, path: str, max_bytes: int = 1 << 30, mode: str = "read"):
+        if mode not in CACHE_MODES:
+            raise ValueError("Unsupported cache mode {}! Expected one of {}".format(mode, CACHE_MODES))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, output TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str):
+        """Get the stored response, None on a miss or when reading is disabled"""
+        if self.mode != "read":
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT output FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return row[0]
+
+    def put(self, key: str, output: str):
+        """Store a response and evict the least recently used ones if the cache is full"""
+        if self.mode == "off" or output is None:
+            return
+        size = len(output.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, output, size, time.time()))
+            self.total_bytes += size
+            self._evict()
+            self.conn.commit()
+
+    def delete(self, key: str):
+        """Remove a response, e.g. when it could not be parsed"""
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= old[0]
+                self.conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def create_cache_from_config(config: dict):
+    """Create the response cache from the configuration
+
+    Args:
+        config (dict): configuration dictionary
+
+    Returns:
+        ResponseCache: the cache, None if it is turned off
+    """
+    mode = config.get("cache", "off")
+    if mode == "off":
+        return None
+    return ResponseCache(
+        path=config.get("cache_path", "./cache/responses.sqlite"),
+        max_bytes=int(config.get("cache_max_mb", 1024) * 1024 * 1024),
+        mode=mode
+    )
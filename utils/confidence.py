@@ -0,0 +1,58 @@
+import json
+import math
+
+
+def value_spans(text: str) -> dict:
+    """Character span of the value of each top-level property of a JSON object
+
+    Args:
+        text (str): JSON object, as returned by the model
+
+    Returns:
+        dict: property -> (start, end) of its value in `text`
+    """
+    decoder = json.JSONDecoder()
+    spans = {}
+
+    def skip(i, characters=" \t\n\r"):
+        while i < len(text) and text[i] in characters:
+            i += 1
+        return i
+
+    i = skip(text.index("{") + 1)
+    while i < len(text) and text[i] != "}":
+        key, i = decoder.raw_decode(text, i)
+        i = skip(skip(i) + 1)  # ":"
+        start = i
+        _, i = decoder.raw_decode(text, i)
+        spans[key] = (start, i)
+        i = skip(i, " \t\n\r,")
+    return spans
+
+
+def attribute_confidences(text: str, tokens: list) -> dict:
+    """Confidence of the model in the value of each top-level property of its JSON output: the
+    probability of the tokens of the value, i.e. exp of the sum of their logprobs
+
+    Args:
+        text (str): JSON object returned by the model
+        tokens (list): logprobs of the output tokens (`choices[0].logprobs.content`), objects or dicts
+            with a `token` and a `logprob`
+
+    Returns:
+        dict: property -> confidence in [0, 1]
+    """
+    # Character span of each token, tokens are concatenated into the text
+    token_spans = []
+    offset = 0
+    for token in tokens:
+        token = token if isinstance(token, dict) else {"token": token.token, "logprob": token.logprob}
+        token_spans.append((offset, offset + len(token["token"]), token["logprob"]))
+        offset += len(token["token"])
+
+    confidences = {}
+    for key, (start, end) in value_spans(text).items():
+        logprob = sum(token_logprob for token_start, token_end, token_logprob in token_spans
+                      if token_start < end and token_end > start)
+        confidences[key] = math.exp(logprob)
+    return confidences
@@ -1,6 +1,7 @@
+import csv
 import json
-import copy
-import pandas as pd
+import argparse
+from .template_utils import ATTRIBUTE_MAPPING, compile_template
 
 
 def remove_first_and_last_line(text: str) -> str:
@@ -27,13 +28,7 @@ def check_json_valid(json_data: dict) -> bool:
     Returns:
         bool: whether the json is valid
     """
-    keys = [
-        "Function", "Type", "Main Color", "Sub Color", "Upper Structure", "Closure Type", "Toe Shape", "Heel Type"
-    ]
-    for key in keys:
-        if key not in json_data.keys():
-            return False
-    return True
+    return isinstance(json_data, dict) and all(key in json_data for key in ATTRIBUTE_MAPPING)
     
 
 def convert_gpt2labelstudio(data: str, orig_template: list) -> dict:
@@ -48,111 +43,144 @@ def convert_gpt2labelstudio(data: str, orig_template: list) -> dict:
     """
     pruned_response = remove_first_and_last_line(data)
     json_response = json.loads(pruned_response)
-    json_response = json_response[0]
-    if not check_json_valid:
-        return TypeError("The JSON format is incorrect!")
+    if isinstance(json_response, list):
+        json_response = json_response[0]
+    if not check_json_valid(json_response):
+        raise TypeError("The JSON format is incorrect!")
     
-    template = copy.deepcopy(orig_template)
-    
-    for result in template["result"]:
-        if result["from_name"] == "answer1":
-            result["value"]["text"] = [", ".join(json_response["Function"])]
-        elif result["from_name"] == "answer2":
-            result["value"]["text"] = [", ".join(json_response["Type"])]
-        elif result["from_name"] == "answer3":
-            result["value"]["text"] = [", ".join(json_response["Main Color"])]
-        elif result["from_name"] == "answer4":
-            result["value"]["text"] = [", ".join(json_response["Sub Color"])]
-        elif result["from_name"] == "answer5":
-            result["value"]["text"] = [", ".join(json_response["Upper Structure"])]
-        elif result["from_name"] == "answer6":
-            result["value"]["text"] = [", ".join(json_response["Closure Type"])]
-        elif result["from_name"] == "answer7":
-            result["value"]["text"] = [", ".join(json_response["Toe Shape"])]
-        elif result["from_name"] == "answer8":
-            result["value"]["text"] = [", ".join(json_response["Heel Type"])]
-        else:
-            continue
-        result["origin"] = "ChatGPT"
-    
-    return template
+    return compile_template(orig_template).fill(json_response, "ChatGPT")
 
 
-def flatten_annotation_json(input_json_path, output_csv_path=None, output_json_path=None):
+# Questions of the labeling interface ("to_name" of the results)
+QUESTION_KEYS = ["q1", "q2", "q3", "q4", "q5", "q6", "q7", "q8"]
+
+FLAT_COLUMNS = [
+    "task_id", "image_path", "file_name", "annotation_id", "completed_by",
+    "annotation_created_at", "annotation_updated_at", "parent_prediction_id", "prediction_created_at",
+    "prediction_origin"
+] + [f"{q_key}_{suffix}" for q_key in QUESTION_KEYS for suffix in ("prediction", "annotation", "changed")]
+
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
+
+
+def result_texts(results: list) -> dict:
+    """Map the "to_name" of each textarea/choices result to its first value"""
+    texts = {}
+    for item in results or []:
+        value = item.get("value", {})
+        values = value.get("text") or value.get("choices")
+        if values:
+            texts[item.get("to_name")] = values[0]
+    return texts
+
+
+def select_prediction(prediction, prediction_id=None):
+    """Prediction of an annotation, exports store it either as a dict or as a list of predictions
+
+    Args:
+        prediction (dict | list): "prediction" of an annotation, or "predictions" of a task
+        prediction_id (int): id of the prediction the annotation started from, if known
+
+    Returns:
+        dict: the prediction, {} if there is none
     """
-    Converts a nested annotation JSON (e.g., from Label Studio) into a flat tabular format.
+    if isinstance(prediction, dict):
+        return prediction
+    if not prediction:
+        return {}
+    for candidate in prediction:
+        if isinstance(candidate, dict) and candidate.get("id") == prediction_id:
+            return candidate
+    return prediction[0] if isinstance(prediction[0], dict) else {}
+
+
+def prediction_origin(prediction: dict):
+    """Model version of a prediction, or the origin stored in its results, to tell the prompts/models apart"""
+    if prediction.get("model_version"):
+        return prediction["model_version"]
+    for item in prediction.get("result") or []:
+        if item.get("origin") not in (None, "prediction", "prediction-changed", "manual"):
+            return item["origin"]
+    return None
+
+
+def flatten_task(task: dict) -> list:
+    """Flatten an exported task into one row per annotation, or a single row without annotation fields
+    if the task has not been annotated
+
+    Args:
+        task (dict): task of a Label Studio JSON export
 
-    Parameters:
-        input_json_path (str): Path to the input JSON file.
-        output_csv_path (str): Optional path to save the output as CSV.
-        output_json_path (str): Optional path to save the output as JSON.
-    
     Returns:
-        pd.DataFrame: Flattened annotations dataframe.
+        list: rows with the FLAT_COLUMNS keys
     """
-    # Define question-to-answer mapping
-    question_keys = {
-        "q1": "answer1",
-        "q2": "answer2",
-        "q3": "answer3",
-        "q4": "answer4",
-        "q5": "answer5",
-        "q6": "answer6",
-        "q7": "answer7",
-        "q8": "answer8"
-    }
-
-    # Load JSON
-    with open(input_json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    flattened_data = []
-
-    for task in data:
-        task_id = task["id"]
-        image_path = task.get("data", {}).get("image", "")
-        file_name = task.get("file_upload", "")
-
-        # Assume one annotation per task
-        annotation = task.get("annotations", [])[0]
-        annotation_result = {item["to_name"]: item["value"]["text"][0] for item in annotation["result"]}
-
-        # Get prediction embedded inside annotation
-        prediction_result = {}
-        prediction_created_at = None
-        if "prediction" in annotation:
-            prediction_obj = annotation["prediction"]
-            prediction_created_at = prediction_obj.get("created_at")
-            if "result" in prediction_obj:
-                prediction_result = {item["to_name"]: item["value"]["text"][0] for item in prediction_obj["result"]}
-
-        # Create record
+    annotations = task.get("annotations") or [None]
+    rows = []
+    for annotation in annotations:
+        annotation = annotation or {}
+        # Get prediction embedded inside annotation, or the prediction of the task
+        prediction = select_prediction(annotation.get("prediction") or task.get("predictions"),
+                                       annotation.get("parent_prediction"))
+        prediction_result = result_texts(prediction.get("result"))
+        annotation_result = result_texts(annotation.get("result"))
+
         entry = {
-            "task_id": task_id,
-            "image_path": image_path,
-            "file_name": file_name,
-            "annotation_id": annotation["id"],
+            "task_id": task.get("id"),
+            "image_path": task.get("data", {}).get("image", ""),
+            "file_name": task.get("file_upload", ""),
+            "annotation_id": annotation.get("id"),
             "completed_by": annotation.get("completed_by"),
-            #"lead_time": annotation.get("lead_time"),
             "annotation_created_at": annotation.get("created_at"),
             "annotation_updated_at": annotation.get("updated_at"),
             "parent_prediction_id": annotation.get("parent_prediction"),
-            "prediction_created_at": prediction_created_at
+            "prediction_created_at": prediction.get("created_at"),
+            "prediction_origin": prediction_origin(prediction)
         }
 
         # Add Q&A comparisons
-        for q_key in question_keys:
+        for q_key in QUESTION_KEYS:
             pred_value = prediction_result.get(q_key)
             anno_value = annotation_result.get(q_key)
             changed = (pred_value != anno_value) if pred_value is not None and anno_value is not None else None
             entry[f"{q_key}_prediction"] = pred_value
             entry[f"{q_key}_annotation"] = anno_value
             entry[f"{q_key}_changed"] = changed
+        rows.append(entry)
+    return rows
+
+
+def iter_export_tasks(input_json_path: str):
+    """Parse the tasks of a Label Studio JSON export one at a time, without loading the whole file
 
-        flattened_data.append(entry)
+    Args:
+        input_json_path (str): path to the export (a JSON array of tasks)
+
+    Yields:
+        dict: task
+    """
+    import ijson
+    with open(input_json_path, "rb") as f:
+        yield from ijson.items(f, "item", use_float=True)
+
+
+def flatten_annotation_json(input_json_path, output_csv_path=None, output_json_path=None):
+    """
+    Converts a nested annotation JSON (e.g., from Label Studio) into a flat tabular format.
+    Use stream_flatten_export() for exports that do not fit in memory.
+
+    Parameters:
+        input_json_path (str): Path to the input JSON file.
+        output_csv_path (str): Optional path to save the output as CSV.
+        output_json_path (str): Optional path to save the output as JSON.
+    
+    Returns:
+        pd.DataFrame: Flattened annotations dataframe.
+    """
+    import pandas as pd
+    flattened_data = [row for task in iter_export_tasks(input_json_path) for row in flatten_task(task)]
 
     # Convert to DataFrame
-    df_flattened = pd.DataFrame(flattened_data)
+    df_flattened = pd.DataFrame(flattened_data, columns=FLAT_COLUMNS)
 
     # Save to CSV
     if output_csv_path:
@@ -168,10 +196,78 @@ def flatten_annotation_json(input_json_path, output_csv_path=None, output_json_p
     return df_flattened
 
 
+def _parquet_schema():
+    import pyarrow as pa
+    types = {"task_id": pa.int64(), "annotation_id": pa.int64(), "completed_by": pa.int64(),
+             "parent_prediction_id": pa.int64()}
+    fields = []
+    for column in FLAT_COLUMNS:
+        if column.endswith("_changed"):
+            fields.append(pa.field(column, pa.bool_()))
+        else:
+            fields.append(pa.field(column, types.get(column, pa.string())))
+    return pa.schema(fields)
+
+
+def stream_flatten_export(input_json_path: str, output_path: str, output_format: str = None,
+                          chunk_size: int = 10000) -> int:
+    """Flatten a Label Studio JSON export of any size with bounded memory.
+    Tasks are parsed incrementally and the rows are written in chunks of `chunk_size`.
+
+    Args:
+        input_json_path (str): path to the export
+        output_path (str): path to the output file
+        output_format (str): "csv", "jsonl" or "parquet", guessed from the extension of `output_path` if None
+        chunk_size (int): number of rows buffered before they are written
+
+    Returns:
+        int: number of rows written
+    """
+    output_format = output_format or output_path.rsplit(".", 1)[-1].lower()
+    if output_format not in EXPORT_FORMATS:
+        raise ValueError("Unsupported output format {}! Expected one of {}".format(output_format, EXPORT_FORMATS))
+
+    if output_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = _parquet_schema()
+        writer = pq.ParquetWriter(output_path, schema)
+        write_chunk = lambda rows: writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        close = writer.close
+    else:
+        f = open(output_path, "w", encoding="utf-8", newline="")
+        if output_format == "csv":
+            csv_writer = csv.DictWriter(f, fieldnames=FLAT_COLUMNS)
+            csv_writer.writeheader()
+            write_chunk = csv_writer.writerows
+        else:
+            write_chunk = lambda rows: f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+        close = f.close
+
+    n_rows = 0
+    chunk = []
+    try:
+        for task in iter_export_tasks(input_json_path):
+            chunk.extend(flatten_task(task))
+            if len(chunk) >= chunk_size:
+                write_chunk(chunk)
+                n_rows += len(chunk)
+                chunk = []
+        if chunk:
+            write_chunk(chunk)
+            n_rows += len(chunk)
+    finally:
+        close()
+    return n_rows
+
+
 if __name__ == "__main__":
-    df = flatten_annotation_json(
-        input_json_path="E:\\Code\\KAIST\\DEAL-ShoeDesign\\ChatGPT_ShoeGen\\annotations\\original_annotations\\project-6-at-2025-04-15-15-01-8521cc11.json",
-        output_csv_path="E:\\Code\\KAIST\\DEAL-ShoeDesign\\ChatGPT_ShoeGen\\annotations\\formatted_annotations\\project-6-at-2025-04-15-15-01-8521cc11.csv",
-        output_json_path="E:\\Code\\KAIST\\DEAL-ShoeDesign\\ChatGPT_ShoeGen\\annotations\\formatted_annotations\\project-6-at-2025-04-15-15-01-8521cc11.json"
-    )
+    parser = argparse.ArgumentParser(description="Flatten a Label Studio JSON export into CSV, JSONL or Parquet")
+    parser.add_argument("input", type=str, help="Label Studio JSON export")
+    parser.add_argument("output", type=str, help="Output file (.csv, .jsonl or .parquet)")
+    parser.add_argument("--format", type=str, choices=EXPORT_FORMATS, help="Output format, guessed from the extension by default", default=None)
+    parser.add_argument("--chunk_size", type=int, help="Rows written at a time", default=10000)
+    args = parser.parse_args()
 
+    n_rows = stream_flatten_export(args.input, args.output, args.format, args.chunk_size)
+    print(f"Saved {n_rows} rows to: {args.output}")
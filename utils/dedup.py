@@ -0,0 +1,339 @@
+import os
+import sqlite3
+import threading
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageOps
+from .metrics import stage_timer
+
+
+HASH_ALGORITHMS = ("dhash", "phash")
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """Difference hash: whether each pixel of a small grayscale thumbnail is brighter than its right neighbour"""
+    pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: Image.Image, hash_size: int = 8) -> int:
+    """Perceptual hash: whether each low frequency of the DCT of a grayscale thumbnail is above their median"""
+    size = hash_size * 4
+    pixels = np.asarray(image.convert("L").resize((size, size), Image.LANCZOS), dtype=np.float64)
+    # DCT-II matrix, the 2D transform is C @ X @ C.T
+    n = np.arange(size)
+    dct = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    low = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    return bits_to_int(low > np.median(low))
+
+
+def bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of different bits of two hashes"""
+    return bin(a ^ b).count("1")
+
+
+def hash_image(job: tuple):
+    """Hash an image in a worker process
+
+    Args:
+        job (tuple): (image path, algorithm, hash size)
+
+    Returns:
+        int: the hash, None if the image cannot be read
+    """
+    image_path, algorithm, hash_size = job
+    try:
+        with Image.open(image_path) as image:
+            image = ImageOps.exif_transpose(image)
+            return (phash if algorithm == "phash" else dhash)(image, hash_size)
+    except Exception:
+        return None
+
+
+class BKTree:
+    """
+        Burkhard-Keller tree over the Hamming distance. A search within radius r only descends
+        into the children whose distance to the node is within r of the distance to the query
+        (triangle inequality), instead of comparing the query with every stored hash.
+    """
+    def __init__(self):
+        # Node: [hash, items, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, item):
+        """Store an item under its hash"""
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> list:
+        """Items whose hash is within `radius` bits of `value`
+
+        Returns:
+            list: (distance, item) pairs, closest first
+        """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found += [(distance, item) for item in node[1]]
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return sorted(found, key=lambda pair: pair[0])
+
+
+class ImageHasher:
+    """
+        Perceptual hashes of local images, computed in a process pool and stored in SQLite by path,
+        size and modification time, so that later runs only hash the new or modified images.
+
+        Args:
+            path (str): path to the SQLite file of the hashes
+            algorithm (str): "dhash" or "phash"
+            hash_size (int): side of the hash, the hashes have hash_size ** 2 bits
+            workers (int): number of hashing processes
+    """
+    def __init__(self, path: str, algorithm: str = "dhash", hash_size: int = 8, workers: int = 4):
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError("Unsupported hash algorithm {}! Expected one of {}".format(algorithm, HASH_ALGORITHMS))
+        self.path = path
+        self.algorithm = algorithm
+        self.hash_size = hash_size
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+        self.conn.commit()
+
+    def _key(self, image_path: str):
+        """Key of the stored hash, None if the image is not a local file"""
+        try:
+            stat = os.stat(image_path)
+        except (OSError, ValueError):
+            return None
+        return "{}:{}:{}:{}:{}".format(self.algorithm, self.hash_size, os.path.abspath(image_path),
+                                       stat.st_size, stat.st_mtime_ns)
+
+    def hash_images(self, image_paths: list, metrics=None) -> dict:
+        """Hashes of the images, read from the store or computed in the process pool
+
+        Args:
+            image_paths (list): paths to the images
+            metrics (RunMetrics): optional run metrics
+
+        Returns:
+            dict: image path -> hash, None for the images that could not be hashed
+        """
+        keys = {image_path: self._key(image_path) for image_path in image_paths}
+        hashes = {image_path: None for image_path in image_paths}
+        with self.lock:
+            for image_path, key in keys.items():
+                if key is None:
+                    continue
+                row = self.conn.execute("SELECT hash FROM hashes WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    hashes[image_path] = int(row[0], 16)
+        missing = [image_path for image_path, key in keys.items() if key is not None and hashes[image_path] is None]
+        if metrics is not None:
+            metrics.count("dedup_hashes_stored", sum(value is not None for value in hashes.values()))
+            metrics.count("dedup_hashes_computed", len(missing))
+        if not missing:
+            return hashes
+
+        with stage_timer(metrics, "dedup_hash"):
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            jobs = [(image_path, self.algorithm, self.hash_size) for image_path in missing]
+            computed = list(self.pool.map(hash_image, jobs, chunksize=max(1, len(jobs) // (4 * self.workers))))
+        with self.lock:
+            for image_path, value in zip(missing, computed):
+                hashes[image_path] = value
+                if value is not None:
+                    self.conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?)", (keys[image_path], format(value, "x")))
+            self.conn.commit()
+        return hashes
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        with self.lock:
+            self.conn.close()
+
+
+class Deduplicator:
+    """
+        Groups the near-duplicate images of a project so that only one representative per group is
+        queried, and fans the result of the representative out to the other tasks of its group.
+        The task stream is processed in chunks: the images of a chunk are hashed together, then each
+        image joins the group of the closest representative within `threshold` bits, found with a
+        BK-tree, or becomes a new representative.
+
+        The results of the last `max_results` representatives are kept in memory for the duplicates
+        found later. The result of an older representative is read again with `reload` (e.g. from
+        the journal of the run), or the duplicate is queried itself.
+
+        Args:
+            hasher (ImageHasher): hashes of the images, shared by the projects
+            threshold (int): maximum Hamming distance between an image and its representative
+            chunk_size (int): number of tasks hashed together
+            metrics (RunMetrics): optional run metrics
+            max_results (int): number of results of representatives kept in memory
+    """
+    def __init__(self, hasher: ImageHasher, threshold: int = 4, chunk_size: int = 256, metrics=None,
+                 max_results: int = 10000):
+        self.hasher = hasher
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.max_results = max_results
+        self.tree = BKTree()
+        self.lock = threading.Lock()
+        # Representative task id -> duplicate task ids waiting for its result
+        self.members = defaultdict(list)
+        # Representative task id -> (output, prediction, error) once it is resolved, least recently used first
+        self.results = OrderedDict()
+        # Representatives whose result was evicted from `results`
+        self.evicted = set()
+        # Optional callable: representative task id -> (output, prediction, error), None if it cannot be read
+        self.reload = None
+        # (task_id, output, prediction, error) of duplicates found after their representative was resolved
+        self.late = []
+        self.stats = {"representatives": 0, "duplicates": 0}
+
+    def representatives(self, tasks):
+        """Filter the task stream down to the representatives of the groups of near-duplicates
+
+        Args:
+            tasks: iterable of (task_id, image_path) pairs
+
+        Yields:
+            tuple: (task_id, image_path) of the tasks to query
+        """
+        chunk = []
+        for task in tasks:
+            chunk.append(task)
+            if len(chunk) >= self.chunk_size:
+                yield from self._group(chunk)
+                chunk = []
+        yield from self._group(chunk)
+
+    def _group(self, chunk: list):
+        hashes = self.hasher.hash_images([image_path for _, image_path in chunk], self.metrics) if chunk else {}
+        for task_id, image_path in chunk:
+            value = hashes[image_path]
+            matches = self.tree.search(value, self.threshold) if value is not None else []
+            if not matches:
+                if value is not None:
+                    self.tree.add(value, task_id)
+                self.stats["representatives"] += 1
+                yield task_id, image_path
+                continue
+            representative = matches[0][1]
+            with self.lock:
+                result = self.results.get(representative)
+                if result is not None:
+                    self.results.move_to_end(representative)
+                elif representative not in self.evicted:
+                    self.members[representative].append(task_id)
+            if result is None and representative in self.evicted:
+                result = self.reload(representative) if self.reload is not None else None
+                if result is None:
+                    # The result of the representative is gone, the duplicate is queried instead
+                    self.stats["representatives"] += 1
+                    yield task_id, image_path
+                    continue
+                if self.metrics is not None:
+                    self.metrics.count("dedup_reloads")
+            self.stats["duplicates"] += 1
+            if self.metrics is not None:
+                self.metrics.count("dedup_duplicates")
+            if result is not None:
+                with self.lock:
+                    self.late.append((task_id,) + result)
+
+    def resolve(self, task_id: int, output: str, prediction: dict, error: str) -> list:
+        """Record the result of a representative
+
+        Returns:
+            list: ids of the duplicates of the representative found so far, they share its result
+        """
+        with self.lock:
+            self.results[task_id] = (output, prediction, error)
+            while len(self.results) > self.max_results:
+                evicted, _ = self.results.popitem(last=False)
+                self.evicted.add(evicted)
+            return self.members.pop(task_id, [])
+
+    def drain(self) -> list:
+        """(task_id, output, prediction, error) of the duplicates found after their representative was resolved"""
+        with self.lock:
+            late, self.late = self.late, []
+        return late
+
+
+def create_hasher_from_config(config: dict):
+    """Create the image hasher of the deduplication stage from the configuration
+
+    Args:
+        config (dict): configuration dictionary
+
+    Returns:
+        ImageHasher: the hasher, None if deduplication is turned off
+    """
+    dedup_config = config.get("dedup")
+    if not dedup_config:
+        return None
+    return ImageHasher(
+        path=dedup_config.get("hash_path", "./cache/image_hashes.sqlite"),
+        algorithm=dedup_config.get("algorithm", "dhash"),
+        hash_size=dedup_config.get("hash_size", 8),
+        workers=dedup_config.get("workers", 4)
+    )
+
+
+def create_deduplicator_from_config(config: dict, hasher: ImageHasher, metrics=None):
+    """Create the deduplication stage of a project
+
+    Args:
+        config (dict): configuration dictionary of the project
+        hasher (ImageHasher): image hasher shared by the projects, None if deduplication is turned off
+        metrics (RunMetrics): optional run metrics of the project
+
+    Returns:
+        Deduplicator: the deduplication stage, None if it is turned off
+    """
+    if hasher is None:
+        return None
+    dedup_config = config.get("dedup") or {}
+    return Deduplicator(hasher, threshold=dedup_config.get("threshold", 4),
+                        chunk_size=dedup_config.get("chunk_size", 256), metrics=metrics,
+                        max_results=dedup_config.get("max_results", 10000))
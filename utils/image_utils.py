@@ -1,7 +1,148 @@
-from PIL import Image
+from PIL import Image, ImageOps
+import io
+import math
 import base64
+import mimetypes
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import stage_timer
+
+
+DETAIL_LEVELS = ("low", "high", "auto")
 
 
 def encode_image(image_path):
     with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
\ No newline at end of file
+        return base64.b64encode(image_file.read()).decode("utf-8")
+
+
+def image_mime_type(image_path: str) -> str:
+    """Guess the MIME type of an image from its file name, defaults to JPEG"""
+    mime_type, _ = mimetypes.guess_type(image_path)
+    if mime_type is None or not mime_type.startswith("image/"):
+        return "image/jpeg"
+    return mime_type
+
+
+def preprocess_image(image_path: str, max_side: int = None, quality: int = 85):
+    """Downscale the image so that its longest side is at most `max_side` and re-encode it as JPEG.
+    JPEG images that are already small enough are returned untouched.
+
+    Args:
+        image_path (str): path to the image
+        max_side (int): maximum length of the longest side, None to keep the size
+        quality (int): JPEG quality
+
+    Returns:
+        tuple: (image bytes, MIME type, width, height)
+    """
+    with Image.open(image_path) as image:
+        width, height = image.size
+        needs_resize = max_side is not None and max(width, height) > max_side
+        if image.format == "JPEG" and not needs_resize:
+            with open(image_path, "rb") as f:
+                return f.read(), "image/jpeg", width, height
+
+        image = ImageOps.exif_transpose(image)
+        if needs_resize:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode != "RGB":
+            # Flatten the transparency on a white background
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            image = image.convert("RGBA")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        return buffer.getvalue(), "image/jpeg", image.width, image.height
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """Estimate the number of input tokens billed for an image by the GPT-4o family
+
+    Args:
+        width (int): image width
+        height (int): image height
+        detail (str): "low", "high" or "auto" (estimated as "high")
+
+    Returns:
+        int: number of image tokens
+    """
+    if detail == "low":
+        return 85
+    # Fit in 2048 x 2048, then scale the shortest side down to 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 170 * tiles + 85
+
+
+class ImagePreprocessor:
+    """
+        Resize and re-encode images in a thread pool ahead of the query stage.
+        The encoded images are kept in a small LRU so that retries do not encode them again.
+    """
+    def __init__(self, max_side: int = None, quality: int = 85, detail: str = "auto",
+                 workers: int = 4, capacity: int = 64):
+        if detail not in DETAIL_LEVELS:
+            raise ValueError("Unsupported detail {}! Expected one of {}".format(detail, DETAIL_LEVELS))
+        self.max_side = max_side
+        self.quality = quality
+        self.detail = detail
+        self.capacity = capacity
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = OrderedDict()
+        self.lock = threading.Lock()
+        # Optional RunMetrics timing the encoding of each image
+        self.metrics = None
+
+    @property
+    def settings(self) -> dict:
+        return {"max_side": self.max_side, "quality": self.quality, "detail": self.detail}
+
+    def _encode(self, image_path: str) -> str:
+        with stage_timer(self.metrics, "encode"):
+            data, mime_type, _, _ = preprocess_image(image_path, self.max_side, self.quality)
+        return "data:{};base64,{}".format(mime_type, base64.b64encode(data).decode("utf-8"))
+
+    def submit(self, image_path: str):
+        """Start preprocessing an image, returns the future of its data URL"""
+        with self.lock:
+            if image_path in self.futures:
+                self.futures.move_to_end(image_path)
+                return self.futures[image_path]
+            future = self.executor.submit(self._encode, image_path)
+            self.futures[image_path] = future
+            while len(self.futures) > self.capacity:
+                self.futures.popitem(last=False)
+            return future
+
+    def image_content(self, image_path: str) -> dict:
+        """Image part of a chat completion message"""
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": self.submit(image_path).result(),
+                "detail": self.detail
+            }
+        }
+
+
+def create_preprocessor_from_config(config: dict):
+    """Create the image preprocessor from the configuration
+
+    Args:
+        config (dict): configuration dictionary
+
+    Returns:
+        ImagePreprocessor: the preprocessor, None if images are sent as they are
+    """
+    preprocessing = config.get("image_preprocessing")
+    if not preprocessing:
+        return None
+    return ImagePreprocessor(**preprocessing)
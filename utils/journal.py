@@ -0,0 +1,174 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from .sharding import config_shard_path, check_resume_shards
+
+
+TASK_STATES = ("queried", "parsed", "spooled", "uploaded", "failed")
+
+
+class RunJournal:
+    """
+        Journal of the state of each task in a run, stored in SQLite.
+        Records are buffered in memory and written in batches, every `flush_every` records
+        or `flush_interval` seconds, so that the journal does not slow down the query stage.
+    """
+    def __init__(self, path: str, flush_every: int = 500, flush_interval: float = 2.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The push command may record uploads from another process
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "task_id INTEGER PRIMARY KEY, state TEXT NOT NULL, output TEXT, error TEXT, updated_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def reset(self):
+        """Forget the previous run"""
+        with self.lock:
+            self.buffer = []
+            self.conn.execute("DELETE FROM tasks")
+            self.conn.commit()
+
+    def record(self, task_id: int, state: str, output: str = None, error: str = None):
+        """Record the new state of a task, the stored output is kept if `output` is None
+
+        Args:
+            task_id (int): task id
+            state (str): one of "queried", "parsed", "spooled", "uploaded" or "failed"
+            output (str): raw output of the model
+            error (str): reason of the failure
+        """
+        if state not in TASK_STATES:
+            raise ValueError("Unsupported task state {}!".format(state))
+        with self.lock:
+            self.buffer.append((task_id, state, output, error, time.time()))
+            if len(self.buffer) < self.flush_every and time.monotonic() - self.last_flush < self.flush_interval:
+                return
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.conn.executemany(
+                "INSERT INTO tasks (task_id, state, output, error, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(task_id) DO UPDATE SET "
+                # A spool consumer may journal the upload before the writer journals the spooled segment
+                "state = CASE WHEN tasks.state = 'uploaded' AND excluded.state = 'spooled' THEN tasks.state "
+                "ELSE excluded.state END, "
+                "output = COALESCE(excluded.output, tasks.output), error = excluded.error, "
+                "updated_at = excluded.updated_at",
+                self.buffer
+            )
+            self.conn.commit()
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def load_states(self) -> dict:
+        """Map each recorded task to its last state"""
+        self.flush()
+        with self.lock:
+            return dict(self.conn.execute("SELECT task_id, state FROM tasks"))
+
+    def output(self, task_id: int):
+        """Stored raw output of the model for a task, None if there is none"""
+        with self.lock:
+            self._flush()
+            row = self.conn.execute("SELECT output FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+
+def journal_state_counts(path: str) -> dict:
+    """Number of tasks in each state of a journal, read without locking it (e.g. from another process)
+
+    Args:
+        path (str): path to the journal
+
+    Returns:
+        dict: state -> number of tasks, empty if the journal does not exist yet
+    """
+    if not os.path.exists(path):
+        return {}
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True, timeout=5)
+    try:
+        return dict(conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+
+def resume_tasks(tasks, journal: RunJournal, prompt, template: dict, uploader, logger: logging.Logger):
+    """Skip the tasks completed in the previous run, uploaded or spooled. Tasks that were parsed but
+    not uploaded are uploaded again from their stored output without querying the model.
+
+    Args:
+        tasks: iterable of (task_id, image_path) pairs
+        journal (RunJournal): journal of the previous run
+        prompt: Prompt object
+        template (dict): result template
+        uploader (PredictionUploader): uploader of the predictions to Label Studio
+        logger (logging.Logger): logger
+
+    Yields:
+        tuple: (task_id, image_path) of the tasks that still need to be queried
+    """
+    states = journal.load_states()
+    logger.info("Resuming the previous run: {} tasks uploaded or spooled, {} to upload, {} failed".format(
+        sum(state in ("uploaded", "spooled") for state in states.values()),
+        sum(state in ("queried", "parsed") for state in states.values()),
+        sum(state == "failed" for state in states.values())))
+
+    for task_id, image_path in tasks:
+        state = states.get(task_id)
+        if state in ("uploaded", "spooled"):
+            continue
+        if state in ("queried", "parsed"):
+            output = journal.output(task_id)
+            try:
+                prediction = prompt.parse(output, template)
+            except Exception:
+                yield task_id, image_path
+                continue
+            uploader.add(task_id, prediction)
+            continue
+        yield task_id, image_path
+
+
+def create_journal_from_config(config: dict, resume: bool) -> RunJournal:
+    """Open the journal of the project (one per shard), it is cleared unless the run is resumed
+
+    Args:
+        config (dict): configuration dictionary
+        resume (bool): whether the previous run is resumed
+
+    Returns:
+        RunJournal: the journal
+    """
+    path = config.get("journal_path", "./journals/project_{}.sqlite".format(config["project_id"]))
+    if resume:
+        check_resume_shards(path, config.get("shard_count", 1))
+    journal = RunJournal(config_shard_path(config, path))
+    if not resume:
+        journal.reset()
+    return journal
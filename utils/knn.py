@@ -0,0 +1,698 @@
+import os
+import json
+import logging
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageOps
+from .metrics import stage_timer
+from .sharding import shard_of
+from .template_utils import LABEL_SEPARATOR
+
+
+EMBEDDERS = ("handcrafted", "onnx")
+# Below this number of annotated images the index is searched exhaustively
+IVF_MIN_SIZE = 4096
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Scale the rows to unit length, so that dot products are cosine similarities"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def background_color(rgb: np.ndarray) -> np.ndarray:
+    """Median color of the border of an image, product photos have a plain background"""
+    return np.median(np.concatenate([rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]]), axis=0)
+
+
+def foreground_mask(rgb: np.ndarray, background: np.ndarray) -> np.ndarray:
+    """Pixels that differ from the background color, all of them if almost none does"""
+    mask = np.abs(rgb - background).sum(axis=2) > 40
+    return mask if mask.mean() >= 0.02 else np.ones(mask.shape, dtype=bool)
+
+
+def handcrafted_features(image: Image.Image, size: int = 64) -> np.ndarray:
+    """Cheap global descriptor of an image, computed on the square around the object so that it does
+    not depend on its position: a joint HSV histogram of the object colors, a 4x4 grid of gradient
+    orientation histograms (shape), a 8x8 silhouette and a 4x4 color thumbnail (where the colors are),
+    each block normalized
+
+    Returns:
+        np.ndarray: float32 vector of unit length
+    """
+    image = image.convert("RGB")
+    thumbnail = np.asarray(image.resize((size, size), Image.BILINEAR), dtype=np.int32)
+    background = background_color(thumbnail)
+    rows, columns = np.nonzero(foreground_mask(thumbnail, background))
+    # Square around the object, in the coordinates of the image, padded with the background
+    scale_x, scale_y = image.width / size, image.height / size
+    top, bottom = (rows.min() - 1) * scale_y, (rows.max() + 2) * scale_y
+    left, right = (columns.min() - 1) * scale_x, (columns.max() + 2) * scale_x
+    side = max(bottom - top, right - left)
+    center_x, center_y = (left + right) / 2, (top + bottom) / 2
+    box = tuple(int(round(value)) for value in (center_x - side / 2, center_y - side / 2,
+                                                  center_x + side / 2, center_y + side / 2))
+    square = Image.new("RGB", (box[2] - box[0], box[3] - box[1]), tuple(int(value) for value in background))
+    square.paste(image.crop((max(box[0], 0), max(box[1], 0), min(box[2], image.width), min(box[3], image.height))),
+                 (max(-box[0], 0), max(-box[1], 0)))
+    image = square.resize((size, size), Image.BILINEAR)
+    foreground = foreground_mask(np.asarray(image, dtype=np.int32), background)
+
+    hsv = np.asarray(image.convert("HSV"), dtype=np.int32)
+    # 12 hues x 3 saturations x 3 values
+    bins = (hsv[..., 0] * 12 // 256) * 9 + (hsv[..., 1] * 3 // 256) * 3 + hsv[..., 2] * 3 // 256
+    color = np.bincount(bins[foreground], minlength=108).astype(np.float64)
+
+    gray = np.asarray(image.convert("L"), dtype=np.float64)
+    gy, gx = np.gradient(gray)
+    magnitude = np.hypot(gx, gy)
+    orientation = ((np.arctan2(gy, gx) % np.pi) * 8 / np.pi).astype(np.int32).clip(0, 7)
+    cell = size // 4
+    cells = (np.arange(size)[:, None] // cell) * 4 + np.arange(size)[None, :] // cell
+    shape = np.bincount((cells * 8 + orientation).ravel(), weights=magnitude.ravel(), minlength=128)
+
+    silhouette = foreground.reshape(8, size // 8, 8, size // 8).mean(axis=(1, 3)).ravel()
+    silhouette = silhouette - silhouette.mean()
+    color_layout = np.asarray(image.resize((4, 4), Image.BOX), dtype=np.float64).ravel() / 255
+
+    # Square roots of the histograms (Hellinger kernel), then the blocks are weighted equally
+    blocks = [np.sqrt(color / max(color.sum(), 1e-12)), np.sqrt(shape / max(shape.sum(), 1e-12)),
+              silhouette, color_layout - color_layout.mean()]
+    vector = np.concatenate([block / max(np.linalg.norm(block), 1e-12) for block in blocks])
+    return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+
+def embed_image(job: tuple):
+    """Embed an image in a worker process
+
+    Args:
+        job (tuple): (image path, thumbnail size)
+
+    Returns:
+        np.ndarray: the embedding, None if the image cannot be read
+    """
+    image_path, size = job
+    try:
+        with Image.open(image_path) as image:
+            return handcrafted_features(ImageOps.exif_transpose(image), size)
+    except Exception:
+        return None
+
+
+class HandcraftedEmbedder:
+    """
+        Color, shape and layout descriptors computed with NumPy in a process pool. No model is needed,
+        it separates well the attributes that show in the colors and the silhouette of the images.
+
+        Args:
+            size (int): side of the thumbnail the features are computed on
+            workers (int): number of processes
+    """
+    def __init__(self, size: int = 64, workers: int = 4):
+        self.size = size
+        self.workers = workers
+        self.pool = None
+
+    def describe(self) -> dict:
+        """Parameters of the embeddings, an index can only be searched with the embedder it was built with"""
+        return {"embedder": "handcrafted", "size": self.size}
+
+    def embed(self, image_paths: list, metrics=None) -> tuple:
+        """Embed images
+
+        Args:
+            image_paths (list): paths to the images
+            metrics (RunMetrics): optional run metrics
+
+        Returns:
+            tuple: (n x d float32 matrix of unit rows, boolean mask of the images that could be read)
+        """
+        if not image_paths:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=bool)
+        with stage_timer(metrics, "knn_embed"):
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            jobs = [(image_path, self.size) for image_path in image_paths]
+            vectors = list(self.pool.map(embed_image, jobs, chunksize=max(1, len(jobs) // (4 * self.workers))))
+        return stack_embeddings(vectors)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+class OnnxEmbedder:
+    """
+        Embeddings of a small image model exported to ONNX (e.g. the image tower of CLIP or a
+        MobileNet without its classifier), run on CPU with onnxruntime. Requires `pip install onnxruntime`.
+
+        Args:
+            model_path (str): path to the .onnx model, taking NCHW float images
+            input_size (int): side of the input images
+            batch_size (int): images per inference
+            mean (list): per-channel mean of the normalization, ImageNet by default
+            std (list): per-channel standard deviation of the normalization
+    """
+    def __init__(self, model_path: str, input_size: int = 224, batch_size: int = 32,
+                 mean: list = (0.485, 0.456, 0.406), std: list = (0.229, 0.224, 0.225)):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx embedder requires onnxruntime, install it with `pip install onnxruntime`")
+        self.model_path = model_path
+        self.input_size = input_size
+        self.batch_size = batch_size
+        self.mean = np.asarray(mean, dtype=np.float32).reshape(1, 3, 1, 1)
+        self.std = np.asarray(std, dtype=np.float32).reshape(1, 3, 1, 1)
+        self.session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def describe(self) -> dict:
+        return {"embedder": "onnx", "model": os.path.basename(self.model_path), "input_size": self.input_size}
+
+    def _load(self, image_path: str):
+        try:
+            with Image.open(image_path) as image:
+                image = ImageOps.exif_transpose(image).convert("RGB").resize((self.input_size,) * 2, Image.BICUBIC)
+                return np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255
+        except Exception:
+            return None
+
+    def embed(self, image_paths: list, metrics=None) -> tuple:
+        vectors = []
+        with stage_timer(metrics, "knn_embed"):
+            for start in range(0, len(image_paths), self.batch_size):
+                pixels = [self._load(image_path) for image_path in image_paths[start:start + self.batch_size]]
+                loaded = [array for array in pixels if array is not None]
+                outputs = iter([])
+                if loaded:
+                    batch = (np.stack(loaded) - self.mean) / self.std
+                    outputs = iter(self.session.run(None, {self.input_name: batch})[0].reshape(len(loaded), -1))
+                vectors += [None if array is None else next(outputs) for array in pixels]
+        return stack_embeddings(vectors)
+
+    def close(self):
+        pass
+
+
+def stack_embeddings(vectors: list) -> tuple:
+    """Matrix of unit embeddings, zero rows for the images that could not be embedded"""
+    dimension = next((len(vector) for vector in vectors if vector is not None), 0)
+    matrix = np.zeros((len(vectors), dimension), dtype=np.float32)
+    ok = np.array([vector is not None for vector in vectors], dtype=bool)
+    if ok.any():
+        matrix[ok] = normalize_rows(np.stack([vector for vector in vectors if vector is not None]).astype(np.float32))
+    return matrix, ok
+
+
+def spherical_kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Centroids of unit vectors (k-means on the cosine similarity), trained on a sample of at most 50k rows"""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), 50000), replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for index in range(n_lists):
+            members = sample[assignment == index]
+            if len(members):
+                centroids[index] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids.astype(np.float32)
+
+
+class VectorIndex:
+    """
+        On-disk index of the embeddings of the annotated images and of their labels, in a directory:
+
+            meta.json      embedder, attributes, answer vocabulary of each attribute, task ids
+            vectors.npy    n x d float32 embeddings, memory-mapped, ordered by inverted list
+            codes.npy      n x attributes int32 answer codes, -1 where the attribute was not annotated
+            centroids.npy  centroids of the inverted lists, offsets.npy their boundaries in vectors.npy
+
+        Large indexes are inverted-file (IVF) indexes: the embeddings are clustered with k-means and a
+        search only scans the `nprobe` lists closest to the query, read as contiguous slices of the
+        memory map. Below IVF_MIN_SIZE images there is a single list and the search is exact.
+
+        Args:
+            directory (str): directory of the index
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.codes = np.load(os.path.join(directory, "codes.npy"))
+        self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.attributes = self.meta["attributes"]
+        self.vocabularies = self.meta["vocabularies"]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @staticmethod
+    def write(directory: str, vectors: np.ndarray, codes: np.ndarray, task_ids: list, attributes: list,
+              vocabularies: dict, embedder: dict, n_lists: int = None):
+        """Build an index from the embeddings and answer codes of the annotated images
+
+        Args:
+            directory (str): directory of the index, overwritten
+            vectors (np.ndarray): n x d unit embeddings
+            codes (np.ndarray): n x len(attributes) answer codes, -1 for missing answers
+            task_ids (list): task id of each row
+            attributes (list): attributes of the model output
+            vocabularies (dict): attribute -> list of answers, codes index these lists
+            embedder (dict): description of the embedder (Embedder.describe())
+            n_lists (int): number of inverted lists, about sqrt(n) by default
+        """
+        os.makedirs(directory, exist_ok=True)
+        if n_lists is None:
+            n_lists = 1 if len(vectors) < IVF_MIN_SIZE else int(np.sqrt(len(vectors)))
+        if n_lists > 1:
+            centroids = spherical_kmeans(vectors, n_lists)
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+        else:
+            centroids = normalize_rows(vectors.mean(axis=0, keepdims=True)).astype(np.float32)
+            assignment = np.zeros(len(vectors), dtype=np.int64)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))])
+
+        stored = np.lib.format.open_memmap(os.path.join(directory, "vectors.npy"), mode="w+",
+                                           dtype=np.float32, shape=vectors.shape)
+        stored[:] = vectors[order]
+        stored.flush()
+        del stored
+        np.save(os.path.join(directory, "codes.npy"), codes[order].astype(np.int32))
+        np.save(os.path.join(directory, "centroids.npy"), centroids)
+        np.save(os.path.join(directory, "offsets.npy"), offsets)
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"embedder": embedder, "attributes": attributes, "vocabularies": vocabularies,
+                       "task_ids": [int(task_ids[row]) for row in order]}, f, ensure_ascii=False)
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: int = 8) -> tuple:
+        """Nearest annotated images of each query
+
+        Args:
+            queries (np.ndarray): q x d unit embeddings
+            k (int): number of neighbours
+            nprobe (int): number of inverted lists scanned per query
+
+        Returns:
+            tuple: (q x k cosine similarities, q x k rows of the index, -1 when there are fewer than k)
+        """
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(self.centroids) == 1:
+            scores = queries @ np.asarray(self.vectors).T
+            for index in range(len(queries)):
+                self._top(scores[index], np.arange(len(self)), k, similarities[index], rows[index])
+            return similarities, rows
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        # Each probed list is read once for all the queries probing it, as a contiguous slice of the
+        # memory map, and its best rows are merged into the k best of each query
+        for probe in np.unique(probes):
+            start, stop = self.offsets[probe], self.offsets[probe + 1]
+            if start == stop:
+                continue
+            probing = np.flatnonzero((probes == probe).any(axis=1))
+            scores = np.asarray(self.vectors[start:stop]) @ queries[probing].T
+            n = min(k, stop - start)
+            best = np.argpartition(-scores, n - 1, axis=0)[:n] if n < stop - start else np.arange(stop - start)[:, None].repeat(len(probing), axis=1)
+            merged_scores = np.concatenate([similarities[probing], np.take_along_axis(scores, best, axis=0).T], axis=1)
+            merged_rows = np.concatenate([rows[probing], best.T + start], axis=1)
+            order = np.argsort(-merged_scores, axis=1)[:, :k]
+            similarities[probing] = np.take_along_axis(merged_scores, order, axis=1)
+            rows[probing] = np.take_along_axis(merged_rows, order, axis=1)
+        return similarities, rows
+
+    @staticmethod
+    def _top(scores: np.ndarray, candidates: np.ndarray, k: int, similarities: np.ndarray, rows: np.ndarray):
+        n = min(k, len(scores))
+        best = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        similarities[:n] = scores[best]
+        rows[:n] = candidates[best]
+
+    def vote(self, similarities: np.ndarray, rows: np.ndarray, min_agreement: float = 0.9,
+             min_similarity: float = 0.8, min_votes: int = 3) -> list:
+        """Majority answer of the neighbours of each query, weighted by their similarity
+
+        Args:
+            similarities (np.ndarray): q x k similarities of the neighbours (VectorIndex.search())
+            rows (np.ndarray): q x k rows of the neighbours
+            min_agreement (float): weighted share of the neighbours that must give the answer
+            min_similarity (float): similarity of the nearest neighbour below which nothing is proposed
+            min_votes (int): minimum number of neighbours that annotated the attribute
+
+        Returns:
+            list: for each query, attribute -> (answer, agreement) of the attributes the neighbours agree on
+        """
+        proposals = []
+        for query_similarities, query_rows in zip(similarities, rows):
+            found = query_rows >= 0
+            proposal = {}
+            if found.any() and query_similarities[0] >= min_similarity:
+                weights = np.clip(query_similarities[found], 0, None).astype(np.float64)
+                codes = self.codes[query_rows[found]]
+                for column, attribute in enumerate(self.attributes):
+                    annotated = codes[:, column] >= 0
+                    total = weights[annotated].sum()
+                    if annotated.sum() < min_votes or total <= 0:
+                        continue
+                    votes = np.bincount(codes[annotated, column], weights=weights[annotated],
+                                        minlength=len(self.vocabularies[attribute]))
+                    best = int(np.argmax(votes))
+                    if votes[best] / total >= min_agreement:
+                        proposal[attribute] = (self.vocabularies[attribute][best], float(votes[best] / total))
+            proposals.append(proposal)
+        return proposals
+
+
+def answer_values(answer: str) -> list:
+    """Labels of an answer of a flattened export, in the list form of the model outputs"""
+    return [label.strip() for label in answer.split(LABEL_SEPARATOR) if label.strip()]
+
+
+class KnnLabeler:
+    """
+        Local pre-annotation tier: the images whose nearest annotated images agree on every attribute
+        get the majority answers as prediction without querying the model; the other images go on
+        to the prompt. The task stream is processed in chunks that are embedded together.
+
+        Args:
+            index (VectorIndex): index of the annotated images
+            embedder: HandcraftedEmbedder or OnnxEmbedder the index was built with
+            template (CompiledTemplate): result template of the project
+            origin (str): origin of the local predictions
+            k (int): number of neighbours
+            nprobe (int): number of inverted lists scanned per query
+            min_agreement (float): weighted share of the neighbours that must agree on each attribute
+            min_similarity (float): similarity of the nearest neighbour below which the image is queried
+            min_votes (int): minimum number of neighbours that annotated each attribute
+            chunk_size (int): number of tasks embedded together
+            metrics (RunMetrics): optional run metrics
+    """
+    def __init__(self, index: VectorIndex, embedder, template, origin: str = "knn", k: int = 5, nprobe: int = 8,
+                 min_agreement: float = 0.9, min_similarity: float = 0.8, min_votes: int = 3,
+                 chunk_size: int = 256, metrics=None):
+        if index.meta["embedder"] != embedder.describe():
+            raise ValueError("The index {} was built with {}, not with {}, rebuild it!".format(
+                index.directory, index.meta["embedder"], embedder.describe()))
+        self.index = index
+        self.embedder = embedder
+        self.template = template
+        self.origin = origin
+        self.k = k
+        self.nprobe = nprobe
+        self.min_agreement = min_agreement
+        self.min_similarity = min_similarity
+        self.min_votes = min_votes
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # (task_id, output, prediction, error) of the tasks labeled locally, not recorded yet
+        self.resolved = []
+        self.stats = {"local": 0, "queried": 0}
+
+    def unresolved(self, tasks):
+        """Label the tasks the neighbours agree on and filter the stream down to the others
+
+        Args:
+            tasks: iterable of (task_id, image_path) pairs
+
+        Yields:
+            tuple: (task_id, image_path) of the tasks to query
+        """
+        chunk = []
+        for task in tasks:
+            chunk.append(task)
+            if len(chunk) >= self.chunk_size:
+                yield from self._label(chunk)
+                chunk = []
+        yield from self._label(chunk)
+
+    def _label(self, chunk: list):
+        if not chunk:
+            return
+        vectors, ok = self.embedder.embed([image_path for _, image_path in chunk], self.metrics)
+        proposals = [{}] * len(chunk)
+        if ok.any():
+            with stage_timer(self.metrics, "knn_search"):
+                similarities, rows = self.index.search(vectors[ok], self.k, self.nprobe)
+                found = iter(self.index.vote(similarities, rows, self.min_agreement, self.min_similarity, self.min_votes))
+            proposals = [next(found) if readable else {} for readable in ok]
+        for (task_id, image_path), proposal in zip(chunk, proposals):
+            if len(proposal) < len(self.index.attributes):
+                self.stats["queried"] += 1
+                yield task_id, image_path
+                continue
+            values = {attribute: answer_values(answer) for attribute, (answer, _) in proposal.items()}
+            output = json.dumps(values, ensure_ascii=False)
+            self.stats["local"] += 1
+            if self.metrics is not None:
+                self.metrics.count("knn_resolved")
+            with self.lock:
+                self.resolved.append((task_id, output, self.template.fill(values, self.origin), None))
+
+    def drain(self) -> list:
+        """(task_id, output, prediction, error) of the tasks labeled locally since the last call"""
+        with self.lock:
+            resolved, self.resolved = self.resolved, []
+        return resolved
+
+
+def annotated_rows(df, mapping: dict = None):
+    """Latest annotation of each task of a flattened export, with the answers as attribute columns
+
+    Args:
+        df (pd.DataFrame): flattened export (see convert_utils.flatten_annotation_json)
+        mapping (dict): attribute -> from_name ("answerN"), defaults to ATTRIBUTE_MAPPING
+
+    Returns:
+        pd.DataFrame: task_id, image_path and one column per attribute, None where it was not annotated
+    """
+    from .template_utils import ATTRIBUTE_MAPPING
+    mapping = mapping or ATTRIBUTE_MAPPING
+    df = df[df["annotation_id"].notna()].sort_values(["task_id", "annotation_updated_at"], na_position="first")
+    df = df.drop_duplicates("task_id", keep="last")
+    columns = {"{}_annotation".format(from_name.replace("answer", "q")): attribute for attribute, from_name in mapping.items()}
+    rows = df[["task_id", "image_path"] + list(columns)].rename(columns=columns)
+    return rows.astype(object).where(rows.notna(), None).reset_index(drop=True)
+
+
+def local_image_paths(rows, config: dict, logger: logging.Logger) -> list:
+    """Local path of the image of each annotated task, remote images are downloaded into the image cache"""
+    from .label_studio_server import task_image_path
+    from .remote_images import create_image_source_from_config
+    tasks = [(int(task_id), task_image_path({"id": int(task_id), "data": {"image": image}}, config))
+             for task_id, image in zip(rows["task_id"], rows["image_path"])]
+    image_source = create_image_source_from_config(config)
+    if image_source is not None:
+        fetched = dict(image_source.fetch_tasks(tasks, logger))
+        return [fetched.get(task_id) for task_id, _ in tasks]
+    return [image_path for _, image_path in tasks]
+
+
+def encode_rows(rows, attributes: list) -> tuple:
+    """Answer codes of the annotated rows
+
+    Returns:
+        tuple: (n x len(attributes) int32 codes with -1 for missing answers, attribute -> list of answers)
+    """
+    codes = np.full((len(rows), len(attributes)), -1, dtype=np.int32)
+    vocabularies = {}
+    for column, attribute in enumerate(attributes):
+        answers = {}
+        for row, answer in enumerate(rows[attribute]):
+            if answer:
+                codes[row, column] = answers.setdefault(answer, len(answers))
+        vocabularies[attribute] = list(answers)
+    return codes, vocabularies
+
+
+def build_index(rows, image_paths: list, embedder, directory: str, logger: logging.Logger, chunk_size: int = 1024) -> VectorIndex:
+    """Embed the annotated images and write their index
+
+    Args:
+        rows (pd.DataFrame): annotated rows (annotated_rows())
+        image_paths (list): local path of the image of each row
+        embedder: HandcraftedEmbedder or OnnxEmbedder
+        directory (str): directory of the index
+        logger (logging.Logger): logger
+        chunk_size (int): images embedded at a time
+
+    Returns:
+        VectorIndex: the index
+    """
+    attributes = [column for column in rows.columns if column not in ("task_id", "image_path")]
+    chunks = [embedder.embed([path or "" for path in image_paths[start:start + chunk_size]])
+              for start in range(0, len(image_paths), chunk_size)]
+    vectors = np.concatenate([vectors for vectors, _ in chunks]) if chunks else np.zeros((0, 0), dtype=np.float32)
+    ok = np.concatenate([ok for _, ok in chunks]) if chunks else np.zeros(0, dtype=bool)
+    if not ok.any():
+        raise ValueError("None of the {} annotated images could be read!".format(len(rows)))
+    if not ok.all():
+        logger.warning("{} annotated images could not be read and are not indexed".format(int((~ok).sum())))
+    rows = rows[ok].reset_index(drop=True)
+    codes, vocabularies = encode_rows(rows, attributes)
+    VectorIndex.write(directory, vectors[ok], codes, list(rows["task_id"]), attributes, vocabularies, embedder.describe())
+    logger.info("Indexed {} annotated images in {}".format(len(rows), directory))
+    return VectorIndex(directory)
+
+
+def evaluate(rows, image_paths: list, embedder, directory: str, logger: logging.Logger, holdout: float = 0.2,
+             thresholds: list = (0.7, 0.8, 0.9, 1.0), k: int = 5, nprobe: int = 8, min_similarity: float = 0.8,
+             min_votes: int = 3) -> list:
+    """Label a held-out split of the annotated images from the index of the others and compare
+    the proposals with the annotations, for several agreement thresholds
+
+    Args:
+        rows (pd.DataFrame): annotated rows (annotated_rows())
+        image_paths (list): local path of the image of each row
+        embedder: HandcraftedEmbedder or OnnxEmbedder
+        directory (str): directory of the index of the training split
+        logger (logging.Logger): logger
+        holdout (float): share of the tasks held out, chosen from a stable hash of the task ids
+        thresholds (list): values of min_agreement to evaluate
+        k, nprobe, min_similarity, min_votes: parameters of the search and of the vote
+
+    Returns:
+        list: one report per threshold: share of the held-out images resolved locally, agreement of
+            the resolved images with their annotation overall and per attribute
+    """
+    held_out = np.array([shard_of(int(task_id), 1000) < holdout * 1000 for task_id in rows["task_id"]])
+    train_paths = [path for path, test in zip(image_paths, held_out) if not test]
+    index = build_index(rows[~held_out].reset_index(drop=True), train_paths, embedder, directory, logger)
+    test_rows = rows[held_out].reset_index(drop=True)
+    vectors, ok = embedder.embed([path or "" for path, test in zip(image_paths, held_out) if test])
+    similarities, rows_found = index.search(vectors[ok], k, nprobe)
+    truth = test_rows[ok].reset_index(drop=True)
+
+    reports = []
+    for threshold in thresholds:
+        proposals = index.vote(similarities, rows_found, threshold, min_similarity, min_votes)
+        resolved = [row for row, proposal in enumerate(proposals) if len(proposal) == len(index.attributes)]
+        report = {"min_agreement": threshold, "held_out": int(len(test_rows)),
+                  "resolved": len(resolved), "resolved_share": len(resolved) / max(1, len(test_rows)),
+                  "attributes": {}}
+        matches = []
+        for attribute in index.attributes:
+            pairs = [(proposals[row][attribute][0], truth[attribute][row]) for row in resolved if truth[attribute][row]]
+            correct = [answer == annotation for answer, annotation in pairs]
+            matches += correct
+            # Share of the held-out images whose attribute alone would be resolved, for a partial tier
+            covered = sum(attribute in proposal for proposal in proposals) / max(1, len(test_rows))
+            report["attributes"][attribute] = {"agreement": float(np.mean(correct)) if correct else None,
+                                               "covered_share": covered}
+        report["agreement"] = float(np.mean(matches)) if matches else None
+        report["exact_images"] = int(sum(all(proposals[row][attribute][0] == truth[attribute][row]
+                                             for attribute in index.attributes if truth[attribute][row])
+                                         for row in resolved))
+        reports.append(report)
+    return reports
+
+
+def create_embedder_from_config(config: dict):
+    """Create the image embedder of the kNN tier from the configuration
+
+    Args:
+        config (dict): configuration dictionary
+
+    Returns:
+        HandcraftedEmbedder | OnnxEmbedder: the embedder, None if the kNN tier is turned off
+    """
+    knn_config = config.get("knn")
+    if not knn_config:
+        return None
+    kind = knn_config.get("embedder", "handcrafted")
+    if kind not in EMBEDDERS:
+        raise ValueError("Unsupported embedder {}! Expected one of {}".format(kind, EMBEDDERS))
+    if kind == "onnx":
+        return OnnxEmbedder(knn_config["model_path"], input_size=knn_config.get("input_size", 224),
+                            batch_size=knn_config.get("batch_size", 32))
+    return HandcraftedEmbedder(size=knn_config.get("size", 64), workers=knn_config.get("workers", 4))
+
+
+def knn_index_directory(config: dict) -> str:
+    """Index directory of a project, "{project_id}" is replaced by its id"""
+    directory = (config.get("knn") or {}).get("index_dir", "./knn/project_{project_id}")
+    return directory.replace("{project_id}", str(config["project_id"]))
+
+
+def create_knn_labeler_from_config(config: dict, embedder, template, origin: str = None, metrics=None):
+    """Create the kNN tier of a project
+
+    Args:
+        config (dict): configuration dictionary of the project
+        embedder: embedder shared by the projects, None if the kNN tier is turned off
+        template (CompiledTemplate): result template of the project
+        origin (str): origin of the prompt, the local predictions are "{origin}/knn"
+        metrics (RunMetrics): optional run metrics of the project
+
+    Returns:
+        KnnLabeler: the kNN tier, None if it is turned off
+    """
+    if embedder is None:
+        return None
+    knn_config = config.get("knn") or {}
+    return KnnLabeler(VectorIndex(knn_index_directory(config)), embedder, template,
+                      origin="{}/knn".format(origin) if origin else "knn",
+                      k=knn_config.get("k", 5),
+                      nprobe=knn_config.get("nprobe", 8),
+                      min_agreement=knn_config.get("min_agreement", 0.9),
+                      min_similarity=knn_config.get("min_similarity", 0.8),
+                      min_votes=knn_config.get("min_votes", 3),
+                      chunk_size=knn_config.get("chunk_size", 256),
+                      metrics=metrics)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or evaluate the kNN index of the annotated images of a project")
+    parser.add_argument("action", choices=["build", "evaluate"])
+    parser.add_argument("export", type=str, help="Flattened export (.csv, .jsonl or .parquet), see utils/convert_utils.py")
+    parser.add_argument("--config", type=str, help="System config, for the `knn` section and the image storage", default="./configs/chat_gpt_40.yaml")
+    parser.add_argument("--project_id", type=int, help="Project of the export, overrides the configuration", default=None)
+    parser.add_argument("--holdout", type=float, help="Share of the tasks held out by evaluate", default=0.2)
+    parser.add_argument("--thresholds", type=float, nargs="+", help="Agreement thresholds compared by evaluate", default=[0.7, 0.8, 0.9, 1.0])
+    parser.add_argument("--output", type=str, help="Write the evaluation report as JSON", default=None)
+    args = parser.parse_args()
+
+    import yaml
+    from .analytics import read_flattened
+    with open(args.config) as stream:
+        config = yaml.safe_load(stream)
+    if args.project_id is not None:
+        config["project_id"] = args.project_id
+    config.setdefault("knn", {})
+    logger = logging.getLogger("Label Studio LLM tool")
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+    rows = annotated_rows(read_flattened(args.export), config.get("attribute_mapping"))
+    image_paths = local_image_paths(rows, config, logger)
+    # The embedding processes need the functions of the module, not of __main__
+    from utils.knn import create_embedder_from_config as create_embedder
+    embedder = create_embedder(config)
+    knn_config = config["knn"]
+    try:
+        if args.action == "build":
+            build_index(rows, image_paths, embedder, knn_index_directory(config), logger)
+        else:
+            reports = evaluate(rows, image_paths, embedder, knn_index_directory(config) + ".eval", logger,
+                               args.holdout, args.thresholds, knn_config.get("k", 5), knn_config.get("nprobe", 8),
+                               knn_config.get("min_similarity", 0.8), knn_config.get("min_votes", 3))
+            print("{:>10} {:>10} {:>10} {:>10}  {}".format("agreement", "resolved", "share", "accuracy", "per attribute"))
+            for report in reports:
+                print("{:>10.2f} {:>10} {:>10.1%} {:>10}  {}".format(
+                    report["min_agreement"], report["resolved"], report["resolved_share"],
+                    "-" if report["agreement"] is None else "{:.1%}".format(report["agreement"]),
+                    ", ".join("{} {}".format(attribute, "-" if stats["agreement"] is None else "{:.0%}".format(stats["agreement"]))
+                              for attribute, stats in report["attributes"].items())))
+            if args.output:
+                with open(args.output, "w") as f:
+                    json.dump(reports, f, indent=2)
+                print("Saved the report to: {}".format(args.output))
+    finally:
+        embedder.close()
@@ -1,9 +1,14 @@
 from label_studio_sdk import Client, Project
-import json
 import logging
-from tqdm import tqdm
 import os
+import json
 import yaml
+import queue
+import threading
+from .template_utils import load_template
+from .metrics import stage_timer
+from .remote_images import resolve_image_url, create_image_source_from_config
+from .sharding import shard_of
 
 
 def initialize_client(url: str, api_key: str) -> Client:
@@ -30,46 +35,173 @@ def update_prediction(project: Project ,prediction_id: int, prediction: dict):
     project.make_request("PATCH", "/api/predictions/{}".format(prediction_id), json=prediction)
     
 
-def setup(config: dict, logger: logging.Logger):
+def iter_tasks(project: Project, page_size: int = 100, prefetch_pages: int = 2, fields: str = "id,data",
+               metrics=None, filters: list = None):
+    """Page through the tasks of a project, only requesting the needed fields.
+    The next pages are downloaded in a background thread while the current one is processed.
+
+    With `filters`, only the matching tasks are requested, ordered by id. They are paged by id
+    (the next page starts after the last task received) instead of by page number, so that the tasks
+    leaving the filter while the run processes them, e.g. once they get a prediction, do not shift
+    the following pages.
+
+    Args:
+        project (Project): Label Studio project
+        page_size (int): number of tasks per page
+        prefetch_pages (int): maximum number of pages downloaded ahead
+        fields (str): comma-separated task fields to request
+        metrics (RunMetrics): optional metrics timing the download of each page
+        filters (list): Data Manager filter items, combined with "and"
+
+    Yields:
+        dict: task
+    """
+    pages = queue.Queue(maxsize=prefetch_pages)
+    stop = threading.Event()
+
+    def download():
+        page, last_id = 1, None
+        try:
+            while not stop.is_set():
+                params = {
+                    "project": project.id,
+                    "page": page,
+                    "page_size": page_size,
+                    # The predictions are only listed with all the fields
+                    "fields": "all" if "predictions" in fields.split(",") else "task_only",
+                    "include": fields
+                }
+                if filters is not None:
+                    items = list(filters)
+                    if last_id is not None:
+                        items.append({"filter": "filter:tasks:id", "operator": "greater", "type": "Number", "value": last_id})
+                    params["page"] = 1
+                    params["query"] = json.dumps({"filters": {"conjunction": "and", "items": items},
+                                                  "ordering": ["tasks:id"]})
+                with stage_timer(metrics, "ls_get_tasks"):
+                    response = project.make_request("GET", "/api/tasks", params=params, raise_exceptions=False)
+                # Label Studio answers 404 past the last page
+                if response.status_code == 404:
+                    break
+                response.raise_for_status()
+                tasks = response.json()
+                tasks = tasks["tasks"] if isinstance(tasks, dict) else tasks
+                if not tasks:
+                    break
+                pages.put(tasks)
+                page += 1
+                last_id = tasks[-1]["id"]
+                # A short page of filtered tasks is the last one
+                if filters is not None and len(tasks) < page_size:
+                    break
+            pages.put(None)
+        except Exception as e:
+            pages.put(e)
+
+    thread = threading.Thread(target=download, daemon=True)
+    thread.start()
+    try:
+        while True:
+            tasks = pages.get()
+            if tasks is None:
+                return
+            if isinstance(tasks, Exception):
+                raise tasks
+            yield from tasks
+    finally:
+        # Unblock the download thread if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                pages.get_nowait()
+            except queue.Empty:
+                thread.join(0.1)
+
+
+def task_image_path(task: dict, config: dict):
+    """Get the path of the image of a task
+
+    Args:
+        task (dict): task with its data
+        config (dict): configuration dictionary
+
+    Returns:
+        str: url of the image in "remote" mode, local path in "local" mode, None if the task has no image
+    """
+    if 'image' not in task['data']:
+        return None
+    # If the image are stored remotely (uploaded files, absolute or presigned URLs, cloud storage URIs)
+    if config["data_storage"] == "remote":
+        return resolve_image_url(task['data']['image'], task['id'], config["label_studio_url"])
+    image_file = task['data'].get('image').split("/")[-1]
+    image_file = image_file[9:]
+    return os.path.join(config["data_dir"], image_file)
+
+
+def iter_task_images(project: Project, config: dict, metrics=None, sync=None):
+    """Stream the (task id, image path) pairs of a project.
+    With `shard_count` > 1 in the configuration, only the tasks of shard `shard_index` are kept.
+
+    Args:
+        project (Project): Label Studio project
+        config (dict): configuration dictionary
+        metrics (RunMetrics): optional run metrics
+        sync (IncrementalSync): optional incremental sync, only the tasks that need a prediction are streamed
+
+    Yields:
+        tuple: (task_id, image_path)
+    """
+    shard_index, shard_count = config.get("shard_index", 0), config.get("shard_count", 1)
+    if sync is not None:
+        tasks = sync.iter_tasks(project, config.get("page_size", 100), metrics)
+    else:
+        tasks = iter_tasks(project, config.get("page_size", 100), metrics=metrics)
+    for task in tasks:
+        if shard_count > 1 and shard_of(task["id"], shard_count) != shard_index:
+            continue
+        image_path = task_image_path(task, config)
+        if image_path is not None:
+            if sync is not None:
+                sync.select(task)
+            yield task["id"], image_path
+
+
+def setup(config: dict, logger: logging.Logger, metrics=None, ls_client: Client = None, sync=None):
     """Setup the project, get tasks' ids, result template
     
     Args:
         config: configuration dictionary
+        metrics: optional RunMetrics timing the task downloads
+        ls_client: optional Label Studio client shared with other projects of the same server
+        sync: optional IncrementalSync, only the tasks that need a prediction are fetched
+    
+    Returns:
+        tuple: (project, generator of (task_id, image_path) pairs, result template)
     """
     # Setup Label Studio Client
-    ls_client = Client(url=config["label_studio_url"],
-                       api_key=config["label_studio_api_key"])
+    if ls_client is None:
+        ls_client = Client(url=config["label_studio_url"],
+                           api_key=config["label_studio_api_key"])
     
     ls_project = ls_client.get_project(id=config["project_id"])
     
-    # Get all images' urls from the Label Studio server
-    tasks_list = ls_project.get_tasks()
-    id2image_path = {}
+    if config["data_storage"] not in ("remote", "local"):
+        raise ValueError("Unsupported data storage format {}!".format(config["data_storage"]))
     
-    logger.info("Getting all the image urls from project id: {}".format(config["project_id"]))
-    # If the image are stored remotely
-    if config["data_storage"] == "remote":
-        for task in tqdm(tasks_list):
-            if 'image' in task['data']:
-                id2image_path[task["id"]] = config["label_studio_url"] + task['data'].get('image')
-            else:
-                continue
-    elif config["data_storage"] == "local":
-        for task in tqdm(tasks_list):
-            if 'image' in task['data']:
-                image_file = task['data'].get('image').split("/")[-1]
-                image_file = image_file[9:]
-                image_path = os.path.join(config["data_dir"], image_file)
-                id2image_path[task["id"]] = image_path
-    else:
-        logger.error("Unsupported data storage format!")
+    # The image urls are streamed page by page from the Label Studio server
+    logger.info("Getting the image urls from project id: {}".format(config["project_id"]))
+    tasks = iter_task_images(ls_project, config, metrics, sync)
+    
+    # Remote images are downloaded into a local cache ahead of the query stage
+    image_source = create_image_source_from_config(config)
+    if image_source is not None:
+        image_source.metrics = metrics
+        tasks = image_source.fetch_tasks(tasks, logger)
         
-    # Get the result template from file
-    template_file = config["template"]
-    with open(template_file) as f:
-        template = json.load(f)
+    # Load and compile the result template once for the whole run
+    template = load_template(config["template"], config.get("attribute_mapping"))
     
-    return ls_project, tasks_list, id2image_path, template
+    return ls_project, tasks, template
     
 
 # For testing purposes only
@@ -92,4 +224,6 @@ if __name__ == "__main__":
     logger.propagate = False
     logger.setLevel(getattr(logging, config["logging"]))
     
-    setup(config, logger)
\ No newline at end of file
+    ls_project, tasks, template = setup(config, logger)
+    for task_id, image_path in tasks:
+        print(task_id, image_path)
\ No newline at end of file
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+import statistics
+from collections import defaultdict, deque
+
+
+# Why the requests of the current thread or task are sent: "first" attempt, full "retry" of an image,
+# or "followup" re-query of the attributes that were missing or invalid. Set with request_purpose().
+REQUEST_PURPOSE = contextvars.ContextVar("request_purpose", default="first")
+
+
+@contextlib.contextmanager
+def request_purpose(purpose: str):
+    """Attribute the tokens of the requests sent in the enclosed block to `purpose`"""
+    token = REQUEST_PURPOSE.set(purpose)
+    try:
+        yield
+    finally:
+        REQUEST_PURPOSE.reset(token)
+
+
+class RunMetrics:
+    """
+        Timers and counters of a run, shared by every stage of the pipeline
+        (encode, rate_limit_wait, query, parse, ls_get_tasks, ls_create, ls_update).
+        The durations of each stage, the token usage of the responses and the retries and
+        errors by class are summarized at the end of the run, as JSON or in the Prometheus text format.
+
+        Args:
+            prices (dict): USD per million tokens for "prompt", "completion" and "cached" tokens,
+                and optionally per model under "models" (e.g. {"models": {"gpt-4o-mini": {"prompt": 0.15, ...}}})
+            window (int): if set, the percentiles are computed over the last `window` durations of each
+                stage, so that a long-running server keeps bounded memory; the count, total and max stay exact
+    """
+    def __init__(self, prices: dict = None, window: int = None):
+        self.prices = prices or {}
+        self.window = window
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.durations = defaultdict(list) if window is None else defaultdict(lambda: deque(maxlen=window))
+        # Stage -> [count, total, max] of every duration, also those out of the window
+        self.totals = defaultdict(lambda: [0, 0.0, 0.0])
+        self.counters = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.tokens = {"prompt": 0, "completion": 0, "cached": 0}
+        self.model_tokens = defaultdict(lambda: {"prompt": 0, "completion": 0, "cached": 0})
+        self.purpose_tokens = defaultdict(lambda: {"prompt": 0, "completion": 0, "cached": 0})
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """Time the enclosed block as one occurrence of `stage`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, duration: float):
+        with self.lock:
+            self.durations[stage].append(duration)
+            totals = self.totals[stage]
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record_error(self, error: Exception):
+        """Count a failed attempt by the class of its error"""
+        with self.lock:
+            self.errors[type(error).__name__] += 1
+
+    def record_usage(self, usage, model: str = None):
+        """Add the token usage of a chat completion response, per model if `model` is given,
+        and per purpose of the request (see request_purpose())"""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+        purpose = REQUEST_PURPOSE.get()
+        with self.lock:
+            self.tokens["prompt"] += usage.prompt_tokens
+            self.tokens["completion"] += usage.completion_tokens
+            self.tokens["cached"] += cached
+            self.purpose_tokens[purpose]["prompt"] += usage.prompt_tokens
+            self.purpose_tokens[purpose]["completion"] += usage.completion_tokens
+            self.purpose_tokens[purpose]["cached"] += cached
+            if model is not None:
+                self.model_tokens[model]["prompt"] += usage.prompt_tokens
+                self.model_tokens[model]["completion"] += usage.completion_tokens
+                self.model_tokens[model]["cached"] += cached
+
+    def _token_cost(self, tokens: dict, prices: dict) -> float:
+        uncached = tokens["prompt"] - tokens["cached"]
+        return (uncached * prices.get("prompt", 0.0)
+                + tokens["cached"] * prices.get("cached", prices.get("prompt", 0.0))
+                + tokens["completion"] * prices.get("completion", 0.0)) / 1e6
+
+    def cost(self) -> float:
+        """Estimated cost of the run in USD, cached tokens are billed at the cached price.
+        Tokens of models listed in `prices["models"]` are billed at the prices of their model."""
+        model_prices = self.prices.get("models") or {}
+        # Tokens without a model, or of a model without prices, are billed at the default prices
+        rest = dict(self.tokens)
+        cost = 0.0
+        for model, tokens in list(self.model_tokens.items()):
+            if model in model_prices:
+                cost += self._token_cost(tokens, model_prices[model])
+                rest = {kind: rest[kind] - tokens[kind] for kind in rest}
+        return cost + self._token_cost(rest, self.prices)
+
+    def summary(self) -> dict:
+        """Summary of the run
+
+        Returns:
+            dict: wall time, per-stage count/total/p50/p95/p99/max in seconds, counters, errors, tokens and cost
+        """
+        with self.lock:
+            stages = {}
+            for stage, durations in self.durations.items():
+                ordered = sorted(durations)
+                cuts = statistics.quantiles(ordered, n=100, method="inclusive") if len(ordered) > 1 else ordered * 99
+                count, total, longest = self.totals[stage]
+                stages[stage] = {
+                    "count": count,
+                    "total": round(total, 6),
+                    "p50": round(cuts[49], 6),
+                    "p95": round(cuts[94], 6),
+                    "p99": round(cuts[98], 6),
+                    "max": round(longest, 6),
+                }
+            return {
+                "wall_time": round(time.time() - self.started, 3),
+                "stages": stages,
+                "counters": dict(self.counters),
+                "errors": dict(self.errors),
+                "tokens": dict(self.tokens),
+                "tokens_by_model": {model: dict(tokens) for model, tokens in self.model_tokens.items()},
+                "tokens_by_purpose": {purpose: dict(tokens) for purpose, tokens in self.purpose_tokens.items()},
+                "cost_usd": round(self.cost(), 6),
+            }
+
+    def write_summary(self, path: str) -> dict:
+        """Write the JSON summary of the run and return it"""
+        summary = self.summary()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = ["# TYPE lsllm_stage_seconds summary"]
+        for stage, stats in summary["stages"].items():
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+                lines.append('lsllm_stage_seconds{{stage="{}",quantile="{}"}} {}'.format(stage, quantile, stats[key]))
+            lines.append('lsllm_stage_seconds_sum{{stage="{}"}} {}'.format(stage, stats["total"]))
+            lines.append('lsllm_stage_seconds_count{{stage="{}"}} {}'.format(stage, stats["count"]))
+        lines.append("# TYPE lsllm_events_total counter")
+        for name, value in summary["counters"].items():
+            lines.append('lsllm_events_total{{event="{}"}} {}'.format(name, value))
+        lines.append("# TYPE lsllm_errors_total counter")
+        for name, value in summary["errors"].items():
+            lines.append('lsllm_errors_total{{error="{}"}} {}'.format(name, value))
+        lines.append("# TYPE lsllm_tokens_total counter")
+        for kind, value in summary["tokens"].items():
+            lines.append('lsllm_tokens_total{{kind="{}"}} {}'.format(kind, value))
+        lines.append("# TYPE lsllm_purpose_tokens_total counter")
+        for purpose, tokens in summary["tokens_by_purpose"].items():
+            for kind, value in tokens.items():
+                lines.append('lsllm_purpose_tokens_total{{purpose="{}",kind="{}"}} {}'.format(purpose, kind, value))
+        lines.append("# TYPE lsllm_cost_usd gauge")
+        lines.append("lsllm_cost_usd {}".format(summary["cost_usd"]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Write the metrics for the node_exporter textfile collector, atomically"""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+
+def start_prometheus_writer(metrics: RunMetrics, path: str, interval: float = 15.0) -> threading.Event:
+    """Rewrite the Prometheus file every `interval` seconds in a background thread
+
+    Returns:
+        threading.Event: set it to stop the writer
+    """
+    stop = threading.Event()
+
+    def write():
+        while not stop.wait(interval):
+            metrics.write_prometheus(path)
+
+    threading.Thread(target=write, daemon=True).start()
+    return stop
+
+
+def stage_timer(metrics: RunMetrics, stage: str):
+    """Timer of a stage, or a no-op if no RunMetrics is attached"""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.timer(stage)
+
+
+def create_metrics_from_config(config: dict, window: int = None) -> RunMetrics:
+    """Create the run metrics from the `metrics` section of the configuration
+
+    Args:
+        config (dict): configuration dictionary
+        window (int): default number of durations per stage kept for the percentiles, all of them if None
+
+    Returns:
+        RunMetrics: the run metrics
+    """
+    metrics_config = config.get("metrics") or {}
+    return RunMetrics(metrics_config.get("prices"), window=metrics_config.get("window", window))
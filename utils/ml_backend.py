@@ -0,0 +1,425 @@
+"""
+    Label Studio ML backend: the predictions of the prompts are computed when an annotator opens a
+    task, instead of being pushed for the whole project ahead of time. Implements the `/health`,
+    `/setup` and `/predict` endpoints that Label Studio calls on a connected model.
+
+    The /predict calls of the HTTP threads are answered by an asyncio loop in a background thread:
+    the tasks of concurrent calls are coalesced into micro-batches (packed into one request with a
+    packed prompt), a task already being predicted is not queried twice, and repeated calls are
+    answered from the last predictions. A call returns within `timeout`, the tasks predicted later
+    are kept for the next call.
+"""
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .pipeline import aquery_with_retries, aquery_packed_with_fallback
+from .label_studio_server import task_image_path
+from .remote_images import create_image_source_from_config
+from .template_utils import load_template
+from .sync import model_version_from_config
+from .metrics import stage_timer
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # Label Studio and the annotators open many connections at once, the default backlog is 5
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def project_id_of(value) -> int:
+    """Id of the project of a request, Label Studio sends "<project id>.<timestamp>" """
+    return int(str(value).split(".")[0])
+
+
+class ServedProject:
+    """
+        Prompt, result template and image source of a project served by the backend.
+
+        Args:
+            config (dict): configuration dictionary of the project
+            prompt: Prompt object of the project
+            template (CompiledTemplate): result template
+            image_source (RemoteImageSource): downloads the images of remote projects, None for local ones
+    """
+    def __init__(self, config: dict, prompt, template, image_source=None):
+        self.config = config
+        self.prompt = prompt
+        self.template = template
+        self.image_source = image_source
+        self.model_version = model_version_from_config(config, prompt)
+        self.max_retries = config.get("MAX_RETRIES", 5)
+        self.max_followups = config.get("MAX_FOLLOWUPS", 1)
+
+    def image_path(self, task: dict) -> str:
+        """Local path to the image of a task, downloaded first for remote projects. Blocking"""
+        image = task_image_path(task, self.config)
+        if image is None or self.image_source is None:
+            return image
+        return self.image_source.fetch(image)
+
+    def missing_from_names(self, label_config: str) -> list:
+        """from_names of the result template that are not in a labeling configuration"""
+        return sorted({result["from_name"] for result in self.template.template["result"]
+                       if 'name="{}"'.format(result["from_name"]) not in label_config})
+
+
+class PredictionService:
+    """
+        Predictions of the tasks of /predict calls, shared by the HTTP threads.
+
+        A batch starts with the first queued task and takes the tasks queued within `max_wait`
+        seconds, up to `max_batch_size`. Under load, the tasks queued while `concurrency` batches
+        are in flight form the next batch at once. A task (project, id and image) is queried once
+        however many calls ask for it, and its prediction is kept for the next calls, the
+        `cache_size` most recent ones in memory and the outputs of the model in the response cache
+        of the prompt.
+
+        Args:
+            projects (dict): project id -> ServedProject
+            client (openai.AsyncClient): asynchronous OpenAI client
+            logger (logging.Logger): logger
+            max_batch_size (int): maximum number of tasks in a batch
+            max_wait (float): seconds the first task of a batch waits for more tasks
+            concurrency (int): number of batches processed at the same time
+            timeout (float): latency SLO of a call in seconds, the tasks that are not predicted by then
+                are left out of the response, their queries go on
+            cache_size (int): number of predictions kept in memory
+            metrics (RunMetrics): optional metrics of the server
+    """
+    def __init__(self, projects: dict, client, logger: logging.Logger, max_batch_size: int = 8,
+                 max_wait: float = 0.05, concurrency: int = 8, timeout: float = 10.0, cache_size: int = 10000,
+                 metrics=None):
+        self.projects = projects
+        self.client = client
+        self.logger = logger
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.metrics = metrics
+        # (project id, task id, image) -> future of the prediction being computed, and the last predictions
+        self.inflight = {}
+        self.predictions = OrderedDict()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.queue = None
+        self.slots = None
+        self.batcher = None
+
+    def start(self):
+        """Start the event loop thread and the batcher"""
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        return self
+
+    async def _start(self):
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.batcher = asyncio.ensure_future(self._batch_forever())
+
+    async def _stop(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        """Cancel the batcher and the queries in flight, then stop the event loop thread"""
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        for project in self.projects.values():
+            if project.image_source is not None:
+                project.image_source.close()
+
+    def _count(self, name: str, value: int = 1):
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def predict(self, project_id: int, tasks: list) -> list:
+        """Predict the tasks of a /predict call, called from the HTTP threads
+
+        Args:
+            project_id (int): id of the project
+            tasks (list): tasks with their id and data
+
+        Returns:
+            list: predictions of the first tasks, in order, up to the first task that is not predicted
+                within the timeout or failed
+        """
+        return asyncio.run_coroutine_threadsafe(self.apredict(project_id, tasks), self.loop).result()
+
+    async def apredict(self, project_id: int, tasks: list) -> list:
+        project = self.projects[project_id]
+        futures = [self._prediction(project_id, project, task) for task in tasks]
+        pending = [future for future in futures if not future.done()]
+        if pending:
+            # The futures are shared with other calls, they are not cancelled on timeout
+            await asyncio.wait(pending, timeout=self.timeout)
+        # Label Studio pairs the results with the tasks in order
+        results = []
+        for future in futures:
+            if not future.done():
+                self._count("tasks_timed_out")
+                break
+            if future.result() is None:
+                break
+            results.append(future.result())
+        return results
+
+    def _prediction(self, project_id: int, project: ServedProject, task: dict) -> asyncio.Future:
+        """Future of the prediction of a task: already known, being computed, or queued"""
+        key = (project_id, task["id"], json.dumps(task.get("data", {}).get("image")))
+        if key in self.predictions:
+            self._count("prediction_cache_hits")
+            self.predictions.move_to_end(key)
+            future = self.loop.create_future()
+            future.set_result(self.predictions[key])
+            return future
+        if key in self.inflight:
+            self._count("inflight_joins")
+            return self.inflight[key]
+        future = self.loop.create_future()
+        self.inflight[key] = future
+        self.queue.put_nowait((project, task, key, future))
+        return future
+
+    async def _batch_forever(self):
+        getter = None
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(self.queue.get())
+            batch = [await getter]
+            getter = None
+            deadline = self.loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                # The getter is kept for the next batch on timeout, cancelling it could lose a task
+                getter = asyncio.ensure_future(self.queue.get())
+                done, _ = await asyncio.wait([getter], timeout=remaining)
+                if not done:
+                    break
+                batch.append(getter.result())
+                getter = None
+            await self.slots.acquire()
+            self._count("batches")
+            self._count("batched_tasks", len(batch))
+            asyncio.ensure_future(self._process(batch))
+
+    async def _process(self, batch: list):
+        try:
+            by_project = OrderedDict()
+            for item in batch:
+                by_project.setdefault(id(item[0]), []).append(item)
+            await asyncio.gather(*[self._process_project(items) for items in by_project.values()])
+        finally:
+            self.slots.release()
+
+    async def _process_project(self, items: list):
+        project = items[0][0]
+        try:
+            paths = await asyncio.gather(*[asyncio.to_thread(project.image_path, task) for _, task, _, _ in items],
+                                         return_exceptions=True)
+            ready = []
+            for item, path in zip(items, paths):
+                if isinstance(path, Exception) or path is None:
+                    self._resolve(item, None, "No image: {}".format(path))
+                else:
+                    ready.append((item, path))
+            if not ready:
+                return
+            results = await self._query(project, [path for _, path in ready])
+            for (item, _), (_, prediction, error) in zip(ready, results):
+                self._resolve(item, prediction, error)
+        except Exception as e:
+            self.logger.exception("Error in predicting {} tasks of project {}".format(
+                len(items), project.config["project_id"]))
+            for item in items:
+                self._resolve(item, None, "{}: {}".format(type(e).__name__, e))
+
+    async def _query(self, project: ServedProject, image_paths: list) -> list:
+        """(output, prediction, error) of each image, images with a cached output are not packed"""
+        prompt = project.prompt
+        if prompt.image_preprocessor is not None:
+            await asyncio.gather(*[asyncio.wrap_future(prompt.image_preprocessor.submit(image_path))
+                                   for image_path in image_paths])
+        pack_size = getattr(prompt, "pack_size", 1)
+        query = lambda image_path: aquery_with_retries(prompt, self.client, image_path, project.template,
+                                                       project.max_retries, self.logger, project.max_followups)
+        if pack_size == 1:
+            return list(await asyncio.gather(*[query(image_path) for image_path in image_paths]))
+
+        cached = [False] * len(image_paths)
+        if prompt.cache is not None:
+            cached = await asyncio.to_thread(
+                lambda: [prompt.cache.get(prompt.cache_key(image_path)) is not None for image_path in image_paths])
+        to_pack = [index for index, hit in enumerate(cached) if not hit]
+        packs = [to_pack[start:start + pack_size] for start in range(0, len(to_pack), pack_size)]
+        results = [None] * len(image_paths)
+        single = [index for index, hit in enumerate(cached) if hit]
+        outputs = await asyncio.gather(
+            *[aquery_packed_with_fallback(prompt, self.client, [image_paths[index] for index in pack], project.template,
+                                          project.max_retries, self.logger, project.max_followups) for pack in packs],
+            *[query(image_paths[index]) for index in single])
+        for pack, pack_results in zip(packs, outputs):
+            for index, result in zip(pack, pack_results):
+                results[index] = result
+        for index, result in zip(single, outputs[len(packs):]):
+            results[index] = result
+        return results
+
+    def _resolve(self, item: tuple, prediction: dict, error: str):
+        project, task, key, future = item
+        self.inflight.pop(key, None)
+        if prediction is not None:
+            prediction = dict(prediction, model_version=project.model_version)
+            self.predictions[key] = prediction
+            while len(self.predictions) > self.cache_size:
+                self.predictions.popitem(last=False)
+            self._count("tasks_predicted")
+        else:
+            self._count("tasks_failed")
+            self.logger.error("No prediction for task {} ({})".format(task["id"], error))
+        if not future.done():
+            future.set_result(prediction)
+
+
+class MLBackendServer:
+    """
+        HTTP server of the ML backend contract of Label Studio:
+
+            GET  /health   {"status": "UP", "model_class": ...}
+            POST /setup    {"project": "<id>.<timestamp>", "schema": <labeling configuration>, ...}
+                           -> {"model_version": ...}
+            POST /predict  {"project": ..., "tasks": [...]} -> {"results": [prediction, ...]}
+            GET  /metrics  counters and timings in the Prometheus text format
+
+        Requests without a project, or for a project that is not served, are answered with the
+        project of the first configuration if it is the only one served, with 400 otherwise.
+
+        Args:
+            service (PredictionService): predictions of the tasks
+            logger (logging.Logger): logger
+            host (str): address to listen on
+            port (int): port to listen on, 0 for any free port
+    """
+    def __init__(self, service: PredictionService, logger: logging.Logger, host: str = "0.0.0.0", port: int = 9090):
+        self.service = service
+        self.logger = logger
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length)) if length else {}
+                    status, payload = server.handle(self.command, self.path.split("?")[0].rstrip("/"), body)
+                except Exception as e:
+                    logger.exception("Error in {} {}".format(self.command, self.path))
+                    status, payload = 500, {"error": "{}: {}".format(type(e).__name__, e)}
+                data = payload.encode("utf-8") if isinstance(payload, str) else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain" if isinstance(payload, str) else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _handle
+
+        self.httpd = _HTTPServer((host, port), Handler)
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self.httpd.server_address[:2])
+
+    def project_id(self, body: dict) -> int:
+        """Served project of a request, None if there is none"""
+        project_ids = list(self.service.projects)
+        if body.get("project") is not None:
+            project_id = project_id_of(body["project"])
+            if project_id in self.service.projects:
+                return project_id
+        return project_ids[0] if len(project_ids) == 1 else None
+
+    def handle(self, method: str, path: str, body: dict) -> tuple:
+        """Answer a request
+
+        Returns:
+            tuple: (status code, JSON payload, or text)
+        """
+        if method == "GET" and path in ("", "/health"):
+            return 200, {"status": "UP", "model_class": sorted({type(project.prompt).__name__
+                                                                for project in self.service.projects.values()})}
+        if method == "GET" and path == "/metrics":
+            return 200, self.service.metrics.prometheus() if self.service.metrics is not None else ""
+        if method != "POST" or path not in ("/setup", "/predict"):
+            return 404, {"error": "Not found"}
+        project_id = self.project_id(body)
+        if project_id is None:
+            return 400, {"error": "Project {} is not served".format(body.get("project"))}
+        project = self.service.projects[project_id]
+        if path == "/setup":
+            missing = project.missing_from_names(body.get("schema") or "")
+            if body.get("schema") and missing:
+                self.logger.warning("The labeling configuration of project {} has no control for {}".format(
+                    project_id, missing))
+            return 200, {"model_version": project.model_version}
+        start = time.perf_counter()
+        with stage_timer(self.service.metrics, "predict"):
+            results = self.service.predict(project_id, body.get("tasks") or [])
+        self.logger.debug("{} of {} tasks of project {} predicted in {:.3f}s".format(
+            len(results), len(body.get("tasks") or []), project_id, time.perf_counter() - start))
+        return 200, {"results": results, "model_version": project.model_version}
+
+    def serve_forever(self):
+        self.logger.info("ML backend listening on {}".format(self.url))
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def create_served_project(config: dict, prompt) -> ServedProject:
+    """Served project of a configuration, with its result template and remote image source"""
+    template = load_template(config["template"], config.get("attribute_mapping"))
+    return ServedProject(config, prompt, template, create_image_source_from_config(config))
+
+
+def create_service_from_config(config: dict, projects: dict, client, logger: logging.Logger, metrics=None):
+    """Create the prediction service from the `ml_backend` section of the configuration
+
+    Args:
+        config (dict): configuration dictionary
+        projects (dict): project id -> ServedProject
+        client (openai.AsyncClient): asynchronous OpenAI client
+        logger (logging.Logger): logger
+        metrics (RunMetrics): optional metrics of the server
+
+    Returns:
+        PredictionService: the service, not started
+    """
+    backend_config = config.get("ml_backend") or {}
+    return PredictionService(projects, client, logger,
+                             max_batch_size=backend_config.get("max_batch_size", 8),
+                             max_wait=backend_config.get("max_wait_ms", 50) / 1000,
+                             concurrency=backend_config.get("concurrency", config.get("concurrency", 8)),
+                             timeout=backend_config.get("timeout", 10.0),
+                             cache_size=backend_config.get("cache_size", 10000),
+                             metrics=metrics)
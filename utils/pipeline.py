@@ -0,0 +1,629 @@
+import time
+import asyncio
+import logging
+import openai
+from collections import deque
+from tqdm import tqdm
+from .uploader import PredictionUploader
+from .journal import RunJournal
+from .rate_limiter import is_retryable, backoff_delay, get_retry_after
+from .metrics import stage_timer, request_purpose
+
+
+def log_first_prediction(logger: logging.Logger, prompt, output: str, prediction: dict):
+    """Log the output of the first processed task for debugging
+
+    Args:
+        logger (logging.Logger): logger
+        prompt: Prompt object
+        output (str): raw output of the model
+        prediction (dict): parsed prediction
+    """
+    logger.debug("====================== DEBUGGING ======================")
+    logger.debug("Output: {}".format(output))
+    logger.debug("Prediction: {}".format(prediction))
+    logger.debug("Model: {}".format(prompt.model))
+    logger.debug("Origin: {}".format(prompt.origin))
+
+
+def prefetch_images(prompt, tasks):
+    """Start preprocessing the images a few tasks ahead of the query stage
+
+    Args:
+        prompt: Prompt object
+        tasks: iterable of (task_id, image_path) pairs
+
+    Yields:
+        tuple: (task_id, image_path), in the same order
+    """
+    if prompt.image_preprocessor is None:
+        yield from tasks
+        return
+    window = deque()
+    for task in tasks:
+        prompt.image_preprocessor.submit(task[1])
+        window.append(task)
+        if len(window) > prompt.image_preprocessor.workers:
+            yield window.popleft()
+    yield from window
+
+
+def handle_query_error(prompt, error: Exception, image_path: str, attempt: int, max_retries: int,
+                       logger: logging.Logger):
+    """Log a failed attempt and decide whether to try again
+
+    Args:
+        prompt: Prompt object
+        error (Exception): the error
+        image_path (str): path to the image
+        attempt (int): number of failed attempts so far
+        max_retries (int): maximum number of attempts
+        logger (logging.Logger): logger
+
+    Returns:
+        float: delay before the next attempt, None if the query should not be repeated
+    """
+    if prompt.metrics is not None:
+        prompt.metrics.record_error(error)
+    if not is_retryable(error):
+        logger.error("Fatal error in querying {}! Skipping the image.".format(image_path))
+        logger.error(error)
+        return None
+    if attempt >= max_retries:
+        logger.error("Failed to get the results for {} after {} attempts! Skipping the image.".format(
+            image_path, max_retries))
+        logger.error(error)
+        return None
+    if prompt.rate_limiter is not None:
+        delay = prompt.rate_limiter.on_error(error, attempt)
+    else:
+        delay = 0.0 if not isinstance(error, openai.APIError) else backoff_delay(attempt, get_retry_after(error))
+    if prompt.metrics is not None:
+        prompt.metrics.count("retries")
+    logger.warning("Error in querying {} ({}), retrying in {:.1f}s".format(image_path, type(error).__name__, delay))
+    return delay
+
+
+def _log_followup(prompt, image_path: str, attributes: list, logger: logging.Logger):
+    if prompt.metrics is not None:
+        prompt.metrics.count("followups")
+        prompt.metrics.count("followup_attributes", len(attributes))
+    logger.debug("Missing or invalid attributes for {}: {}, querying them again".format(image_path, attributes))
+
+
+def complete_output(prompt, client: openai.Client, image_path: str, output: str, max_followups: int,
+                    logger: logging.Logger) -> str:
+    """Repair the output locally against the schema of the prompt, then query the model again for
+    the attributes that are still missing or invalid, up to `max_followups` times, instead of
+    sending the whole image again. The completed output replaces the cached one.
+
+    Args:
+        prompt: Prompt object
+        client (openai.Client): OpenAI client
+        image_path (str): path to the image
+        output (str): raw output of the model
+        max_followups (int): maximum number of follow-up requests
+        logger (logging.Logger): logger
+
+    Returns:
+        str: the repaired output
+    """
+    completed, invalid = prompt.validate(output)
+    for _ in range(max_followups):
+        if not invalid:
+            break
+        _log_followup(prompt, image_path, invalid, logger)
+        with request_purpose("followup"):
+            completed = prompt.followup(client, image_path, completed, invalid)
+        completed, invalid = prompt.validate(completed)
+    if completed != output:
+        prompt.recache(image_path, completed)
+    return completed
+
+
+async def acomplete_output(prompt, client: openai.AsyncClient, image_path: str, output: str, max_followups: int,
+                           logger: logging.Logger) -> str:
+    """Asynchronous counterpart of complete_output()"""
+    completed, invalid = prompt.validate(output)
+    for _ in range(max_followups):
+        if not invalid:
+            break
+        _log_followup(prompt, image_path, invalid, logger)
+        with request_purpose("followup"):
+            completed = await prompt.afollowup(client, image_path, completed, invalid)
+        completed, invalid = prompt.validate(completed)
+    if completed != output:
+        await asyncio.to_thread(prompt.recache, image_path, completed)
+    return completed
+
+
+def query_with_retries(prompt, client: openai.Client, image_path: str, template: dict,
+                       max_retries: int, logger: logging.Logger, max_followups: int = 1):
+    """Query the model and parse its output, repeating the query until the result is valid.
+    Outputs are repaired locally and missing attributes are queried again on their own first,
+    see complete_output(). Retryable errors are repeated after a backoff, fatal ones
+    (e.g. invalid requests) are not.
+
+    Args:
+        prompt: Prompt object
+        client (openai.Client): OpenAI client
+        image_path (str): path to the image
+        template (dict): result template
+        max_retries (int): maximum number of attempts
+        logger (logging.Logger): logger
+        max_followups (int): maximum number of follow-up requests for missing attributes per attempt
+
+    Returns:
+        tuple: (output, prediction, error), output and prediction are None if every attempt failed
+    """
+    attempt = 0
+    while True:
+        try:
+            with request_purpose("retry" if attempt else "first"):
+                output = prompt.query(client, image_path)
+            output = complete_output(prompt, client, image_path, output, max_followups, logger)
+            try:
+                with stage_timer(prompt.metrics, "parse"):
+                    prediction = prompt.parse(output, template)
+            except Exception:
+                # Do not serve the same invalid output from the cache again
+                prompt.uncache(image_path)
+                raise
+            return output, prediction, None
+        except Exception as e:
+            attempt += 1
+            delay = handle_query_error(prompt, e, image_path, attempt, max_retries, logger)
+            if delay is None:
+                return None, None, "{}: {}".format(type(e).__name__, e)
+            time.sleep(delay)
+
+
+async def aquery_with_retries(prompt, client: openai.AsyncClient, image_path: str, template: dict,
+                              max_retries: int, logger: logging.Logger, max_followups: int = 1):
+    """Asynchronous counterpart of query_with_retries()"""
+    attempt = 0
+    while True:
+        try:
+            with request_purpose("retry" if attempt else "first"):
+                output = await prompt.aquery(client, image_path)
+            output = await acomplete_output(prompt, client, image_path, output, max_followups, logger)
+            try:
+                with stage_timer(prompt.metrics, "parse"):
+                    prediction = prompt.parse(output, template)
+            except Exception:
+                await asyncio.to_thread(prompt.uncache, image_path)
+                raise
+            return output, prediction, None
+        except Exception as e:
+            attempt += 1
+            delay = handle_query_error(prompt, e, image_path, attempt, max_retries, logger)
+            if delay is None:
+                return None, None, "{}: {}".format(type(e).__name__, e)
+            await asyncio.sleep(delay)
+
+
+def group_tasks(prompt, tasks):
+    """Group the tasks by `prompt.pack_size` for prompts classifying several images per request
+
+    Args:
+        prompt: Prompt object
+        tasks: iterable of (task_id, image_path) pairs
+
+    Yields:
+        list: (task_id, image_path) pairs of each request
+    """
+    pack_size = getattr(prompt, "pack_size", 1)
+    group = []
+    for task in tasks:
+        group.append(task)
+        if len(group) >= pack_size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def _split_packed(prompt, output: str, image_paths: list, template: dict):
+    """Split a packed output into per-image outputs, repaired locally, and parse each of them,
+    raising if any is invalid"""
+    with stage_timer(prompt.metrics, "parse"):
+        results = []
+        for image_output in prompt.split(output, len(image_paths)):
+            image_output, invalid = prompt.validate(image_output)
+            if invalid:
+                raise ValueError("Missing or invalid attributes {}".format(invalid))
+            results.append((image_output, prompt.parse(image_output, template), None))
+        return results
+
+
+def _cache_hits(prompt, image_paths: list) -> list:
+    """Whether the output of each image is in the response cache of the prompt"""
+    if prompt.cache is None:
+        return [False] * len(image_paths)
+    return [prompt.cache.get(prompt.cache_key(image_path)) is not None for image_path in image_paths]
+
+
+def _recache_split(prompt, image_paths: list, results: list):
+    """Cache the per-image outputs of a packed query, which does not go through prompt.query()"""
+    if prompt.cache is not None:
+        for image_path, (output, _, _) in zip(image_paths, results):
+            prompt.recache(image_path, output)
+
+
+def _query_pack(prompt, client: openai.Client, image_paths: list, template: dict,
+                max_retries: int, logger: logging.Logger, max_followups: int) -> list:
+    if len(image_paths) == 1:
+        return [query_with_retries(prompt, client, image_paths[0], template, max_retries, logger, max_followups)]
+    attempt = 0
+    while True:
+        try:
+            with request_purpose("retry" if attempt else "first"):
+                output = prompt.query_packed(client, image_paths)
+        except Exception as e:
+            attempt += 1
+            delay = handle_query_error(prompt, e, image_paths[0], attempt, max_retries, logger)
+            if delay is None:
+                break
+            time.sleep(delay)
+            continue
+        try:
+            results = _split_packed(prompt, output, image_paths, template)
+        except Exception as e:
+            logger.warning("Invalid packed output for {} images ({}), querying them one by one".format(
+                len(image_paths), e))
+            if prompt.metrics is not None:
+                prompt.metrics.count("packed_fallbacks")
+            break
+        _recache_split(prompt, image_paths, results)
+        return results
+    return [query_with_retries(prompt, client, image_path, template, max_retries, logger, max_followups)
+            for image_path in image_paths]
+
+
+async def _aquery_pack(prompt, client: openai.AsyncClient, image_paths: list, template: dict,
+                       max_retries: int, logger: logging.Logger, max_followups: int) -> list:
+    if len(image_paths) == 1:
+        return [await aquery_with_retries(prompt, client, image_paths[0], template, max_retries, logger, max_followups)]
+    attempt = 0
+    while True:
+        try:
+            with request_purpose("retry" if attempt else "first"):
+                output = await prompt.aquery_packed(client, image_paths)
+        except Exception as e:
+            attempt += 1
+            delay = handle_query_error(prompt, e, image_paths[0], attempt, max_retries, logger)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            continue
+        try:
+            results = _split_packed(prompt, output, image_paths, template)
+        except Exception as e:
+            logger.warning("Invalid packed output for {} images ({}), querying them one by one".format(
+                len(image_paths), e))
+            if prompt.metrics is not None:
+                prompt.metrics.count("packed_fallbacks")
+            break
+        await asyncio.to_thread(_recache_split, prompt, image_paths, results)
+        return results
+    return list(await asyncio.gather(*[
+        aquery_with_retries(prompt, client, image_path, template, max_retries, logger, max_followups)
+        for image_path in image_paths
+    ]))
+
+
+def query_packed_with_fallback(prompt, client: openai.Client, image_paths: list, template: dict,
+                               max_retries: int, logger: logging.Logger, max_followups: int = 1) -> list:
+    """Query the model once for a pack of images. Images with an output in the response cache are
+    served from it and only the others are packed, their split outputs are cached in turn.
+    API errors are retried as in query_with_retries(), an output that cannot be split into valid
+    per-image predictions falls back to one query per image.
+
+    Args:
+        prompt: Prompt object with a `pack_size`
+        client (openai.Client): OpenAI client
+        image_paths (list): paths to the images of the pack
+        template (dict): result template
+        max_retries (int): maximum number of attempts
+        logger (logging.Logger): logger
+        max_followups (int): maximum number of follow-up requests of the images queried one by one
+
+    Returns:
+        list: (output, prediction, error) for each image, in the same order
+    """
+    hits = _cache_hits(prompt, image_paths)
+    misses = [index for index, hit in enumerate(hits) if not hit]
+    results = [None] * len(image_paths)
+    if misses:
+        for index, result in zip(misses, _query_pack(prompt, client, [image_paths[index] for index in misses],
+                                                     template, max_retries, logger, max_followups)):
+            results[index] = result
+    for index, hit in enumerate(hits):
+        if hit:
+            results[index] = query_with_retries(prompt, client, image_paths[index], template, max_retries, logger,
+                                                max_followups)
+    return results
+
+
+async def aquery_packed_with_fallback(prompt, client: openai.AsyncClient, image_paths: list, template: dict,
+                                      max_retries: int, logger: logging.Logger, max_followups: int = 1) -> list:
+    """Asynchronous counterpart of query_packed_with_fallback()"""
+    hits = await asyncio.to_thread(_cache_hits, prompt, image_paths)
+    misses = [index for index, hit in enumerate(hits) if not hit]
+    single = [index for index, hit in enumerate(hits) if hit]
+    results = [None] * len(image_paths)
+    outputs = await asyncio.gather(
+        *([_aquery_pack(prompt, client, [image_paths[index] for index in misses], template, max_retries, logger,
+                        max_followups)] if misses else []),
+        *[aquery_with_retries(prompt, client, image_paths[index], template, max_retries, logger, max_followups)
+          for index in single])
+    if misses:
+        for index, result in zip(misses, outputs[0]):
+            results[index] = result
+    for index, result in zip(single, outputs[len(outputs) - len(single):]):
+        results[index] = result
+    return results
+
+
+def log_usage(prompt, n_images: int, elapsed: float, logger: logging.Logger):
+    """Log the tokens and the wall time spent per image"""
+    if n_images == 0:
+        return
+    logger.info("Pack size {}: {} images in {} requests, {:.0f} prompt tokens/image, "
+                "{:.0f} completion tokens/image, {:.3f}s/image".format(
+                    getattr(prompt, "pack_size", 1), n_images, prompt.usage["requests"],
+                    prompt.usage["prompt_tokens"] / n_images, prompt.usage["completion_tokens"] / n_images,
+                    elapsed / n_images))
+
+
+class ProjectRun:
+    """
+        One project processed by the runners: its prompt, task stream, result template, uploader
+        and journal. Several runs can share the OpenAI client, the rate limiter and the workers,
+        their requests are then interleaved round-robin so that no project starves the others.
+
+        Args:
+            prompt: Prompt object of the project
+            uploader (PredictionUploader): uploader of the predictions to the project
+            tasks: iterable of (task_id, image_path) pairs
+            template (dict): result template
+            config (dict): configuration dictionary of the project
+            journal (RunJournal): journal recording the state of each task
+            name (str): name shown in the progress bar and in the logs
+            dedup (Deduplicator): optional deduplication stage, `tasks` then only holds the representatives
+                of the groups of near-duplicate images and their results are fanned out to the groups
+            knn (KnnLabeler): optional kNN tier, `tasks` then only holds the images it could not label
+    """
+    def __init__(self, prompt, uploader: PredictionUploader, tasks, template: dict, config: dict,
+                 journal: RunJournal = None, name: str = None, dedup=None, knn=None):
+        self.prompt = prompt
+        self.uploader = uploader
+        self.tasks = tasks
+        self.template = template
+        self.config = config
+        self.journal = journal
+        self.name = name
+        self.dedup = dedup
+        if dedup is not None and journal is not None:
+            dedup.reload = self._reload
+        self.knn = knn
+        self.max_retries = config.get("MAX_RETRIES", 5)
+        self.max_followups = config.get("MAX_FOLLOWUPS", 1)
+        self.stats = {"parsed": 0, "failed": 0}
+        self.progress = None
+        self.start = None
+
+    def begin(self, position: int = 0):
+        """Start the progress bar of the run, one line per project"""
+        self.progress = tqdm(desc=self.name, position=position) if self.name else tqdm()
+        self.start = time.perf_counter()
+
+    def record(self, group: list, results: list, first: bool, logger: logging.Logger) -> list:
+        """Count and journal the results of a group of tasks, of the duplicates sharing them and of the
+        tasks labeled by the kNN tier in the meantime
+
+        Args:
+            group (list): (task_id, image_path) pairs
+            results (list): (output, prediction, error) of each task
+            first (bool): whether this is the first group of the run, its first prediction is logged
+            logger (logging.Logger): logger
+
+        Returns:
+            list: (task_id, prediction) pairs to upload
+        """
+        to_upload = []
+        for position, ((task_id, _), (output, prediction, error)) in enumerate(zip(group, results)):
+            if self._record_task(task_id, output, prediction, error, to_upload) and first and position == 0:
+                log_first_prediction(logger, self.prompt, output, prediction)
+            if self.dedup is not None:
+                for duplicate_id in self.dedup.resolve(task_id, output, prediction, error):
+                    self._record_task(duplicate_id, output, prediction, error, to_upload)
+        if self.dedup is not None:
+            for duplicate_id, output, prediction, error in self.dedup.drain():
+                self._record_task(duplicate_id, output, prediction, error, to_upload)
+        if self.knn is not None:
+            for task_id, output, prediction, error in self.knn.drain():
+                self._record_task(task_id, output, prediction, error, to_upload)
+        return to_upload
+
+    def _reload(self, task_id: int):
+        """Result of a task read again from its output in the journal, None if it was not stored"""
+        output = self.journal.output(task_id)
+        if output is None:
+            return None
+        try:
+            return output, self.prompt.parse(output, self.template), None
+        except Exception as e:
+            return output, None, str(e)
+
+    def _record_task(self, task_id: int, output: str, prediction: dict, error: str, to_upload: list) -> bool:
+        """Count and journal the result of a task, and queue its prediction. Returns whether it was parsed"""
+        if self.prompt.metrics is not None:
+            self.prompt.metrics.count("tasks_parsed" if prediction is not None else "tasks_failed")
+        if self.journal is not None:
+            self.journal.record(task_id, "parsed" if prediction is not None else "failed",
+                                output=output, error=error)
+        if prediction is None:
+            self.stats["failed"] += 1
+            return False
+        to_upload.append((task_id, prediction))
+        self.stats["parsed"] += 1
+        return True
+
+    def finish(self, logger: logging.Logger):
+        """Close the progress bar, send the buffered predictions and log the usage of the run"""
+        if self.progress is not None:
+            self.progress.close()
+        # Duplicates found after the last result of their representative was recorded,
+        # and tasks labeled by the kNN tier after the last query
+        if self.dedup is not None or self.knn is not None:
+            for task_id, prediction in self.record([], [], False, logger):
+                self.uploader.add(task_id, prediction)
+        # Send the buffered predictions, also when the run is interrupted
+        self.uploader.flush()
+        if self.name:
+            logger.info("{}: {} predictions parsed, {} failed".format(
+                self.name, self.stats["parsed"], self.stats["failed"]))
+        if self.dedup is not None:
+            logger.info("Deduplication: {} images queried for {} tasks ({} near-duplicates)".format(
+                self.dedup.stats["representatives"], self.dedup.stats["representatives"] + self.dedup.stats["duplicates"],
+                self.dedup.stats["duplicates"]))
+        if self.knn is not None:
+            logger.info("kNN tier: {} images labeled locally, {} sent to the model".format(
+                self.knn.stats["local"], self.knn.stats["queried"]))
+        log_usage(self.prompt, self.stats["parsed"] + self.stats["failed"],
+                  time.perf_counter() - (self.start or time.perf_counter()), logger)
+
+
+def interleave(iterables):
+    """Round-robin over several iterables until all of them are exhausted
+
+    Args:
+        iterables: list of iterables
+
+    Yields:
+        tuple: (index of the iterable, item)
+    """
+    active = deque((index, iter(iterable)) for index, iterable in enumerate(iterables))
+    while active:
+        index, iterator = active.popleft()
+        item = next(iterator, None)
+        if item is None:
+            continue
+        yield index, item
+        active.append((index, iterator))
+
+
+def run_projects_serial(runs: list, client: openai.Client, logger: logging.Logger):
+    """Process the tasks of one or more projects one request at a time, alternating between the projects
+
+    Args:
+        runs (list): ProjectRun of each project
+        client (openai.Client): OpenAI client shared by the projects
+        logger (logging.Logger): logger
+    """
+    for position, run in enumerate(runs):
+        run.begin(position)
+    groups = [group_tasks(run.prompt, prefetch_images(run.prompt, run.tasks)) for run in runs]
+    processed = [0] * len(runs)
+    try:
+        for index, group in interleave(groups):
+            run = runs[index]
+            if getattr(run.prompt, "pack_size", 1) > 1:
+                results = query_packed_with_fallback(run.prompt, client, [image_path for _, image_path in group],
+                                                     run.template, run.max_retries, logger, run.max_followups)
+            else:
+                results = [query_with_retries(run.prompt, client, group[0][1], run.template, run.max_retries, logger,
+                                              run.max_followups)]
+            for task_id, prediction in run.record(group, results, processed[index] == 0, logger):
+                run.uploader.add(task_id, prediction)
+            processed[index] += 1
+            run.progress.update(len(group))
+    finally:
+        for run in runs:
+            run.finish(logger)
+
+
+async def _run_projects_concurrent(runs: list, client: openai.AsyncClient, concurrency: int,
+                                   logger: logging.Logger):
+    # Bounded queue, the tasks are pulled from the streams only as fast as they are processed
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    groups = interleave([group_tasks(run.prompt, run.tasks) for run in runs])
+
+    async def producer():
+        counters = [0] * len(runs)
+        while True:
+            # The streams may block on the next page of tasks
+            item = await asyncio.to_thread(next, groups, None)
+            if item is None:
+                break
+            run_index, group = item
+            await queue.put((run_index, counters[run_index], group))
+            counters[run_index] += 1
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    # Groups finish out of order, the progress bars only advance over the
+    # contiguous prefix of finished groups so that they are reported in order
+    finished = [{} for _ in runs]
+    next_index = [0] * len(runs)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            run_index, index, group = item
+            run = runs[run_index]
+            prompt = run.prompt
+            image_paths = [image_path for _, image_path in group]
+            if prompt.image_preprocessor is not None:
+                # Encode the images in the preprocessing pool instead of the event loop
+                await asyncio.gather(*[asyncio.wrap_future(prompt.image_preprocessor.submit(image_path))
+                                       for image_path in image_paths])
+            if getattr(prompt, "pack_size", 1) > 1:
+                results = await aquery_packed_with_fallback(prompt, client, image_paths, run.template,
+                                                            run.max_retries, logger, run.max_followups)
+            else:
+                results = [await aquery_with_retries(prompt, client, image_paths[0], run.template,
+                                                     run.max_retries, logger, run.max_followups)]
+            for task_id, prediction in run.record(group, results, index == 0, logger):
+                # Label Studio SDK is synchronous, upload from a worker thread
+                await asyncio.to_thread(run.uploader.add, task_id, prediction)
+
+            finished[run_index][index] = len(group)
+            while next_index[run_index] in finished[run_index]:
+                run.progress.update(finished[run_index].pop(next_index[run_index]))
+                next_index[run_index] += 1
+
+    await asyncio.gather(producer(), *[worker() for _ in range(concurrency)])
+
+
+def run_projects_concurrent(runs: list, client: openai.AsyncClient, concurrency: int, logger: logging.Logger):
+    """Process the tasks of one or more projects with `concurrency` queries in flight at the same time.
+    The workers are shared by the projects, which are fed to them round-robin.
+
+    On Ctrl-C the pending queries are cancelled, the predictions that were already
+    parsed are still sent so that no finished result is lost.
+
+    Args:
+        runs (list): ProjectRun of each project
+        client (openai.AsyncClient): asynchronous OpenAI client shared by the projects
+        concurrency (int): number of queries in flight
+        logger (logging.Logger): logger
+
+    Returns:
+        bool: whether the run was interrupted before every task was processed
+    """
+    for position, run in enumerate(runs):
+        run.begin(position)
+    try:
+        asyncio.run(_run_projects_concurrent(runs, client, concurrency, logger))
+    except KeyboardInterrupt:
+        logger.warning("Interrupted! {} predictions parsed, {} failed".format(
+            sum(run.stats["parsed"] for run in runs), sum(run.stats["failed"] for run in runs)))
+        return True
+    finally:
+        for run in runs:
+            run.finish(logger)
+    return False
@@ -0,0 +1,88 @@
+import copy
+import requests
+from requests.adapters import HTTPAdapter
+from label_studio_sdk import Client
+
+
+# Per-project paths, "{project_id}" is replaced by the id of each project
+PROJECT_PATHS = ("journal_path", "batch_dir", "spool_dir", "sync_state_path")
+PROJECT_METRICS_PATHS = ("summary_path", "prometheus_path")
+
+
+def _project_path(path, project_id):
+    return path.replace("{project_id}", str(project_id)) if isinstance(path, str) else path
+
+
+def expand_project_configs(configs: list, project_ids: list = None) -> list:
+    """One configuration per project to annotate.
+
+    A configuration with a `projects` list gives one project per entry, each entry overriding
+    the keys of the configuration (e.g. project_id, template, data_dir, prompt). With `project_ids`,
+    every configuration is used for each of the ids.
+
+    Args:
+        configs (list): configuration dictionaries
+        project_ids (list): optional project ids overriding `project_id`
+
+    Returns:
+        list: configuration dictionary of each project, in order
+    """
+    projects = []
+    for config in configs:
+        entries = config.get("projects") or [{}]
+        if project_ids:
+            entries = [dict(entry, project_id=project_id) for entry in entries for project_id in project_ids]
+        for entry in entries:
+            project_config = copy.deepcopy({key: value for key, value in config.items() if key != "projects"})
+            project_config.update(copy.deepcopy(entry))
+            project_id = project_config["project_id"]
+            for key in PROJECT_PATHS:
+                project_config[key] = _project_path(project_config.get(key), project_id)
+            metrics_config = project_config.get("metrics") or {}
+            for key in PROJECT_METRICS_PATHS:
+                if key in metrics_config:
+                    metrics_config[key] = _project_path(metrics_config[key], project_id)
+            projects.append({key: value for key, value in project_config.items() if value is not None})
+
+    if len(projects) > 1:
+        # Projects sharing a journal or a summary would overwrite each other
+        seen = {}
+        for project_config in projects:
+            metrics_config = project_config.get("metrics") or {}
+            for key, path in (("project_id", project_config["project_id"]),
+                              ("journal_path", project_config.get("journal_path")),
+                              ("batch_dir", project_config.get("batch_dir")),
+                              ("spool_dir", project_config.get("spool_dir")),
+                              ("sync_state_path", project_config.get("sync_state_path")),
+                              ("summary_path", metrics_config.get("summary_path"))):
+                if path is None:
+                    continue
+                if (key, path) in seen and key == "project_id":
+                    raise ValueError("Project {} is listed twice!".format(path))
+                if (key, path) in seen:
+                    raise ValueError("Projects {} and {} have the same {} ({}), use {{project_id}} in the path!".format(
+                        seen[(key, path)], project_config["project_id"], key, path))
+                seen[(key, path)] = project_config["project_id"]
+    return projects
+
+
+class SharedLabelStudioClients:
+    """
+        One Label Studio client per server, shared by the projects of a run so that
+        they reuse the same HTTP connection pool.
+    """
+    def __init__(self, pool_size: int = 32):
+        self.pool_size = pool_size
+        self.clients = {}
+
+    def get(self, config: dict) -> Client:
+        """Label Studio client of the server of a project configuration"""
+        key = (config["label_studio_url"], config["label_studio_api_key"])
+        if key not in self.clients:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=3)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.clients[key] = Client(url=config["label_studio_url"], api_key=config["label_studio_api_key"],
+                                       session=session)
+        return self.clients[key]
@@ -0,0 +1,241 @@
+import re
+import time
+import random
+import asyncio
+import threading
+import openai
+
+
+# Image tokens assumed for a "high"/"auto" detail image when its size is unknown
+DEFAULT_IMAGE_TOKENS = 765
+# Completion tokens assumed for a structured annotation
+DEFAULT_COMPLETION_TOKENS = 200
+
+
+def parse_duration(value: str) -> float:
+    """Parse the durations used by the x-ratelimit-reset-* headers ("1s", "6m0s", "20ms")
+
+    Args:
+        value (str): header value
+
+    Returns:
+        float: duration in seconds, 0 if it cannot be parsed
+    """
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(number) * units[unit] for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value))
+
+
+def estimate_request_tokens(request: dict) -> int:
+    """Estimate the tokens counted against the tokens-per-minute limit for a chat completion request
+
+    Args:
+        request (dict): body of the request
+
+    Returns:
+        int: estimated number of tokens
+    """
+    tokens = DEFAULT_COMPLETION_TOKENS
+    for message in request.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4
+            elif part["type"] == "image_url":
+                tokens += 85 if part["image_url"].get("detail") == "low" else DEFAULT_IMAGE_TOKENS
+    if "response_format" in request:
+        tokens += len(str(request["response_format"])) // 4
+    return tokens
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a failed query is worth repeating
+
+    Rate limits, timeouts, connection errors, server errors and invalid outputs are retryable.
+    Invalid requests, authentication errors and an exhausted quota are fatal.
+    """
+    if isinstance(error, openai.RateLimitError):
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError, openai.ConflictError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    # Errors of the output parsing
+    return True
+
+
+def get_retry_after(error: Exception):
+    """Delay requested by the server in the retry-after headers, None if there is none"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    return None
+
+
+def backoff_delay(attempt: int, retry_after: float = None, base: float = 1.0, cap: float = 60.0) -> float:
+    """Delay before the next attempt: the delay requested by the server if any,
+    otherwise an exponential backoff with full jitter
+
+    Args:
+        attempt (int): number of failed attempts so far (starting at 1)
+        retry_after (float): delay requested by the server
+        base (float): delay of the first backoff
+        cap (float): maximum delay
+
+    Returns:
+        float: delay in seconds
+    """
+    if retry_after is not None:
+        return min(retry_after, cap) + random.uniform(0, base / 2)
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # Requests larger than the whole bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class RateLimiter:
+    """
+        Requests-per-minute and tokens-per-minute limiter shared by all the queries of a run.
+        The buckets are kept in sync with the x-ratelimit-* headers of the responses, so the
+        limits do not have to be configured: they are learned from the first response.
+        A 429 pauses every query until the delay requested by the server has passed.
+
+        With `shard_count` > 1, the account is shared by as many processes: the limits are
+        configured per process, and the limits and remaining capacity of the headers are divided
+        by `shard_count` as well.
+    """
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None,
+                 base_backoff: float = 1.0, max_backoff: float = 60.0, shard_count: int = 1):
+        self.shard_count = shard_count
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> float:
+        """Take one request and `tokens` tokens if they are available
+
+        Returns:
+            float: 0 if the request may be sent now, otherwise the time to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                return self.blocked_until - now
+            wait = 0.0
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+            if self.requests is not None:
+                self.requests.level -= 1
+            if self.tokens is not None:
+                self.tokens.level -= tokens
+            return 0.0
+
+    def acquire(self, tokens: int):
+        while (wait := self.reserve(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int):
+        while (wait := self.reserve(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """Synchronize the buckets with the rate limit headers of a response"""
+        with self.lock:
+            now = time.monotonic()
+            for name, attribute in (("requests", "requests"), ("tokens", "tokens")):
+                limit = headers.get("x-ratelimit-limit-{}".format(name))
+                remaining = headers.get("x-ratelimit-remaining-{}".format(name))
+                if limit is None or remaining is None:
+                    continue
+                try:
+                    # Share of this process of the limits of the account
+                    limit, remaining = float(limit) / self.shard_count, float(remaining) / self.shard_count
+                except ValueError:
+                    continue
+                bucket = getattr(self, attribute)
+                if bucket is None or bucket.capacity != limit:
+                    bucket = TokenBucket(limit)
+                    setattr(self, attribute, bucket)
+                bucket.refill(now)
+                bucket.level = min(bucket.level, remaining)
+                if remaining <= 0:
+                    reset = parse_duration(headers.get("x-ratelimit-reset-{}".format(name)))
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+    def on_error(self, error: Exception, attempt: int) -> float:
+        """Register a failed query
+
+        Args:
+            error (Exception): the error
+            attempt (int): number of failed attempts so far for this query
+
+        Returns:
+            float: delay before the next attempt
+        """
+        if not isinstance(error, openai.APIError):
+            # Invalid output, query again right away
+            return 0.0
+        delay = backoff_delay(attempt, get_retry_after(error), self.base_backoff, self.max_backoff)
+        if isinstance(error, openai.RateLimitError):
+            # Every query waits, not only the one that hit the limit
+            with self.lock:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+
+def create_rate_limiter_from_config(config: dict) -> RateLimiter:
+    """Create the rate limiter from the `rate_limit` section of the configuration.
+    The configured limits are shared by the `shard_count` processes of a sharded run.
+
+    Args:
+        config (dict): configuration dictionary
+
+    Returns:
+        RateLimiter: the rate limiter
+    """
+    rate_limit = dict(config.get("rate_limit") or {})
+    shard_count = config.get("shard_count", 1)
+    for key in ("requests_per_minute", "tokens_per_minute"):
+        if rate_limit.get(key):
+            rate_limit[key] = rate_limit[key] / shard_count
+    return RateLimiter(shard_count=shard_count, **rate_limit)
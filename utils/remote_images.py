@@ -0,0 +1,259 @@
+import os
+import time
+import base64
+import sqlite3
+import hashlib
+import logging
+import mimetypes
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .metrics import stage_timer
+
+
+# Query parameters of presigned S3, GCS and Azure URLs, they change every time a URL is signed
+SIGNATURE_PARAM_PREFIXES = ("x-amz-", "x-goog-")
+SIGNATURE_PARAMS = {"signature", "expires", "awsaccesskeyid", "googleaccessid",
+                    "sig", "se", "st", "sp", "sv", "sr", "spr", "skoid", "sktid", "skt", "ske", "sks", "skv"}
+# Cloud storage URIs resolved through the presign endpoint of Label Studio
+CLOUD_SCHEMES = ("s3", "gs", "azure-blob")
+
+
+def stable_url(url: str) -> str:
+    """URL without the signature parameters of presigned URLs, so that it does not change between runs"""
+    parsed = urlparse(url)
+    query = [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+             if key.lower() not in SIGNATURE_PARAMS and not key.lower().startswith(SIGNATURE_PARAM_PREFIXES)]
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
+
+def resolve_image_url(value: str, task_id: int, label_studio_url: str) -> str:
+    """URL of the image of a task from its `data.image` value
+
+    Args:
+        value (str): "/data/...", an absolute (possibly presigned) URL, or a cloud storage URI (s3://, gs://)
+        task_id (int): task id, used to presign cloud storage URIs
+        label_studio_url (str): url to the label studio server
+
+    Returns:
+        str: absolute URL of the image
+    """
+    label_studio_url = label_studio_url.rstrip("/")
+    scheme = urlparse(value).scheme
+    if scheme in CLOUD_SCHEMES:
+        # Label Studio redirects to a URL presigned with the credentials of the cloud storage
+        fileuri = base64.urlsafe_b64encode(value.encode("utf-8")).decode("utf-8")
+        return "{}/tasks/{}/presign/?fileuri={}".format(label_studio_url, task_id, fileuri)
+    if scheme in ("http", "https"):
+        return value
+    return label_studio_url + "/" + value.lstrip("/")
+
+
+class ImageDownloadCache:
+    """
+        Bounded on-disk cache of downloaded images, indexed in SQLite by stable URL together with
+        the ETag (or Last-Modified) of the download, so that reruns only revalidate the images.
+        The least recently used images are deleted once the cache grows beyond `max_bytes`.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 2 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, file TEXT NOT NULL, size INTEGER NOT NULL, "
+            "last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+
+    def path(self, url: str, extension: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + extension)
+
+    def get(self, url: str):
+        """Stored (etag, last_modified, path) of a URL, None if it is not cached"""
+        with self.lock:
+            row = self.conn.execute("SELECT etag, last_modified, file FROM images WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[2]):
+                self._delete(url)
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE images SET last_access = ? WHERE url = ?", (time.time(), url))
+            self.conn.commit()
+        return row
+
+    def put(self, url: str, etag: str, last_modified: str, path: str):
+        """Register a downloaded image and evict the least recently used ones if the cache is full"""
+        size = os.path.getsize(path)
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM images WHERE url = ?", (url,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+                              (url, etag, last_modified, path, size, time.time()))
+            self.total_bytes += size
+            self._evict(keep=url)
+            self.conn.commit()
+
+    def _delete(self, url: str):
+        row = self.conn.execute("SELECT file, size FROM images WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return
+        self.conn.execute("DELETE FROM images WHERE url = ?", (url,))
+        self.total_bytes -= row[1]
+        try:
+            os.remove(row[0])
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep: str):
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT url FROM images WHERE url != ? ORDER BY last_access LIMIT 100", (keep,)
+            ).fetchall()
+            if not rows:
+                break
+            for (url,) in rows:
+                self._delete(url)
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class RemoteImageSource:
+    """
+        Download the images of remote projects into a local cache, a configurable number of tasks
+        ahead of the query stage, with a pooled HTTP session. The Label Studio token is only sent
+        to the Label Studio server, not to the storage serving presigned URLs.
+    """
+    def __init__(self, label_studio_url: str, api_key: str, cache_dir: str = "./cache/images",
+                 cache_max_mb: float = 2048, workers: int = 8, prefetch: int = 32, timeout: float = 30,
+                 retries: int = 3):
+        self.label_studio_host = urlparse(label_studio_url).netloc
+        self.api_key = api_key
+        self.cache = ImageDownloadCache(cache_dir, int(cache_max_mb * 1024 * 1024))
+        self.workers = workers
+        self.prefetch = max(prefetch, workers)
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Optional RunMetrics timing the downloads
+        self.metrics = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers, max_retries=Retry(
+            total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",), respect_retry_after_header=True))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _count(self, name: str):
+        if self.metrics is not None:
+            self.metrics.count(name)
+
+    def fetch(self, url: str) -> str:
+        """Download an image, or revalidate the cached copy
+
+        Args:
+            url (str): absolute URL of the image
+
+        Returns:
+            str: local path to the image
+        """
+        key = stable_url(url)
+        cached = self.cache.get(key)
+        headers = {}
+        if urlparse(url).netloc == self.label_studio_host:
+            # Dropped by requests if the server redirects to another host
+            headers["Authorization"] = "Token {}".format(self.api_key)
+        if cached is not None:
+            etag, last_modified, path = cached
+            if etag is None and last_modified is None:
+                # Nothing to revalidate with, the URL is trusted to always serve the same image
+                self._count("image_cache_hits")
+                return path
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
+        with stage_timer(self.metrics, "image_download"):
+            with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    self._count("image_cache_hits")
+                    return cached[2]
+                response.raise_for_status()
+
+                extension = os.path.splitext(urlparse(key).path)[1]
+                if not extension:
+                    content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+                    extension = mimetypes.guess_extension(content_type) or ".jpg"
+                path = self.cache.path(key, extension.lower())
+                tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(1 << 16):
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+                self.cache.put(key, response.headers.get("ETag"), response.headers.get("Last-Modified"), path)
+        self._count("image_downloads")
+        return path
+
+    def fetch_tasks(self, tasks, logger: logging.Logger):
+        """Download the images of the tasks `prefetch` tasks ahead of the consumer
+
+        Args:
+            tasks: iterable of (task_id, image url) pairs
+            logger (logging.Logger): logger
+
+        Yields:
+            tuple: (task_id, local image path), in the same order, tasks whose image cannot be downloaded are skipped
+        """
+        window = deque()
+        tasks = iter(tasks)
+        while True:
+            while len(window) < self.prefetch:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                window.append((task[0], task[1], self.executor.submit(self.fetch, task[1])))
+            if not window:
+                return
+            task_id, url, future = window.popleft()
+            try:
+                yield task_id, future.result()
+            except Exception as e:
+                self._count("image_download_failures")
+                logger.error("Error in downloading the image of task {} ({})! Skipping the task.".format(task_id, url))
+                logger.error(e)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+        self.cache.close()
+
+
+def create_image_source_from_config(config: dict):
+    """Create the image source of remote projects from the `remote_images` section of the configuration
+
+    Args:
+        config (dict): configuration dictionary
+
+    Returns:
+        RemoteImageSource: the image source, None for local projects
+    """
+    if config["data_storage"] != "remote":
+        return None
+    return RemoteImageSource(config["label_studio_url"], config["label_studio_api_key"],
+                             **(config.get("remote_images") or {}))
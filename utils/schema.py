@@ -0,0 +1,210 @@
+import re
+import json
+import difflib
+
+
+JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "null": type(None),
+}
+# Similarity above which a label that is not in an enum is replaced by the closest allowed label
+NEAR_MISS_CUTOFF = 0.85
+
+
+def normalize_name(text: str) -> str:
+    """Lowercase alphanumeric form of a key or label, e.g. "main_color" and "Main Color" -> "maincolor" """
+    return re.sub(r"[^0-9a-z]", "", text.casefold())
+
+
+def extract_json(text: str) -> tuple:
+    """Decode the JSON value of a model output, ignoring code fences and text around the value
+
+    Args:
+        text (str): raw output of the model
+
+    Returns:
+        tuple: (decoded value, list of the repairs applied, e.g. ["code_fence"])
+
+    Raises:
+        ValueError: if the output holds no JSON value
+    """
+    if text is None:
+        raise ValueError("Empty output")
+    try:
+        return json.loads(text), []
+    except ValueError:
+        pass
+    stripped = text.strip()
+    repairs = []
+    if stripped.startswith("```"):
+        # ```json ... ```
+        stripped = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", stripped)
+        repairs.append("code_fence")
+    starts = [index for index in (stripped.find("{"), stripped.find("[")) if index >= 0]
+    if not starts:
+        raise ValueError("No JSON value in the output")
+    value, _ = json.JSONDecoder().raw_decode(stripped, min(starts))
+    if min(starts) > 0 or not repairs:
+        repairs.append("surrounding_text")
+    return value, repairs
+
+
+class SchemaValidator:
+    """
+        Validator of the subset of JSON schema used by the prompts (type, enum, properties, required,
+        additionalProperties, items, minItems, maxItems), compiled once per schema: the sub-schemas
+        and the normalized lookups of the property names and enum labels are built up front.
+        Besides reporting errors, it repairs the trivial mistakes of model outputs.
+
+        Args:
+            schema (dict): JSON schema
+    """
+    def __init__(self, schema: dict):
+        self.schema = schema
+        expected = schema.get("type")
+        self.types = None if expected is None else (expected if isinstance(expected, list) else [expected])
+        self.enum = schema.get("enum")
+        self.enum_labels = {normalize_name(label): label for label in self.enum or [] if isinstance(label, str)}
+        self.properties = {name: SchemaValidator(sub_schema) for name, sub_schema in schema.get("properties", {}).items()}
+        self.property_names = {normalize_name(name): name for name in self.properties}
+        self.required = schema.get("required", [])
+        self.closed = schema.get("additionalProperties") is False
+        self.items = SchemaValidator(schema["items"]) if "items" in schema else None
+        self.min_items = schema.get("minItems")
+        self.max_items = schema.get("maxItems")
+
+    def _type_ok(self, instance) -> bool:
+        # bool is a subclass of int, but not a JSON integer
+        return self.types is None or any(
+            isinstance(instance, JSON_TYPES[name]) and not (isinstance(instance, bool) and name in ("integer", "number"))
+            for name in self.types)
+
+    def errors(self, instance, path: str = "$") -> list:
+        """Error messages of a decoded value, empty if it is valid"""
+        if not self._type_ok(instance):
+            return ["{}: expected {}, got {}".format(path, self.schema["type"], type(instance).__name__)]
+        errors = []
+        if self.enum is not None and instance not in self.enum:
+            errors.append("{}: {!r} is not one of the allowed values".format(path, instance))
+
+        if isinstance(instance, dict):
+            for key in self.required:
+                if key not in instance:
+                    errors.append("{}: missing required property {!r}".format(path, key))
+            for key, value in instance.items():
+                if key in self.properties:
+                    errors += self.properties[key].errors(value, "{}.{}".format(path, key))
+                elif self.closed:
+                    errors.append("{}: unexpected property {!r}".format(path, key))
+        elif isinstance(instance, list):
+            if self.min_items is not None and len(instance) < self.min_items:
+                errors.append("{}: expected at least {} items".format(path, self.min_items))
+            if self.max_items is not None and len(instance) > self.max_items:
+                errors.append("{}: expected at most {} items".format(path, self.max_items))
+            if self.items is not None:
+                for index, item in enumerate(instance):
+                    errors += self.items.errors(item, "{}[{}]".format(path, index))
+        return errors
+
+    def repair(self, instance) -> tuple:
+        """Fix the trivial mistakes of a decoded model output: a one-object list instead of the object,
+        a label instead of a list of labels (or the reverse), case or spelling variants of property
+        names and enum labels, unexpected properties and invalid items of lists with valid ones
+
+        Args:
+            instance: decoded value
+
+        Returns:
+            tuple: (repaired value, list of the repairs applied)
+        """
+        repairs = []
+        types = self.types or []
+        if "object" in types and isinstance(instance, list) and instance and isinstance(instance[0], dict):
+            instance = instance[0]
+            repairs.append("unwrapped_list")
+        elif "array" in types and not isinstance(instance, list) and instance is not None:
+            instance = [instance]
+            repairs.append("wrapped_value")
+        elif "array" not in types and isinstance(instance, list) and len(instance) == 1:
+            instance = instance[0]
+            repairs.append("unwrapped_value")
+
+        if isinstance(instance, str) and self.enum is not None and instance not in self.enum:
+            key = normalize_name(instance)
+            if key in self.enum_labels:
+                instance = self.enum_labels[key]
+                repairs.append("enum_case")
+            else:
+                close = difflib.get_close_matches(key, self.enum_labels, n=1, cutoff=NEAR_MISS_CUTOFF)
+                if close:
+                    instance = self.enum_labels[close[0]]
+                    repairs.append("enum_near_miss")
+
+        if isinstance(instance, dict) and self.properties:
+            repaired = {}
+            for key, value in instance.items():
+                name = key if key in self.properties else self.property_names.get(normalize_name(str(key)))
+                if name is None:
+                    if not self.closed:
+                        repaired[key] = value
+                    else:
+                        repairs.append("dropped_property")
+                    continue
+                if name != key:
+                    repairs.append("property_case")
+                if name in repaired:
+                    continue
+                repaired[name], value_repairs = self.properties[name].repair(value)
+                repairs += value_repairs
+            instance = repaired
+        elif isinstance(instance, list) and self.items is not None:
+            items = []
+            for item in instance:
+                item, item_repairs = self.items.repair(item)
+                repairs += item_repairs
+                items.append(item)
+            valid = [item for item in items if not self.items.errors(item)]
+            # Invalid labels next to valid ones are dropped, a list without any valid label is left for a re-query
+            if valid and len(valid) < len(items):
+                repairs.append("dropped_item")
+                items = valid
+            if self.max_items is not None and len(items) > self.max_items:
+                items = items[:self.max_items]
+                repairs.append("truncated")
+            instance = items
+        return instance, repairs
+
+    def invalid_properties(self, instance: dict) -> list:
+        """Properties of an object that are missing or invalid, in the order of the schema"""
+        return [name for name, validator in self.properties.items()
+                if (name in instance and validator.errors(instance[name]))
+                or (name not in instance and name in self.required)]
+
+    def subschema(self, properties: list) -> dict:
+        """Schema of an object with only some of the properties, all of them required"""
+        return {
+            "type": "object",
+            "properties": {name: self.properties[name].schema for name in properties},
+            "required": list(properties),
+            "additionalProperties": False
+        }
+
+
+def schema_errors(instance, schema: dict, path: str = "$") -> list:
+    """Validate a model output against the subset of JSON schema used by the prompts
+    (type, enum, properties, required, additionalProperties, items, minItems, maxItems)
+
+    Args:
+        instance: decoded JSON value
+        schema (dict): JSON schema
+        path (str): location of the value, used in the messages
+
+    Returns:
+        list: error messages, empty if the value is valid
+    """
+    return SchemaValidator(schema).errors(instance, path)
@@ -0,0 +1,90 @@
+import os
+import re
+import glob
+import hashlib
+
+
+def shard_of(task_id: int, shard_count: int) -> int:
+    """Shard of a task, from a stable hash of its id (the same on every machine and every run)
+
+    Args:
+        task_id (int): task id
+        shard_count (int): number of shards
+
+    Returns:
+        int: shard index in [0, shard_count)
+    """
+    digest = hashlib.blake2b(str(task_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+def check_shard(shard_index: int, shard_count: int):
+    """Raise a ValueError for an invalid shard"""
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError("Invalid shard {} of {}!".format(shard_index, shard_count))
+
+
+def shard_path(path: str, shard_index: int, shard_count: int) -> str:
+    """Per-shard version of a file or directory path, e.g. journal.sqlite -> journal.shard-1-of-4.sqlite"""
+    if shard_count <= 1 or path is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return "{}.shard-{}-of-{}{}".format(root, shard_index, shard_count, extension)
+
+
+def config_shard_path(config: dict, path: str) -> str:
+    """Per-shard version of a path for the shard set in the configuration (`shard_index`, `shard_count`)"""
+    return shard_path(path, config.get("shard_index", 0), config.get("shard_count", 1))
+
+
+def check_resume_shards(path: str, shard_count: int):
+    """Raise a ValueError if the journals next to `path` were written with another number of shards.
+    The tasks of a shard depend on the number of shards, so a run can only be resumed with the same number.
+
+    Args:
+        path (str): unsharded journal path
+        shard_count (int): number of shards of the resumed run
+    """
+    root, extension = os.path.splitext(path)
+    pattern = re.compile(re.escape(root) + r"\.shard-\d+-of-(\d+)" + re.escape(extension) + "$")
+    counts = {int(match.group(1)) for match in map(pattern.match, glob.glob(glob.escape(root) + ".shard-*" + extension)) if match}
+    if os.path.exists(path):
+        counts.add(1)
+    if counts and shard_count not in counts:
+        raise ValueError("Cannot resume with {} shard(s), the previous run used {} shard(s)!".format(
+            shard_count, sorted(counts)))
+
+
+def merge_summaries(summaries: list) -> dict:
+    """Merge the run summaries of the shards (see RunMetrics.summary())
+
+    Counts, totals, counters, errors, tokens and costs are summed. Percentiles cannot be merged
+    exactly, the merged p50/p95/p99 and max are the largest over the shards (an upper bound).
+
+    Args:
+        summaries (list): run summaries
+
+    Returns:
+        dict: merged summary
+    """
+    merged = {"wall_time": 0.0, "stages": {}, "counters": {}, "errors": {},
+              "tokens": {"prompt": 0, "completion": 0, "cached": 0}, "cost_usd": 0.0, "shards": len(summaries)}
+    for summary in summaries:
+        merged["wall_time"] = max(merged["wall_time"], summary["wall_time"])
+        merged["cost_usd"] = round(merged["cost_usd"] + summary["cost_usd"], 6)
+        for section in ("counters", "errors", "tokens"):
+            for name, value in summary[section].items():
+                merged[section][name] = merged[section].get(name, 0) + value
+        for section in ("tokens_by_model", "tokens_by_purpose"):
+            for name, tokens in summary.get(section, {}).items():
+                current = merged.setdefault(section, {}).setdefault(name, {"prompt": 0, "completion": 0, "cached": 0})
+                for kind, value in tokens.items():
+                    current[kind] = current.get(kind, 0) + value
+        for stage, stats in summary["stages"].items():
+            current = merged["stages"].setdefault(stage, {"count": 0, "total": 0.0, "p50": 0.0, "p95": 0.0,
+                                                          "p99": 0.0, "max": 0.0})
+            current["count"] += stats["count"]
+            current["total"] = round(current["total"] + stats["total"], 6)
+            for key in ("p50", "p95", "p99", "max"):
+                current[key] = max(current[key], stats[key])
+    return merged
@@ -0,0 +1,288 @@
+import os
+import json
+import glob
+import time
+import logging
+import threading
+from .metrics import stage_timer
+
+
+# Segment being written, segment ready to be pushed, segment pushed to Label Studio
+OPEN_SUFFIX, READY_SUFFIX, DONE_SUFFIX = ".jsonl.part", ".jsonl", ".jsonl.done"
+
+
+def ready_segments(directory: str) -> list:
+    """Segments of a spool waiting to be pushed, oldest first"""
+    return sorted(glob.glob(os.path.join(directory, "*" + READY_SUFFIX)))
+
+
+def pending_bytes(directory: str) -> int:
+    """Size of the segments of a spool waiting to be pushed"""
+    return sum(os.path.getsize(path) for path in ready_segments(directory) if os.path.exists(path))
+
+
+def spool_project(directory: str):
+    """Project id of the predictions of a spool, None if no segment is waiting to be pushed"""
+    for path in ready_segments(directory):
+        with open(path, encoding="utf-8") as f:
+            line = f.readline()
+        if line:
+            return json.loads(line)["project"]
+    return None
+
+
+class SpoolWriter:
+    """
+        Durable local spool of the parsed predictions of a project, written by the query stage instead
+        of uploading them, so that the model run does not depend on the availability of Label Studio.
+        Predictions are appended to a JSONL segment, which is synced and renamed to *.jsonl once it
+        holds `segment_size` predictions or is `segment_seconds` old; only complete segments are pushed.
+        It can replace the PredictionUploader of a run (add, flush and stats).
+
+        With `max_pending_mb`, add() waits while the segments not pushed yet exceed this size, so that
+        a consumer running at the same time bounds the spool (backpressure). Segments left open by an
+        interrupted run are completed at start-up with their whole lines.
+
+        Args:
+            directory (str): directory of the segments
+            project_id (int): id of the project of the predictions
+            logger (logging.Logger): logger
+            segment_size (int): maximum number of predictions per segment
+            segment_seconds (float): maximum age of the open segment
+            max_pending_mb (float): maximum size of the segments waiting to be pushed, None for no limit
+            journal (RunJournal): optional journal, tasks are marked as spooled once their segment is complete
+            metrics (RunMetrics): optional run metrics
+            model_version (str): optional model version of the predictions, uploaded with them
+    """
+    def __init__(self, directory: str, project_id: int, logger: logging.Logger, segment_size: int = 1000,
+                 segment_seconds: float = 30.0, max_pending_mb: float = None, journal=None, metrics=None,
+                 model_version: str = None):
+        self.directory = directory
+        self.project_id = project_id
+        self.logger = logger
+        self.segment_size = segment_size
+        self.segment_seconds = segment_seconds
+        self.max_pending_bytes = None if max_pending_mb is None else int(max_pending_mb * 1024 * 1024)
+        self.journal = journal
+        self.metrics = metrics
+        self.model_version = model_version
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        self.tasks = []
+        self.opened = None
+        self.stats = {"spooled": 0}
+        os.makedirs(directory, exist_ok=True)
+        for path in sorted(glob.glob(os.path.join(directory, "*" + OPEN_SUFFIX))):
+            self._recover_segment(path)
+
+    def _recover_segment(self, path: str):
+        """Complete a segment left open by an interrupted run, its last line may be cut"""
+        lines, tasks = [], []
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith("\n"):
+                    break
+                lines.append(line)
+                tasks.append(record["task"])
+        if not lines:
+            os.remove(path)
+            return
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._complete(path, tasks)
+        self.logger.warning("Recovered {} predictions from the open segment {}".format(len(tasks), path))
+
+    def add(self, task_id: int, prediction: dict):
+        """Append the prediction of a task to the spool
+
+        Args:
+            task_id (int): task id
+            prediction (dict): prediction filled from the result template
+        """
+        self._wait_for_consumer()
+        record = {"project": self.project_id, "task": task_id, "result": prediction["result"]}
+        if self.model_version is not None:
+            record["model_version"] = self.model_version
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.file is None:
+                # Names sort by creation time, the consumer pushes the segments in this order
+                self.path = os.path.join(self.directory, "{:020d}-{}{}".format(time.time_ns(), os.getpid(), OPEN_SUFFIX))
+                self.file = open(self.path, "w", encoding="utf-8")
+                self.opened = time.monotonic()
+            self.file.write(line)
+            self.tasks.append(task_id)
+            self.stats["spooled"] += 1
+            if len(self.tasks) >= self.segment_size or time.monotonic() - self.opened >= self.segment_seconds:
+                self._close_segment()
+
+    def _wait_for_consumer(self):
+        if self.max_pending_bytes is None:
+            return
+        waited = False
+        while pending_bytes(self.directory) > self.max_pending_bytes:
+            if not waited:
+                self.logger.warning("Spool {} is full, waiting for the predictions to be pushed".format(self.directory))
+                waited = True
+            with stage_timer(self.metrics, "spool_wait"):
+                time.sleep(1.0)
+
+    def _close_segment(self):
+        if self.file is None:
+            return
+        with stage_timer(self.metrics, "spool_sync"):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self._complete(self.path, self.tasks)
+        self.file, self.path, self.tasks = None, None, []
+
+    def _complete(self, path: str, tasks: list):
+        """Make a synced segment visible to the consumers, then journal its tasks as spooled"""
+        # A task is only journaled as spooled once its prediction is in a complete segment. The journal
+        # does not turn a task uploaded by a consumer in the meantime back to spooled.
+        os.replace(path, path[:-len(OPEN_SUFFIX)] + READY_SUFFIX)
+        if self.journal is not None:
+            for task_id in tasks:
+                self.journal.record(task_id, "spooled")
+            self.journal.flush()
+
+    def flush(self):
+        """Complete the open segment"""
+        with self.lock:
+            self._close_segment()
+        self.logger.info("Predictions spooled to {}: {}".format(self.directory, self.stats["spooled"]))
+
+
+class SpoolConsumer:
+    """
+        Push the complete segments of a spool to Label Studio through a PredictionUploader, oldest
+        first. A segment is renamed to *.jsonl.done (or deleted) once all its predictions are stored;
+        if Label Studio fails, the segment is tried again after a backoff, predictions that were already
+        stored are skipped by the uploader. The consumer runs once over the spool with drain(), or in a
+        background thread next to the query stage with start() and stop().
+
+        Args:
+            directory (str): directory of the segments
+            uploader (PredictionUploader): uploader of the predictions to the project
+            logger (logging.Logger): logger
+            poll_interval (float): seconds between two checks for new segments
+            delete (bool): delete the pushed segments instead of keeping them as *.jsonl.done
+            max_backoff (float): maximum delay in seconds before a failed segment is tried again
+    """
+    def __init__(self, directory: str, uploader, logger: logging.Logger, poll_interval: float = 2.0,
+                 delete: bool = False, max_backoff: float = 60.0):
+        self.directory = directory
+        self.uploader = uploader
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.delete = delete
+        self.max_backoff = max_backoff
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"segments": 0, "predictions": 0, "failures": 0}
+
+    def push_segment(self, path: str):
+        """Push the predictions of a segment and mark it as done"""
+        count = 0
+        failed = self.uploader.stats.get("failed", 0)
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["project"] != self.uploader.project.id:
+                    raise ValueError("Segment {} holds predictions of project {}, not of project {}!".format(
+                        path, record["project"], self.uploader.project.id))
+                self.uploader.add(record["task"], {key: value for key, value in record.items()
+                                                   if key in ("result", "model_version")})
+                count += 1
+        self.uploader.flush()
+        if self.uploader.stats.get("failed", 0) > failed:
+            raise RuntimeError("{} predictions could not be stored".format(self.uploader.stats["failed"] - failed))
+        if self.delete:
+            os.remove(path)
+        else:
+            os.replace(path, path[:-len(READY_SUFFIX)] + DONE_SUFFIX)
+        self.stats["segments"] += 1
+        self.stats["predictions"] += count
+
+    def drain(self, follow: bool = False):
+        """Push the segments of the spool
+
+        Args:
+            follow (bool): keep waiting for new segments until stop() is called, otherwise
+                return once the spool is empty
+        """
+        failures = 0
+        while True:
+            segments = ready_segments(self.directory)
+            if not segments:
+                # Once stopped, the consumer returns when the spool is empty
+                if not follow or self.stop_event.is_set():
+                    return
+                self.stop_event.wait(self.poll_interval)
+                continue
+            try:
+                self.push_segment(segments[0])
+                failures = 0
+            except ValueError:
+                # Segment of another project or corrupted, trying again would not help
+                raise
+            except Exception as e:
+                failures += 1
+                self.stats["failures"] += 1
+                delay = min(self.max_backoff, 2 ** failures)
+                self.logger.error("Error in pushing {} ({}: {}), trying again in {}s".format(
+                    segments[0], type(e).__name__, e, delay))
+                time.sleep(delay)
+
+    def start(self):
+        """Push the segments in a background thread as they are completed"""
+        self.thread = threading.Thread(target=self.drain, kwargs={"follow": True}, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout: float = None):
+        """Push the remaining segments and stop the background thread"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+def spool_directory(config: dict) -> str:
+    """Spool directory of a project (one per shard)"""
+    from .sharding import config_shard_path
+    return config_shard_path(config, config.get("spool_dir", "./spool/project_{}".format(config["project_id"])))
+
+
+def create_spool_writer_from_config(config: dict, logger: logging.Logger, journal=None, metrics=None,
+                                    model_version: str = None, consumer: bool = True) -> SpoolWriter:
+    """Create the spool of the predictions of a project from the configuration
+
+    Args:
+        config (dict): configuration dictionary of the project
+        logger (logging.Logger): logger
+        journal (RunJournal): optional journal of the run
+        metrics (RunMetrics): optional run metrics
+        model_version (str): optional model version of the predictions
+        consumer (bool): whether a consumer pushes the spool during the run, `spool_max_pending_mb`
+            is ignored otherwise, as nothing would make room in the spool
+
+    Returns:
+        SpoolWriter: the spool writer
+    """
+    max_pending_mb = config.get("spool_max_pending_mb")
+    if max_pending_mb is not None and not consumer:
+        logger.warning("spool_max_pending_mb is ignored, no consumer pushes the spool during the run")
+        max_pending_mb = None
+    return SpoolWriter(spool_directory(config), config["project_id"], logger,
+                       segment_size=config.get("spool_segment_size", 1000),
+                       segment_seconds=config.get("spool_segment_seconds", 30),
+                       max_pending_mb=max_pending_mb,
+                       journal=journal, metrics=metrics, model_version=model_version)
@@ -0,0 +1,157 @@
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from label_studio_sdk import Project
+from .uploader import result_digest
+
+
+def not_annotated() -> dict:
+    return {"filter": "filter:tasks:total_annotations", "operator": "equal", "type": "Number", "value": 0}
+
+
+def with_model_version(model_version: str, present: bool) -> dict:
+    return {"filter": "filter:tasks:predictions_model_versions", "operator": "contains" if present else "not_contains",
+            "type": "List", "value": model_version}
+
+
+def updated_after(timestamp: str) -> dict:
+    return {"filter": "filter:tasks:updated_at", "operator": "greater", "type": "Datetime", "value": timestamp}
+
+
+def before(timestamp: str) -> str:
+    """Mark strictly before an ISO timestamp of Label Studio, in the format of server_time()"""
+    moment = datetime.fromisoformat(timestamp.replace("Z", "+00:00")[:19])
+    return (moment - timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def server_time(project: Project):
+    """Current time of the Label Studio server (Date header), as an ISO timestamp, None if it is not sent"""
+    response = project.make_request("GET", "/api/projects/{}".format(project.id))
+    if "Date" not in response.headers:
+        return None
+    return parsedate_to_datetime(response.headers["Date"]).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class IncrementalSync:
+    """
+        Incremental selection of the tasks of a project. Instead of walking the whole project, the
+        Label Studio server is asked, through Data Manager filters, for:
+
+            new work:      tasks without annotation and without a prediction of `model_version`
+            changed tasks: tasks without annotation, with a prediction of `model_version`, updated
+                           after the high-water mark of the previous complete run
+
+        The high-water mark is the server time at the start of a run. It is only saved by commit()
+        once the run has completed, so that an interrupted run is selected again in full. When
+        some selected tasks were not predicted (failed, unparsed), the mark is held before the
+        oldest update of these tasks, so that the next run selects them again.
+        The predictions of `model_version` come with the tasks, the uploader does not need to
+        download the predictions of the whole project.
+
+        Args:
+            path (str): JSON file of the high-water mark
+            model_version (str): model version of the predictions of the run
+            refresh_changed (bool): also select the tasks updated after their prediction
+    """
+    def __init__(self, path: str, model_version: str, refresh_changed: bool = True):
+        self.path = path
+        self.model_version = model_version
+        self.refresh_changed = refresh_changed
+        self.mark = None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            # The mark of another model version does not tell which tasks have a current prediction
+            if state.get("model_version") == model_version:
+                self.mark = state.get("high_water_mark")
+        self.started = None
+        # Task id -> (prediction id, result digest) of the existing predictions of `model_version`
+        self.predictions = {}
+        # Task id -> updated_at of the tasks handed to the run
+        self.selected = {}
+        self.stats = {"new": 0, "changed": 0}
+
+    def iter_tasks(self, project: Project, page_size: int = 100, metrics=None):
+        """Tasks that need a prediction of the model version
+
+        Yields:
+            dict: task with its id, data, update time and predictions
+        """
+        from .label_studio_server import iter_tasks
+        self.started = server_time(project)
+        queries = [("new", [not_annotated(), with_model_version(self.model_version, False)])]
+        if self.refresh_changed and self.mark is not None:
+            queries.append(("changed", [not_annotated(), with_model_version(self.model_version, True),
+                                        updated_after(self.mark)]))
+        # Tasks predicted by this run can match the second query, they are only processed once
+        seen = set()
+        for kind, filters in queries:
+            for task in iter_tasks(project, page_size, fields="id,data,updated_at,predictions", metrics=metrics, filters=filters):
+                if task["id"] in seen:
+                    continue
+                seen.add(task["id"])
+                self.stats[kind] += 1
+                for prediction in task.get("predictions") or []:
+                    if prediction.get("model_version") == self.model_version and task["id"] not in self.predictions:
+                        self.predictions[task["id"]] = (prediction["id"], result_digest(prediction["result"]))
+                yield task
+
+    def select(self, task: dict):
+        """Record a task handed to the run, commit() checks that it was predicted"""
+        self.selected[task["id"]] = task.get("updated_at")
+
+    def commit(self, logger: logging.Logger, finished: set):
+        """Save the high-water mark once the run has completed
+
+        Args:
+            logger (logging.Logger): logger
+            finished (set): ids of the tasks whose prediction was uploaded or spooled
+        """
+        logger.info("Incremental sync: {} new tasks and {} tasks updated since {}".format(
+            self.stats["new"], self.stats["changed"], self.mark or "the first run"))
+        if self.started is None:
+            return
+        mark = self.started
+        unfinished = [updated_at for task_id, updated_at in self.selected.items() if task_id not in finished]
+        if unfinished:
+            if None in unfinished:
+                logger.warning("Incremental sync: {} tasks were not predicted, the high-water mark is kept at {}".format(
+                    len(unfinished), self.mark))
+                return
+            mark = min(mark, before(min(unfinished)))
+            logger.warning("Incremental sync: {} tasks were not predicted, the next run selects the tasks updated since {}".format(
+                len(unfinished), mark))
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"model_version": self.model_version, "high_water_mark": mark}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def model_version_from_config(config: dict, prompt) -> str:
+    """Model version written with the predictions: `model_version`, or the origin of the prompt"""
+    return config.get("model_version") or prompt.origin
+
+
+def create_sync_from_config(config: dict, prompt, incremental: bool = False):
+    """Create the incremental sync of a project
+
+    Args:
+        config (dict): configuration dictionary of the project
+        prompt: Prompt object of the project
+        incremental (bool): turn the incremental mode on, whatever the configuration
+
+    Returns:
+        IncrementalSync: the sync, None if the project is walked in full
+    """
+    from .sharding import config_shard_path
+    if not (incremental or config.get("incremental")):
+        return None
+    model_version = model_version_from_config(config, prompt)
+    if not model_version:
+        raise ValueError("The incremental mode needs a `model_version` or an `origin` of the prompt!")
+    path = config.get("sync_state_path", "./journals/project_{}.sync.json".format(config["project_id"]))
+    return IncrementalSync(config_shard_path(config, path), model_version,
+                           refresh_changed=config.get("refresh_changed", True))
@@ -0,0 +1,100 @@
+import json
+
+
+# Attribute of the model output -> "from_name" of the Label Studio result it fills
+ATTRIBUTE_MAPPING = {
+    "Function": "answer1",
+    "Type": "answer2",
+    "Main Color": "answer3",
+    "Sub Color": "answer4",
+    "Upper Structure": "answer5",
+    "Closure Type": "answer6",
+    "Toe Shape": "answer7",
+    "Heel Type": "answer8"
+}
+
+
+# Separator of the labels of multi-label answers in the textareas of Label Studio
+LABEL_SEPARATOR = ", "
+
+
+def format_value(value) -> str:
+    """Format an attribute value as the text of a Label Studio textarea, lists are comma-joined"""
+    if isinstance(value, list):
+        return LABEL_SEPARATOR.join(value)
+    return value
+
+
+class CompiledTemplate:
+    """
+        Result template compiled once for a given attribute mapping.
+        The static part of each result is prebuilt, filling the template only creates the
+        result dictionaries that change, instead of deep-copying the whole template for every task.
+    """
+    def __init__(self, template: dict, mapping: dict = None):
+        self.template = template
+        self.mapping = dict(mapping or ATTRIBUTE_MAPPING)
+
+        from_names = {result["from_name"] for result in template["result"]}
+        missing = [name for name in self.mapping.values() if name not in from_names]
+        if missing:
+            raise ValueError("The result template has no result for {}!".format(missing))
+
+        from_name_to_attribute = {from_name: attribute for attribute, from_name in self.mapping.items()}
+        # (static fields, attribute) for each result, attribute is None for results that are not filled
+        self.slots = []
+        for result in template["result"]:
+            static = {key: value for key, value in result.items() if key not in ("value", "origin")}
+            self.slots.append((static, from_name_to_attribute.get(result["from_name"]), result))
+        self.required = list(self.mapping.keys())
+
+    def validate(self, values: dict):
+        """Raise a ValueError if some attributes are missing from the model output"""
+        if not isinstance(values, dict):
+            raise ValueError("Expected a JSON object, got {}!".format(type(values).__name__))
+        missing = [attribute for attribute in self.required if attribute not in values]
+        if missing:
+            raise ValueError("Missing attributes {} in the model output!".format(missing))
+
+    def fill(self, values: dict, origin: str) -> dict:
+        """Fill the template with the attribute values of the model output
+
+        Args:
+            values (dict): attribute -> label or list of labels
+            origin (str): origin of the prediction
+
+        Returns:
+            dict: prediction in the Label Studio format
+        """
+        self.validate(values)
+        results = []
+        for static, attribute, result in self.slots:
+            if attribute is None:
+                results.append(result)
+                continue
+            filled = dict(static)
+            filled["value"] = {"text": [format_value(values[attribute])]}
+            filled["origin"] = origin
+            results.append(filled)
+        return {"result": results}
+
+
+def compile_template(template, mapping: dict = None) -> CompiledTemplate:
+    """Compile a result template, already compiled templates are returned as they are
+
+    Args:
+        template (dict | CompiledTemplate): result template
+        mapping (dict): attribute -> from_name, defaults to ATTRIBUTE_MAPPING
+
+    Returns:
+        CompiledTemplate: compiled template
+    """
+    if isinstance(template, CompiledTemplate):
+        return template
+    return CompiledTemplate(template, mapping)
+
+
+def load_template(template_file: str, mapping: dict = None) -> CompiledTemplate:
+    """Load and compile a result template from `result_templates/`"""
+    with open(template_file) as f:
+        return CompiledTemplate(json.load(f), mapping)
@@ -0,0 +1,149 @@
+import json
+import functools
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from label_studio_sdk import Project
+from .label_studio_server import update_prediction
+from .metrics import stage_timer
+
+
+def result_digest(result: list) -> str:
+    """Hash of the canonical JSON of a prediction result, used to skip identical writes"""
+    return hashlib.sha1(json.dumps(result, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class PredictionUploader:
+    """
+        Upload predictions to Label Studio in bulk.
+        The existing predictions of the project are indexed once, new predictions are buffered and
+        created through the bulk import endpoint, existing ones are updated with concurrent PATCHes,
+        and predictions identical to the stored ones are not written at all.
+
+        With `index` (task id -> (prediction id, result digest)), e.g. filled by the incremental sync
+        as the tasks are fetched, the predictions of the project are not downloaded.
+    """
+    def __init__(self, project: Project, logger: logging.Logger, batch_size: int = 100, workers: int = 4,
+                 journal=None, metrics=None, model_version: str = None, index: dict = None):
+        self.project = project
+        self.logger = logger
+        # Optional RunJournal, tasks are marked as uploaded once their prediction is stored
+        self.journal = journal
+        # Optional RunMetrics timing the create and update requests
+        self.metrics = metrics
+        # Optional model version written with the predictions
+        self.model_version = model_version
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # Task id -> prediction to create, a task added again before it is sent keeps its last prediction
+        self.buffer = {}
+        # Bound the number of queued PATCHes so that updates cannot pile up in memory
+        self.pending_updates = set()
+        self.update_slots = threading.BoundedSemaphore(4 * workers)
+        self.stats = {"created": 0, "updated": 0, "skipped": 0, "failed": 0}
+        self.index = self.load_index() if index is None else index
+
+    def load_index(self) -> dict:
+        """Map each task of the project to the id and result digest of its first prediction"""
+        response = self.project.make_request("GET", "/api/predictions", params={"project": self.project.id})
+        index = {}
+        for prediction in response.json():
+            if prediction["task"] not in index:
+                index[prediction["task"]] = (prediction["id"], result_digest(prediction["result"]))
+        self.logger.info("Found {} tasks with predictions in project {}".format(len(index), self.project.id))
+        return index
+
+    def add(self, task_id: int, prediction: dict):
+        """Queue the prediction of a task, it is sent once enough predictions are buffered
+
+        Args:
+            task_id (int): task id
+            prediction (dict): prediction filled from the result template
+        """
+        digest = result_digest(prediction["result"])
+        with self.lock:
+            existing = self.index.get(task_id)
+            if existing is not None and existing[1] == digest:
+                self.stats["skipped"] += 1
+                self._mark_uploaded(task_id)
+                return
+            if self.model_version is not None:
+                prediction = dict(prediction, model_version=self.model_version)
+            if existing is None or existing[0] is None:
+                self.buffer[task_id] = dict(prediction, task=task_id)
+                self.index[task_id] = (None, digest)
+                if len(self.buffer) < self.batch_size:
+                    return
+                buffer, self.buffer = list(self.buffer.values()), {}
+            else:
+                self.index[task_id] = (existing[0], digest)
+                buffer = None
+
+        if buffer is not None:
+            self._create(buffer)
+        else:
+            self._update(task_id, existing[0], prediction)
+
+    def _mark_uploaded(self, task_id: int):
+        if self.journal is not None:
+            self.journal.record(task_id, "uploaded")
+
+    def _create(self, predictions: list):
+        if predictions:
+            try:
+                with stage_timer(self.metrics, "ls_create"):
+                    self.project.create_predictions(predictions)
+            except Exception as e:
+                # Forget the predictions that were not stored, so that adding them again sends them
+                with self.lock:
+                    self.stats["failed"] += len(predictions)
+                    for prediction in predictions:
+                        if self.index.get(prediction["task"], (None, None))[0] is None:
+                            self.index.pop(prediction["task"], None)
+                self.logger.error("Error in creating {} predictions!".format(len(predictions)))
+                self.logger.error(e)
+                return
+            with self.lock:
+                self.stats["created"] += len(predictions)
+            for prediction in predictions:
+                self._mark_uploaded(prediction["task"])
+
+    def _update(self, task_id: int, prediction_id: int, prediction: dict):
+        self.update_slots.acquire()
+        future = self.executor.submit(self._send_update, prediction_id, prediction)
+        with self.lock:
+            self.pending_updates.add(future)
+        future.add_done_callback(functools.partial(self._update_done, task_id))
+
+    def _send_update(self, prediction_id: int, prediction: dict):
+        with stage_timer(self.metrics, "ls_update"):
+            update_prediction(self.project, prediction_id, prediction)
+
+    def _update_done(self, task_id: int, future):
+        with self.lock:
+            self.pending_updates.discard(future)
+            if future.exception() is None:
+                self.stats["updated"] += 1
+            else:
+                self.stats["failed"] += 1
+                # The stored prediction was not replaced, adding it again sends the update again
+                prediction_id, _ = self.index[task_id]
+                self.index[task_id] = (prediction_id, None)
+        if future.exception() is not None:
+            self.logger.error("Error in updating the prediction of task {}!".format(task_id))
+            self.logger.error(future.exception())
+        else:
+            self._mark_uploaded(task_id)
+        self.update_slots.release()
+
+    def flush(self):
+        """Send the buffered predictions and wait for the pending updates"""
+        with self.lock:
+            buffer, self.buffer = list(self.buffer.values()), {}
+            pending = list(self.pending_updates)
+        self._create(buffer)
+        wait(pending)
+        self.logger.info("Predictions created: {}, updated: {}, unchanged: {}, failed: {}".format(
+            self.stats["created"], self.stats["updated"], self.stats["skipped"], self.stats["failed"]))